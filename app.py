@@ -1,17 +1,25 @@
-import time
+from contextlib import nullcontext
+from ner_annotator.profiling import page_render_timer
+from ner_annotator.tracing import configure_tracing, document_context, span
 import streamlit as st
-from ner_annotator.auth import authenticate
+from ner_annotator.auth import authenticate, is_admin
+from ner_annotator.jobs import get_job_runner
 from settings import auth_file
 
 
 def run_pages(pages):
     pg = st.navigation(pages)
-    pg.run()
+    current_hash = st.session_state.get("current_hash")
+    with document_context(current_hash) if current_hash else nullcontext():
+        with page_render_timer(pg.title):
+            pg.run()
 
-start_time = time.time()
+configure_tracing()
+# Requeue the jobs interrupted by a restart and run them without waiting for a new submission
+get_job_runner()
 authentication_status = st.session_state.get('authentication_status', None)
-authenticate(auth_file=auth_file)
-print("Authentication completed in", time.time() - start_time, "seconds.")
+with span("auth.authenticate"):
+    authenticate(auth_file=auth_file)
 
 if authentication_status:
     username = st.session_state['username']
@@ -23,8 +31,8 @@ if authentication_status:
         st.Page("app_pages/reviewing.py", title="LLM NER Tags Reviewing"),
         st.Page("app_pages/llm_judging.py", title="LLM-As-A-Judge")
     ]
+    if is_admin():
+        pages.append(st.Page("app_pages/diagnostics.py", title="Diagnostics"))
 
     run_pages(pages)
     print("Pages loaded successfully.")
-    print("Pages loaded in", time.time() - start_time, "seconds.")
-    
\ No newline at end of file
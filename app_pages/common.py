@@ -1,25 +1,69 @@
-import time
-import pandas as pd
 import streamlit as st
-import re
 
+from ner_annotator.constants import DATASET_DIR, PIPELINE_MIN_DOCUMENTS
+from ner_annotator.corpus import CorpusIndex, load_corpus_index
+from ner_annotator.corpus_pack import get_corpus_pack
+from ner_annotator.documents import get_document_cache
+from ner_annotator.jobs import get_job_runner
+from ner_annotator.journal import get_journal
+from ner_annotator.metrics import (
+    ReviewStatsAccumulator,
+    ReviewStatsTotal,
+    get_review_counts,
+    summarize_review_counts,
+)
+from ner_annotator.pipeline import export_all, get_shared_pool
+from ner_annotator.search import SearchIndex
+from ner_annotator.send_email import Attachment, OutgoingEmail, get_email_sender
+from ner_annotator.store import ACTIVE_JOB_STATUSES, get_store
+from ner_annotator.tracing import span
+from ner_annotator.entities import EntityIndex, TaggedLine, index_line, normalize_entity_status
+from ner_annotator.export import (
+    EXPORT_FORMATS,
+    LLM_JUDGEMENT_COLUMNS,
+    NER_TAG_COLUMNS,
+    export_records,
+    get_export_file_name,
+    iter_llm_judgement_records,
+    iter_ner_tag_records,
+)
 from ner_annotator.utils import (
-    get_llm_judgment_excel,
+    compact_review_journal,
     get_llm_judgment_stats, 
-    get_ner_tags_excel,
-    encode_df,
-    get_stats
 )
 
 
+JOB_STATUS_REFRESH_SECONDS = 2
+
+
 # Helper Functions
-def extract_entities(tagged_text):
-    pattern = r"<(.*?)>(.*?)</\1>"
-    return [(match[0], match[1]) for match in re.findall(pattern, tagged_text)]
+@st.cache_resource
+def load_shared_corpus_index(dataset_dir=DATASET_DIR) -> CorpusIndex:
+    return load_corpus_index(dataset_dir)
+
+
+def get_corpus_index() -> CorpusIndex:
+    """
+    Corpus index shared by all sessions, with tagged flags refreshed from the store.
+    """
+    return load_shared_corpus_index().refresh_tagged(get_store())
+
+
+@st.cache_resource
+def load_shared_search_index() -> SearchIndex:
+    return SearchIndex.load()
+
+
+def get_search_index() -> SearchIndex:
+    """
+    Full-text index shared by all sessions, updated with any newly uploaded texts.
+    """
+    search_index = load_shared_search_index()
+    search_index.update(load_shared_corpus_index(), get_store())
+    return search_index
 
 
 def add_entity_status():
-    start_time = time.time()
     data = get_current_data()
     if not data:
         st.error("No data found. Please upload a file or start a new session.")
@@ -29,24 +73,76 @@ def add_entity_status():
         st.error("No tagged elements found in the data. ")
         return False
     
-    for i, item in enumerate(data['tagged_elements']):
-        if 'entity_status' not in item:
-            entities = extract_entities(item["tagged"])
-            entities_status = {
-                entity: {
-                    'entity': entity,
-                    'tag': tag,
-                    'user_updated': None,
-                }
-                for tag, entity in entities    
-            }
-            data['tagged_elements'][i]['entity_status'] = entities_status
-            
-    set_text_session_data(**data)
-    print("Added entity status in ", time.time() - start_time, "seconds.")
+    if data.get('entity_index') is not None:
+        return True
+
+    with span("entities.build_status", lines=len(data['tagged_elements'])):
+        # Documents tagged before spans were stored need to be parsed once
+        updated = False
+        for item in data['tagged_elements']:
+            if 'spans' not in item or 'entity_status' not in item:
+                index_line(item)
+                updated = True
+            else:
+                normalize_entity_status(item)
+                
+        entity_index = None
+        if updated:
+            set_text_session_data(tagged_elements=data['tagged_elements'])
+        else:
+            entity_index = get_packed_entity_index(get_current_text_hash())
+        if entity_index is None:
+            entity_index = EntityIndex(data['tagged_elements'])
+        set_text_session_data(entity_index=entity_index)
     return True
 
 
+def get_packed_entity_index(doc_id):
+    """
+    Entity index built with the corpus pack, if the document did not change since.
+    """
+    pack = get_corpus_pack()
+    if pack is None or doc_id not in pack:
+        return None
+    return pack.get_entity_index(doc_id, updated_at=get_store().get_updated_at(doc_id))
+
+
+def get_entity_index() -> EntityIndex:
+    return get_current_data()['entity_index']
+
+
+def get_line_model(line_no) -> TaggedLine:
+    """
+    Editable span model of a line of the current document, built on first access and
+    rebuilt if the line was changed outside of it (bulk corrections, finished jobs).
+    """
+    data = get_current_data()
+    line = data['tagged_elements'][line_no]
+    line_model = (data.get('line_models') or {}).get(line_no)
+    if line_model is None or line_model.tagged != line['tagged']:
+        line_model = get_document_cache().put_line_model(
+            get_current_text_hash(), line_no, TaggedLine.from_line(line)
+        )
+    return line_model
+
+
+def apply_line_model(line_no):
+    """
+    Write an edited line model back into the session line that is saved and exported.
+    """
+    get_line_model(line_no).to_line(get_current_data()['tagged_elements'][line_no])
+
+
+def reindex_line(line_no):
+    """
+    Refresh the entries of an edited line in the document entity index.
+    """
+    line = get_current_data()['tagged_elements'][line_no]
+    if 'spans' not in line:
+        index_line(line)
+    get_entity_index().update_line(line_no, line)
+
+
 def get_current_text_hash():
     
     if 'current_hash' not in st.session_state:
@@ -56,22 +152,32 @@ def get_current_text_hash():
     return st.session_state['current_hash']
 
 def get_current_data(text_hash=None):
+    """
+    Document dictionary from the shared document cache. The session itself only
+    keeps the ids of the documents it opened and its cursors.
+    """
     current_hash = get_current_text_hash() if not text_hash else text_hash
     if current_hash is None:
         st.error(f"No data found for {text_hash}. Please upload a file or start a new session.")
         return 
-    return st.session_state[current_hash]
+    data = get_document_cache().get(current_hash)
+    if data is None:
+        st.error(f"No data found for {current_hash}. Please upload a file or start a new session.")
+    return data
 
 
 def init_session_state(text, text_hash, filename):
-    st.session_state[text_hash] = dict()
-    st.session_state[text_hash] = {
-        "filename": filename,
-        'text': text,
-        'tagged_elements': [],
-        'tagged': False,
-        'llm_judgement': [],
-    }
+    document_cache = get_document_cache()
+    if document_cache.get(text_hash) is None:
+        # Stored before tagging too, so the document can be reloaded after it is evicted
+        get_store().add_document(text_hash, text, filename)
+        document_cache.put(text_hash, {
+            "filename": filename,
+            'text': text,
+            'tagged_elements': [],
+            'tagged': False,
+            'llm_judgement': [],
+        })
     
     st.session_state['all_hashes'] = st.session_state.get('all_hashes', [])
     if text_hash not in st.session_state['all_hashes']:
@@ -81,63 +187,190 @@ def init_session_state(text, text_hash, filename):
 
 def set_text_session_data(**kwargs):
     current_hash = get_current_text_hash()
-    current_data = st.session_state[current_hash]
-    current_data.update(kwargs)
-    st.session_state[current_hash] = current_data
+    if 'tagged_elements' in kwargs:
+        # Derived state of the old lines is rebuilt on the next access
+        kwargs.setdefault('line_models', dict())
+        kwargs.setdefault('entity_index', None)
+        kwargs.setdefault('review_stats', None)
+    get_document_cache().update(current_hash, **kwargs)
+
+
+def submit_job(kind, params, text_hash=None):
+    """
+    Queue a background job for the current document, unless one of the same kind is already active.
+    """
+    text_hash = text_hash or get_current_text_hash()
+    job = get_latest_job(kind, text_hash)
+    if job and job['status'] in ACTIVE_JOB_STATUSES:
+        st.info("A job for this file is already running.")
+        return job['job_id']
+    return get_job_runner().submit(kind, text_hash, params)
+
+
+def get_latest_job(kind, text_hash=None):
+    text_hash = text_hash or st.session_state.get('current_hash')
+    if text_hash is None:
+        return None
+    jobs = get_store().list_jobs(doc_id=text_hash, kind=kind)
+    return jobs[0] if jobs else None
+
+
+@st.fragment(run_every=JOB_STATUS_REFRESH_SECONDS)
+def poll_job_status(job_id):
+    job = get_store().get_job(job_id)
+    if job['status'] not in ACTIVE_JOB_STATUSES:
+        # Reload the document with the results and redraw the whole page
+        get_document_cache().discard(job['doc_id'])
+        st.rerun()
+
+    label = job['message'] or f"{job['kind'].capitalize()} job {job['status']}..."
+    if job['total']:
+        st.progress(min(job['done'] / job['total'], 1.0), text=f"{label} {job['done']}/{job['total']}")
+    else:
+        st.progress(0, text=label)
+    if job['cancel_requested']:
+        st.caption("Cancelling...")
+    elif st.button("Cancel", key=f"cancel_job_{job_id}"):
+        get_job_runner().cancel(job_id)
+
+
+def show_job_status(kind):
+    """
+    Status of the latest job of ``kind`` for the current document, polled while it is active.
+    """
+    job = get_latest_job(kind)
+    if job is None:
+        return None
+    if job['status'] in ACTIVE_JOB_STATUSES:
+        poll_job_status(job['job_id'])
+    elif job['status'] == 'done':
+        st.success(job['message'] or f"{job['kind'].capitalize()} job completed.")
+    elif job['status'] == 'failed':
+        st.error(f"{job['kind'].capitalize()} job failed: {job['error']}")
+    elif job['status'] == 'cancelled':
+        st.warning(f"{job['kind'].capitalize()} job was cancelled.")
+    return job
+
+
+def apply_bulk_correction(entity, tag, new_tag):
+    """
+    Retag every unreviewed occurrence of an entity across the corpus and drop the
+    cached copies of the changed documents.
+    """
+    # Pending journal records would overwrite the corrected lines when folded in later;
+    # those of other server processes cannot be folded here, so their lines are left alone
+    compact_review_journal()
+    batch_id, occurrences = get_store().apply_bulk_correction(
+        entity, tag, new_tag, exclude=get_journal().pending_lines()
+    )
+    for doc_id in {o['doc_id'] for o in occurrences}:
+        get_document_cache().discard(doc_id)
+    return batch_id, occurrences
+
+
+def undo_bulk_correction(batch_id):
+    """
+    Revert a bulk correction, except on the lines reviewed since. Returns the reverted
+    and the skipped ``(doc_id, line_no)`` pairs.
+    """
+    compact_review_journal()
+    reverted, skipped = get_store().undo_bulk_correction(batch_id, exclude=get_journal().pending_lines())
+    for doc_id in {doc_id for doc_id, _ in reverted}:
+        get_document_cache().discard(doc_id)
+    return reverted, skipped
+
+
+def get_review_stats_accumulator(text_hash) -> ReviewStatsAccumulator:
+    """
+    Running review counts of a document, built once and then updated per edit.
+    """
+    data = get_current_data(text_hash=text_hash)
+    if data.get('review_stats') is None:
+        # Through the cache, so the counts are added to the size of the document
+        data = get_document_cache().update(
+            text_hash, review_stats=ReviewStatsAccumulator(data.get('tagged_elements', []))
+        )
+    return data['review_stats']
+
+
+def update_review_stats(line_no):
+    """
+    Apply the change of a single edited line to the document statistics.
+    """
+    accumulator = get_review_stats_accumulator(get_current_text_hash())
+    accumulator.update_line(line_no, get_current_data()['tagged_elements'][line_no])
     
 
-# st.cache_data(max_entries=10)
-def download_ner_tags_data(text_hash):
+def get_ner_tags_records(text_hash):
+    current_data = get_current_data(text_hash=text_hash)
+    if not current_data.get('tagged_elements'):
+        return iter(())
+    return iter_ner_tag_records(current_data.get('filename'), current_data['tagged_elements'])
+
+
+def get_llm_judgement_records(text_hash):
+    current_data = get_current_data(text_hash=text_hash)
+    if not current_data.get('llm_judgement'):
+        return iter(())
+    return iter_llm_judgement_records(current_data.get('filename'), current_data['llm_judgement'])
+
+
+def download_ner_tags_data(text_hash, export_format="Excel"):
     current_data = get_current_data(text_hash=text_hash) 
-    file_name = current_data.get('filename')   
     if 'tagged_elements' not in current_data:
         st.error("No NER tags data found.")
         return None
-    ner_tags_excel = get_ner_tags_excel(file_name, current_data['tagged_elements'])
-    return ner_tags_excel
+    return export_records(
+        get_ner_tags_records(text_hash), NER_TAG_COLUMNS, "NER Tags", export_format
+    )
 
 
-st.cache_data(max_entries=10)
-def download_llm_judgement_data(text_hash):
+def download_llm_judgement_data(text_hash, export_format="Excel"):
     current_data = get_current_data(text_hash=text_hash)
-    file_name = current_data.get('filename')
     if 'llm_judgement' not in current_data:
         st.error("No LLM judgement data found.")
         print("No LLM judgement data found.")
         return None
-
-    llm_judgement_excel = get_llm_judgment_excel(file_name, current_data['llm_judgement'])
-    return llm_judgement_excel
+    return export_records(
+        get_llm_judgement_records(text_hash), LLM_JUDGEMENT_COLUMNS, "LLM Judgement", export_format
+    )
 
 
-def get_combined_data(data_fn, hashes):
-    all_excels = [data_fn(text_hash=text_hash) for text_hash in hashes]
-    all_excels = [excel for excel in all_excels if excel is not None]
-    combined_excel = pd.concat([pd.read_excel(df) for df in all_excels], ignore_index=True, axis=0)
-    print("Combined DataFrame shape:", combined_excel.shape)
-    return encode_df(combined_excel, "Combined NER Tags")
+def get_combined_data(records_fn, hashes, columns, sheet_name, export_format="Excel"):
+    """
+    Stream the records of all documents into a single export file.
+    """
+    records = (record for text_hash in hashes for record in records_fn(text_hash))
+    return export_records(records, columns, sheet_name, export_format)
 
 
-def download_all_ner_tags_data():
+def download_all_ner_tags_data(export_format="Excel"):
     all_hashes = st.session_state.get('all_hashes', [])
     if not all_hashes:
         st.error("No NER tags data found.")
         return None
-    print("All hashes:", all_hashes)
-    return get_combined_data(download_ner_tags_data, all_hashes)
+    if len(all_hashes) >= PIPELINE_MIN_DOCUMENTS:
+        return export_all("ner_tags", all_hashes, export_format, pool=get_shared_pool())
+    return get_combined_data(
+        get_ner_tags_records, all_hashes, NER_TAG_COLUMNS, "Combined NER Tags", export_format
+    )
 
 
-def download_all_llm_judgement_data():
+def download_all_llm_judgement_data(export_format="Excel"):
     all_hashes = st.session_state.get('all_hashes', [])
     if not all_hashes:
         st.error("No LLM judgement data found.")
         return None
-    return get_combined_data(download_llm_judgement_data, all_hashes)
+    if len(all_hashes) >= PIPELINE_MIN_DOCUMENTS:
+        return export_all("llm_judgement", all_hashes, export_format, pool=get_shared_pool())
+    return get_combined_data(
+        get_llm_judgement_records, all_hashes, LLM_JUDGEMENT_COLUMNS, "Combined LLM Judgement", export_format
+    )
 
 
 def get_current_file_review_stats():
-    current_data = get_current_data()
-    return get_stats(current_data['tagged_elements'])
+    with span("stats.current_file"):
+        return summarize_review_counts(get_review_stats_accumulator(get_current_text_hash()).counts)
 
 
 def get_all_files_review_stats():
@@ -146,13 +379,75 @@ def get_all_files_review_stats():
         st.error("No NER tags data found.")
         return None
     
-    all_data = sum([
-        get_current_data(text_hash=text_hash)['tagged_elements'] 
-        for text_hash in all_hashes], []
-    )
-    return get_stats(all_data)
+    total = st.session_state.setdefault('all_files_review_total', ReviewStatsTotal())
+    with span("stats.all_files", files=len(all_hashes)):
+        return summarize_review_counts(total.refresh(
+            (text_hash, get_review_stats_accumulator(text_hash)) for text_hash in all_hashes
+        ))
         
 
+def get_user_email():
+    config = st.session_state.get('credentials_config') or {}
+    user = config.get('credentials', {}).get('usernames', {}).get(st.session_state.get('username'), {})
+    return user.get('email')
+
+
+def format_review_stats(stats):
+    lines = [
+        f"Total entities: {stats['total_entities']}",
+        f"Verified entities: {stats['total_verified']}",
+    ]
+    lines += [f"{tag}: {count}" for tag, count in stats['per_category_count'].items()]
+    for name in ('micro_scores', 'macro_scores'):
+        if stats.get(name):
+            scores = stats[name]
+            lines.append(
+                f"{name.split('_')[0].capitalize()} precision {scores['precision']:.2%}, "
+                f"recall {scores['recall']:.2%}, F1 {scores['f1']:.2%}"
+            )
+    return "\n".join(lines)
+
+
+def build_review_report_email(text_hash, recipient, export_format="Excel"):
+    """
+    Report email of a document. Runs in the email sender thread, so it reads the
+    document cache directly instead of the session.
+    """
+    data = get_document_cache().get(text_hash)
+    if data is None:
+        raise ValueError(f"Document {text_hash} not found.")
+    tagged_elements = data.get('tagged_elements') or []
+    file_name = get_export_file_name(data.get('filename')) or text_hash[:8]
+    stats = summarize_review_counts(get_review_counts(tagged_elements))
+    export = export_records(
+        iter_ner_tag_records(data.get('filename'), tagged_elements), NER_TAG_COLUMNS, "NER Tags", export_format
+    )
+    extension = EXPORT_FORMATS[export_format]['extension']
+    return OutgoingEmail(
+        recipients=[recipient],
+        subject=f"NER review report: {file_name}",
+        body=f"Review statistics of {file_name}\n\n{format_review_stats(stats)}\n",
+        attachments=[Attachment(filename=f"{file_name}_review.{extension}", data=export.getvalue())],
+    )
+
+
+def email_review_reports(text_hashes, export_format="Excel"):
+    """
+    Queue one review report per file to the logged-in user; the reports are built
+    and delivered in the background.
+    """
+    recipient = get_user_email()
+    if not recipient:
+        st.error("No email address is configured for your account.")
+        return []
+    email_sender = get_email_sender()
+    futures = [
+        email_sender.submit(build_review_report_email, h, recipient, export_format) for h in text_hashes
+    ]
+    st.toast(f"Queued {len(futures)} report email(s) to {recipient}.")
+    return futures
+
+
 @st.cache_data(max_entries=10)
 def get_judgment_stats(data, threshold):
     return get_llm_judgment_stats(data, threshold=threshold)
\ No newline at end of file
@@ -0,0 +1,71 @@
+import streamlit as st
+from ner_annotator.auth import is_admin
+from ner_annotator.profiling import PERCENTILES, get_render_profiler
+from ner_annotator.store import get_store
+
+
+def show_render_times():
+    profiler = get_render_profiler()
+    rows = profiler.report()
+    cols = st.columns([3, 1])
+    with cols[0]:
+        st.subheader("Page Render Times")
+        st.caption(
+            f"Rolling percentiles in seconds over the last {profiler.window} reruns of each page "
+            "and section, across all sessions of this server process."
+        )
+    with cols[1]:
+        if st.button("Reset", key="reset_render_times"):
+            profiler.reset()
+            st.rerun()
+    if not rows:
+        st.info("No page renders recorded yet.")
+        return
+    pages = sorted({row["page"] for row in rows})
+    selected_pages = st.multiselect("Pages", options=pages, default=pages)
+    st.dataframe(
+        [row for row in rows if row["page"] in selected_pages],
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            column: st.column_config.NumberColumn(column, format="%.3f")
+            for column in [f"p{q}" for q in PERCENTILES] + ["max"]
+        },
+    )
+
+
+def show_translation_reuse():
+    st.subheader("Translation Memory")
+    st.caption("Lines of the last tagging runs whose English translation was reused instead of requested.")
+    runs = get_store().list_translation_runs()
+    if not runs:
+        st.info("No tagging runs recorded yet.")
+        return
+    st.dataframe(
+        [
+            {
+                "document": run["doc_id"],
+                "lines": run["lines"],
+                "exact": run["exact"],
+                "fuzzy": run["fuzzy"],
+                "missed": run["missed"],
+                "reused": 100 * (run["exact"] + run["fuzzy"]) / max(run["lines"], 1),
+            }
+            for run in runs
+        ],
+        use_container_width=True,
+        hide_index=True,
+        column_config={"reused": st.column_config.NumberColumn("reused", format="%.1f%%")},
+    )
+
+
+def main():
+    st.title("🩺 Diagnostics")
+    if not is_admin():
+        st.error("This page is only available to admins.")
+        st.stop()
+    show_render_times()
+    show_translation_reuse()
+
+
+main()
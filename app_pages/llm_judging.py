@@ -1,6 +1,4 @@
-import time
 import streamlit as st
-import pandas as pd
 
 from app_pages.common import (
     download_all_llm_judgement_data,
@@ -8,14 +6,15 @@ from app_pages.common import (
     get_current_data, 
     add_entity_status,
     get_judgment_stats,
-    set_text_session_data
+    show_job_status,
+    submit_job,
 )
 
 
-from ner_annotator.llm_judge import run_evaluation
-from ner_annotator.utils import save_llm_judgement
+from ner_annotator.export import EXPORT_FORMATS
+from ner_annotator.profiling import section_timer
+from ner_annotator.utils import compact_review_journal
 from settings import SUPPORTED_LLM_JUDGE_MODELS
-from stqdm import stqdm
 
 
 def has_judgment_data():
@@ -75,31 +74,27 @@ def evaluate_models():
     #     st.balloons()
     #     return
     if st.button("Run LLM-As-A-Judge Evaluation"):
-        tagged_data = get_current_data()['tagged_elements']
         selected_models = st.session_state.get('selected_models')
-        sentence_chunk_size = st.session_state.get('sentence_chunk_size')
-        context_size = st.session_state.get('context_size')
-        with st.spinner("Evaluating..."):
-            if not selected_models:
-                st.warning("Please select at least one model to evaluate.")
-                return
-            st.session_state['evaluated_data'] = run_evaluation(
-                tagged_data, selected_models, 
-                sentence_chunk_size, context_size,
-                tqdm=stqdm
-            )
-            st.success("Evaluation completed!")
-            save_llm_judgement(get_current_data()['text'], st.session_state['evaluated_data'])
-            set_text_session_data(**{'llm_judgement': st.session_state['evaluated_data']})
-            st.balloons()
-            st.rerun()
+        if not selected_models:
+            st.warning("Please select at least one model to evaluate.")
+            return
+        # The job reads the lines from the store, so fold in the pending review edits first
+        compact_review_journal()
+        submit_job("judging", {
+            'models': selected_models,
+            'sentence_chunk_size': st.session_state.get('sentence_chunk_size'),
+            'context_size': st.session_state.get('context_size'),
+        })
+    show_job_status("judging")
 
 
 def show_results():
+    import pandas as pd
+
     st.subheader("Evaluation Results")
 
     threshold = st.session_state.get('judgment_threshold')
-    results = get_judgment_stats(st.session_state['evaluated_data'], threshold)
+    results = get_judgment_stats(get_current_data()['llm_judgement'], threshold)
     overall_acc = results['overall_accuracy']
     model_acc = results['model_accuracy']
     tag_acc = results['entity_type_accuracy']
@@ -136,10 +131,14 @@ def show_results():
 
 def download_data():
     def prepare_download(key):
-        st.session_state[key] = download_llm_judgement_data(st.session_state["current_hash"])
+        st.session_state[f"{key}_format"] = st.session_state["export_format"]
+        st.session_state[key] = download_llm_judgement_data(
+            st.session_state["current_hash"], st.session_state["export_format"]
+        )
 
     def prepare_download_all(key):
-        st.session_state[key] = download_all_llm_judgement_data()
+        st.session_state[f"{key}_format"] = st.session_state["export_format"]
+        st.session_state[key] = download_all_llm_judgement_data(st.session_state["export_format"])
         
     def unset_download_data(key):
         if key in st.session_state:
@@ -152,6 +151,13 @@ def download_data():
     st.markdown(
         "Click the button to generate the file. After the file is generated, you can download it."
     )
+    st.radio(
+        "Export format",
+        list(EXPORT_FORMATS),
+        horizontal=True,
+        key="export_format",
+        help="Excel is the most convenient to open; CSV and Parquet are much faster for many files.",
+    )
     cols = st.columns([6, 6])
     with cols[0]:
         st.markdown(
@@ -163,16 +169,17 @@ def download_data():
                 label="Generate LLM Judgment Data",
                 on_click=prepare_download,
                 kwargs={"key": judgment_data_key},
-                help="Click to build the Excel file before downloading"
+                help="Click to build the file before downloading"
             )
         else:
+            export_format = EXPORT_FORMATS[st.session_state[f"{judgment_data_key}_format"]]
             st.download_button(
                 label=":arrow_down: Download LLM Judgment Data",
                 data=st.session_state[judgment_data_key],
-                file_name="llm_judgment_data.xlsx",
-                mime="application/vnd.openxmlformats-officedocument-spreadsheetml.sheet",
+                file_name=f"llm_judgment_data.{export_format['extension']}",
+                mime=export_format['mime'],
                 key="download_llm_judgement",
-                help="Your Excel file is ready—click to save it locally!",
+                help="Your file is ready—click to save it locally!",
                 on_click=unset_download_data,
                 kwargs={"key": judgment_data_key},
             )
@@ -187,16 +194,17 @@ def download_data():
                 label="Generate Data for All Files",
                 on_click=prepare_download_all,
                 kwargs={"key": judgment_data_key_all},
-                help="Click to build the Excel file before downloading"
+                help="Click to build the file before downloading"
             )
         else:
+            export_format = EXPORT_FORMATS[st.session_state[f"{judgment_data_key_all}_format"]]
             st.download_button(
                 label=":arrow_down: Download All Judgment Data",
                 data=st.session_state[judgment_data_key_all],
-                file_name="all_judgment_data.xlsx",
-                mime="application/vnd.openxmlformats-officedocument-spreadsheetml.sheet",
+                file_name=f"all_judgment_data.{export_format['extension']}",
+                mime=export_format['mime'],
                 key="download_all_llm_judgement",
-                help="Your Excel file is ready—click to save it locally!",
+                help="Your file is ready—click to save it locally!",
                 on_click=unset_download_data,
                 kwargs={"key": judgment_data_key_all},
             )
@@ -204,7 +212,6 @@ def download_data():
 
 
 def main():
-    start_time = time.time()
     st.title("📝 Urdu NER LLM-As-A-Judge")
     st.markdown("""
     This page allows you to evaluate the performance of different LLMs on Urdu NER tasks.
@@ -214,9 +221,11 @@ def main():
     st.markdown("**Note:** You can select or deselect models to include in the comparison.")
     st.markdown("---")
     
-    if add_entity_status():
-        
-        set_judgment_configuration()
+    with section_timer("entity_status"):
+        has_entities = add_entity_status()
+    if has_entities:
+        with section_timer("configuration"):
+            set_judgment_configuration()
 
         if selected_models := st.session_state.get('selected_models'):
             st.markdown("**Selected Models**")
@@ -226,11 +235,13 @@ def main():
             st.markdown("---")
         
         if has_judgment_data():
-            show_results()
+            with section_timer("results"):
+                show_results()
             st.markdown("---")
-            download_data()
+            with section_timer("download"):
+                download_data()
         else:
-            evaluate_models()
-        print("Judgment page loaded in", time.time() - start_time, "seconds.")
+            with section_timer("evaluation"):
+                evaluate_models()
 
 main()
\ No newline at end of file
@@ -1,18 +1,32 @@
-import time
+import math
 import streamlit as st
 import re
 from app_pages.common import (
     download_all_ner_tags_data,
     download_ner_tags_data,
-    extract_entities, 
     get_current_data, 
     add_entity_status, 
+    apply_bulk_correction,
+    email_review_reports,
+    apply_line_model,
     get_current_text_hash,
     get_current_file_review_stats,
     get_all_files_review_stats,
+    get_line_model,
+    reindex_line,
+    undo_bulk_correction,
+    update_review_stats,
 )
 
-from ner_annotator.utils import save_file_data
+from ner_annotator.entities import get_line_entities, iter_entity_status, span_key
+from ner_annotator.export import EXPORT_FORMATS
+from ner_annotator.profiling import section_timer
+from ner_annotator.store import get_store
+from ner_annotator.utils import (
+    compact_review_journal,
+    record_review_action,
+    record_review_actions,
+)
 
 
 # Color map for entity types
@@ -29,6 +43,10 @@ TAG_COLORS = {
 # Entity tags
 TAGS = list(TAG_COLORS.keys())
 
+REVIEW_MODES = ["Single line", "Page of lines"]
+REVIEW_WINDOW_SIZE = 20
+BULK_PREVIEW_ROWS = 100
+
 st.markdown(
     """
     <style>
@@ -55,9 +73,8 @@ def get_current_line():
     return tagged_data[st.session_state.get("current_line") - 1]
 
 
-def set_current_line(line_number, content):
-    current_hash = get_current_text_hash()
-    st.session_state[current_hash]["tagged_elements"][line_number - 1]["tagged"] = content
+def get_current_line_model():
+    return get_line_model(st.session_state.get("current_line") - 1)
 
 
 def get_current_entities_status():
@@ -67,60 +84,69 @@ def get_current_entities_status():
 def set_current_entities_status(entities_status):
     current_line = get_current_line()
     current_line["entity_status"] = entities_status
-    current_hash = get_current_text_hash()
-    
-    st.session_state[current_hash]["tagged_elements"][
+    get_current_data()["tagged_elements"][
         st.session_state.get("current_line") - 1
     ] = current_line
 
 
-def set_new_entity_tag_current_entities_status(entity, new_tag):
+def set_new_entity_tag_current_entities_status(key, new_tag, entity=None, start=None, end=None):
     current_entities_status = get_current_entities_status()
-    if entity in current_entities_status:
-        current_entities_status[entity].update(
+    if key in current_entities_status:
+        current_entities_status[key].update(
             {
                 "user_updated": new_tag,
             }
         )
         set_current_entities_status(current_entities_status)
     else:
-        current_entities_status[entity] = {
+        current_entities_status[key] = {
             "entity": entity,
             "tag": None,
             "user_updated": new_tag,
+            "start": start,
+            "end": end,
         }
 
 
 def render_tagged_text():
-    display_text: str = get_current_line()["tagged"]
-    entities = extract_entities(display_text)
-    for tag, text in entities:
-        color = TAG_COLORS.get(tag.upper(), "#E5E7E9")  # Default light grey
-        replacement = f'<span style="background-color: {color}; padding: 2px;" title="{tag}">{text}</span>'
-        display_text = display_text.replace(f"<{tag}>{text}</{tag}>", replacement)
-    st.markdown(display_text, unsafe_allow_html=True)
-
-
-def set_new_tag(entity, old_tag, new_tag):
-    tagged_text: str = get_current_line()["tagged"]
-    pattern = f"<{old_tag}>{entity}</{old_tag}>" if old_tag else entity
-    replacement = f"<{new_tag}>{entity}</{new_tag}>"
-    set_current_line(
-        st.session_state["current_line"], tagged_text.replace(pattern, replacement)
-    )
-    set_new_entity_tag_current_entities_status(entity, new_tag)
-    save_tags()
+    # Unknown tags fall back to light grey
+    st.markdown(get_current_line_model().html(TAG_COLORS), unsafe_allow_html=True)
+
+
+def set_new_tag(entity, old_tag, new_tag, key=None):
+    """
+    Retag the entity at status ``key`` of the current line, or tag the first untagged
+    occurrence of ``entity`` if no key is given.
+    """
+    line_model = get_current_line_model()
+    if key is not None:
+        status = get_current_entities_status()[key]
+        line_model.retag(status["start"], new_tag)
+        # Offer to apply the same correction to the rest of the corpus
+        st.session_state["bulk_entity"] = entity
+        st.session_state["bulk_tag"] = old_tag
+        st.session_state["bulk_new_tag"] = new_tag
+        start, end = status["start"], status["end"]
+    else:
+        start = line_model.find_untagged(entity)
+        if start is None:
+            st.error(f"'{entity}' is not an untagged part of this line.")
+            return
+        end = start + len(entity)
+        line_model.add(start, end, new_tag)
+        key = span_key(start, end)
+    apply_line_model(st.session_state["current_line"] - 1)
+    set_new_entity_tag_current_entities_status(key, new_tag, entity, start, end)
+    save_tags(action="set_new_tag")
     st.success(f"Tagged '{entity}' as {new_tag}")
     st.rerun()
 
 
 def save_all_data():
-    data = get_current_data()
-    text = data["text"]
-    save_file_data(text, data)
+    compact_review_journal()
 
 
-def save_tags():
+def save_tags(action="verification"):
     current_entity_status = get_current_entities_status()
     current_entity_status.update(
         {
@@ -128,32 +154,32 @@ def save_tags():
         }
     )
     set_current_entities_status(current_entity_status)
+    reindex_line(st.session_state["current_line"] - 1)
+    update_review_stats(st.session_state["current_line"] - 1)
+    record_review_action(
+        get_current_text_hash(),
+        st.session_state["current_line"] - 1,
+        get_current_line(),
+        action,
+    )
     print("Tags at line: ", st.session_state["current_line"], "saved successfully.")
     print("Current Entity Status: ", current_entity_status)
     print("Tagged elements: ", get_current_data()['tagged_elements'][st.session_state["current_line"] - 1])
 
 
-def remove_newly_added_tag(entity):
+def remove_newly_added_tag(key):
     current_entities_status = get_current_entities_status()
-    if entity in current_entities_status:
-        tag = current_entities_status[entity]["user_updated"]
-        del current_entities_status[entity]
-        tagged_text = get_current_line()["tagged"]
-        pattern = f"<{tag}>{entity}</{tag}>"
-        replacement = entity
-        print("Ts", tagged_text)
-        print("tag", tag)
-        set_current_line(
-            st.session_state["current_line"], 
-            tagged_text.replace(pattern, replacement)
-        )
+    if key in current_entities_status:
+        status = current_entities_status.pop(key)
+        get_current_line_model().remove(status["start"])
+        apply_line_model(st.session_state["current_line"] - 1)
         set_current_entities_status(current_entities_status)
         
-        save_tags()
+        save_tags(action="remove_newly_added_tag")
         st.rerun()
         # st.success(f"Removed tag for '{entity}'")
     else:
-        st.error(f"No tag found for '{entity}'")
+        st.error(f"No tag found at {key}")
     
 
 def manual_tagging():
@@ -171,7 +197,7 @@ def manual_tagging():
     if st.button("Add Tag"):
         if st.session_state["manual_tagging_words"]:
             selected_text = " ".join(st.session_state["manual_tagging_words"])
-            entities = extract_entities(get_current_line()["tagged"])
+            entities = get_line_entities(get_current_line())
             if any(selected_text in entity for _, entity in entities):
                 st.warning("This phrase is already tagged.")
             elif selected_text in get_current_line()["original"]:
@@ -186,7 +212,7 @@ def manual_tagging():
 def tags_review():
     # Review tagged entities
     current_entity_status = get_current_entities_status()
-    entities = [e for e in current_entity_status if e != 'user_verified']
+    entities = iter_entity_status(current_entity_status)
     cols = st.columns([6, 1])
     with cols[0]:
         st.subheader("Review Existing Tags")
@@ -196,15 +222,15 @@ def tags_review():
     if not entities:
         st.write("No tagged entities found in this line.")
         return
-    for i, entity in enumerate(entities):
+    for i, (key, status) in enumerate(entities):
         correct = None
-        tag = current_entity_status[entity]["tag"]
+        entity = status["entity"]
+        tag = status["tag"]
         col1, col2, col3 = st.columns([3, 2, 3])
         with col1:
             st.write(f"**{entity}**")
         with col2:
-            if current_entity_status[entity]["tag"] is not None:
-                tag = current_entity_status[entity]["tag"]
+            if tag is not None:
                 correct = st.radio(
                     f"Is '{entity}' correctly tagged as {tag}?",
                     ["Yes", "No"],
@@ -213,8 +239,8 @@ def tags_review():
             else:
                 ### Show Option to delete the tag
                 st.markdown('<div class="delete-btn-container">', unsafe_allow_html=True)
-                if st.button("🗑️", key=f"clear_{entity}"):
-                    remove_newly_added_tag(entity)
+                if st.button("🗑️", key=f"clear_{key}"):
+                    remove_newly_added_tag(key)
                 st.markdown('</div>', unsafe_allow_html=True)
                 
         with col3:
@@ -223,18 +249,170 @@ def tags_review():
                     f"Correct tag for '{entity}'", TAGS, key=f"newtag_{i}"
                 )
                 if st.button("Update Tag", key=f"btn_update_{i}"):
-                    set_new_tag(entity, tag, new_tag)
+                    set_new_tag(entity, tag, new_tag, key=key)
+
+
+def get_reviewable_entities(line):
+    return iter_entity_status(line.get("entity_status", {}))
+
+
+def window_widget_key(line_no, name):
+    return f"window_{get_current_text_hash()[:8]}_{line_no}_{name}"
+
+
+def save_window(line_numbers):
+    """
+    Apply the decisions of a page of lines and journal them in a single write.
+    Only lines whose tag or "Reviewed" tick changed are saved; retags on lines
+    that are not ticked are applied without marking the line as verified.
+    """
+    tagged_elements = get_current_data()["tagged_elements"]
+    items = list()
+    for line_no in line_numbers:
+        line = tagged_elements[line_no]
+        entity_status = line["entity_status"]
+        verified = bool(entity_status.get("user_verified", False))
+        reviewed = bool(st.session_state.pop(window_widget_key(line_no, "reviewed"), verified))
+        line_model = get_line_model(line_no)
+        retagged = False
+        for i, (_, status) in enumerate(get_reviewable_entities(line)):
+            selected = st.session_state.pop(window_widget_key(line_no, i), None)
+            current_tag = status["user_updated"] or status["tag"]
+            if status["tag"] is None or selected is None or selected == current_tag:
+                continue
+            line_model.retag(status["start"], selected)
+            status["user_updated"] = None if selected == status["tag"] else selected
+            retagged = True
+        if not retagged and reviewed == verified:
+            continue
+        if retagged:
+            apply_line_model(line_no)
+        entity_status["user_verified"] = reviewed
+        reindex_line(line_no)
+        update_review_stats(line_no)
+        items.append((line_no, "window_review", line))
+    if items:
+        record_review_actions(get_current_text_hash(), items)
+
+
+def review_window():
+    """
+    Review a page of lines in one form, so decisions cost no reruns until the page is saved.
+    """
+    tagged_elements = get_current_data()["tagged_elements"]
+    page_size = st.number_input(
+        "Lines per page", min_value=5, max_value=100, value=REVIEW_WINDOW_SIZE, step=5,
+        key="review_window_size",
+    )
+    max_pages = math.ceil(len(tagged_elements) / page_size)
+    page = st.number_input(
+        f"Select Page / {max_pages}", min_value=1, max_value=max_pages, value=1,
+        key="review_window_page",
+    )
+    line_numbers = list(range((page - 1) * page_size, min(page * page_size, len(tagged_elements))))
+
+    with st.form("review_window_form"):
+        for line_no in line_numbers:
+            line = tagged_elements[line_no]
+            verified = line["entity_status"].get("user_verified", False)
+            st.markdown(f"**Line {line_no + 1}**{' ✅' if verified else ''}")
+            st.markdown(get_line_model(line_no).html(TAG_COLORS), unsafe_allow_html=True)
+            entities = get_reviewable_entities(line)
+            if entities:
+                cols = st.columns(min(len(entities), 4))
+                for i, (_, status) in enumerate(entities):
+                    entity = status["entity"]
+                    with cols[i % len(cols)]:
+                        if status["tag"] is None:
+                            st.caption(f"{entity}: {status['user_updated']} (added)")
+                            continue
+                        current_tag = status["user_updated"] or status["tag"]
+                        options = TAGS if current_tag in TAGS else [current_tag] + TAGS
+                        st.selectbox(
+                            entity, options, index=options.index(current_tag),
+                            key=window_widget_key(line_no, i),
+                        )
+            # Only lines the annotator ticks are marked as verified
+            st.checkbox("Reviewed", value=verified, key=window_widget_key(line_no, "reviewed"))
+            st.markdown("---")
+        st.form_submit_button("Save Page", on_click=save_window, args=(line_numbers,))
+
+
+def bulk_corrections():
+    """
+    Apply a correction to every unreviewed occurrence of an entity in all files, with preview and undo.
+    """
+    with st.expander("Apply a Correction Across All Files", expanded="bulk_entity" in st.session_state):
+        st.markdown(
+            "Retag every occurrence of an entity that still has the given LLM tag, "
+            "in all files, on lines that have not been reviewed yet."
+        )
+        entity = st.text_input("Entity", key="bulk_entity")
+        cols = st.columns(2)
+        with cols[0]:
+            tag = st.selectbox("LLM tag", TAGS, key="bulk_tag")
+        with cols[1]:
+            new_tag = st.selectbox("Correct tag", TAGS, key="bulk_new_tag")
+
+        if entity and tag != new_tag:
+            occurrences = get_store().find_unreviewed_occurrences(entity, tag)
+            st.markdown(f"**{len(occurrences)}** unreviewed occurrences in "
+                        f"**{len({o['doc_id'] for o in occurrences})}** files.")
+            if occurrences:
+                st.dataframe(
+                    [
+                        {"File": o["filename"], "Line": o["line_no"] + 1, "Text": o["original"]}
+                        for o in occurrences[:BULK_PREVIEW_ROWS]
+                    ],
+                    use_container_width=True, hide_index=True,
+                )
+                if st.button(f"Retag {len(occurrences)} occurrences as {new_tag}", key="apply_bulk"):
+                    _, changed = apply_bulk_correction(entity, tag, new_tag)
+                    st.success(f"Retagged {len(changed)} occurrences of '{entity}' as {new_tag}.")
+                    st.rerun()
+
+        if "bulk_undo_result" in st.session_state:
+            reverted, skipped = st.session_state.pop("bulk_undo_result")
+            st.success(f"Reverted {reverted} occurrences.")
+            if skipped:
+                st.warning(f"Kept {len(skipped)} occurrences on lines reviewed after the correction.")
+                st.dataframe(
+                    [{"file": doc_id[:8], "line": line_no + 1} for doc_id, line_no in skipped[:BULK_PREVIEW_ROWS]],
+                    hide_index=True,
+                )
+        recent = [b for b in get_store().list_bulk_corrections() if b["undone_at"] is None]
+        if recent:
+            st.markdown("**Recent corrections**")
+        for batch in recent:
+            col1, col2 = st.columns([5, 1])
+            with col1:
+                st.write(
+                    f"'{batch['entity']}': {batch['tag']} → {batch['new_tag']} "
+                    f"({batch['occurrences']} occurrences)"
+                )
+            with col2:
+                if st.button("Undo", key=f"undo_bulk_{batch['batch_id']}"):
+                    reverted, skipped = undo_bulk_correction(batch["batch_id"])
+                    st.session_state["bulk_undo_result"] = (len(reverted), skipped)
+                    st.rerun()
+
+
+def send_stats_email(stats_id):
+    if stats_id == 'current_file_stats':
+        text_hashes = [get_current_text_hash()]
+    else:
+        text_hashes = st.session_state.get('all_hashes', [])
+    email_review_reports(text_hashes, st.session_state.get("export_format", "Excel"))
 
 
 def show_file_statistics():
-    start_time = time.time()
     def show_stats(stats, stats_id):
         # ── Header with “Send Email” button ───────────────────────────────
         header_col, _, btn_col = st.columns([4, 1, 1])
         with header_col:
             st.subheader("📊 File Statistics")
         with btn_col:
-            st.button("✉️ Send Email", key=stats_id)
+            st.button("✉️ Send Email", key=stats_id, on_click=send_stats_email, args=(stats_id,))
         st.markdown("---")
 
         # And precision + recall in a second row
@@ -262,14 +440,12 @@ def show_file_statistics():
         st.markdown(
             "This table shows the classification scores for each entity type. You can sort and filter the table to find specific entity types."
         )
-        if stats['df_per_type']:
+        if stats['df_per_type'] is not None:
             st.dataframe(stats['df_per_type'].style.format({
-                'Precision': '{:.2%}',
-                'Recall':    '{:.2%}',
-                'F1-Score':  '{:.2%}',
+                'precision': '{:.2%}',
+                'recall':    '{:.2%}',
+                'f1-score':  '{:.2%}',
             }))
-        
-        print(f"Statistics calculated in {time.time() - start_time:.2f} seconds.")
 
     with st.expander("Current File Statistics", expanded=False):
         st.markdown(
@@ -289,10 +465,14 @@ def show_file_statistics():
 
 def download_data():
     def prepare_download(key):
-        st.session_state[key] = download_ner_tags_data(st.session_state["current_hash"])
+        st.session_state[f"{key}_format"] = st.session_state["export_format"]
+        st.session_state[key] = download_ner_tags_data(
+            st.session_state["current_hash"], st.session_state["export_format"]
+        )
 
     def prepare_download_all(key):
-        st.session_state[key] = download_all_ner_tags_data()
+        st.session_state[f"{key}_format"] = st.session_state["export_format"]
+        st.session_state[key] = download_all_ner_tags_data(st.session_state["export_format"])
         
     def unset_download_data(key):
         if key in st.session_state:
@@ -305,6 +485,13 @@ def download_data():
     st.markdown(
         "Click the button to generate the file. After the file is generated, you can download it."
     )
+    st.radio(
+        "Export format",
+        list(EXPORT_FORMATS),
+        horizontal=True,
+        key="export_format",
+        help="Excel is the most convenient to open; CSV and Parquet are much faster for many files.",
+    )
     cols = st.columns([6, 6])
     with cols[0]:
         st.markdown(
@@ -316,16 +503,17 @@ def download_data():
                 label="Generate Review Data",
                 on_click=prepare_download,
                 kwargs={"key": ner_data_key},
-                help="Click to build the Excel file before downloading"
+                help="Click to build the file before downloading"
             )
         else:
+            export_format = EXPORT_FORMATS[st.session_state[f"{ner_data_key}_format"]]
             st.download_button(
                 label=":arrow_down: Download Review Data",
                 data=st.session_state[ner_data_key],
-                file_name=f"{st.session_state['selected_model_id']}_ner_tagged_data.xlsx",
-                mime="application/vnd.openxmlformats-officedocument-spreadsheetml.sheet",
+                file_name=f"{st.session_state['selected_model_id']}_ner_tagged_data.{export_format['extension']}",
+                mime=export_format['mime'],
                 key="download_llm_judgement",
-                help="Your Excel file is ready—click to save it locally!",
+                help="Your file is ready—click to save it locally!",
                 on_click=unset_download_data,
                 kwargs={"key": ner_data_key},
             )
@@ -340,16 +528,17 @@ def download_data():
                 label="Generate Review Data for All Files",
                 on_click=prepare_download_all,
                 kwargs={"key": ner_data_all_key},
-                help="Click to build the Excel file before downloading"
+                help="Click to build the file before downloading"
             )
         else:
+            export_format = EXPORT_FORMATS[st.session_state[f"{ner_data_all_key}_format"]]
             st.download_button(
                 label=":arrow_down: Download All Review Data",
                 data=st.session_state[ner_data_all_key],
-                file_name=f"{st.session_state['selected_model_id']}_all_ner_tagged_data.xlsx",
-                mime="application/vnd.openxmlformats-officedocument-spreadsheetml.sheet",
+                file_name=f"{st.session_state['selected_model_id']}_all_ner_tagged_data.{export_format['extension']}",
+                mime=export_format['mime'],
                 key="download_all_llm_judgement",
-                help="Your Excel file is ready—click to save it locally!",
+                help="Your file is ready—click to save it locally!",
                 on_click=unset_download_data,
                 kwargs={"key": ner_data_all_key},
             )
@@ -357,7 +546,6 @@ def download_data():
 
 # Initialize session state
 def main():
-    start_time = time.time()
     st.title("📜 LLM-based NER Manual Review")
     st.markdown(
         """
@@ -368,42 +556,55 @@ def main():
         You can also review the statistics of the file.
         """
     )
-    if add_entity_status():
-        st.subheader("Named Entity Categories")
-        legend_html = ""
-        for tag, color in TAG_COLORS.items():
-            legend_html += f'<span style="background-color: {color}; padding: 4px; margin:4px; border-radius:4px;">{tag}</span> '
-        st.markdown(legend_html, unsafe_allow_html=True)
-        st.markdown("---")
-        max_lines = len(get_current_data()["tagged_elements"])
-        st.number_input(
-            f"Select Line Number / {max_lines}",
-            min_value=1,
-            max_value=max_lines,
-            value=1,
-            key="current_line",
-        )
-        cols = st.columns([1, 2, 1])
-        with cols[0]:
-            st.subheader("Original Text")
-        with cols[-1]:
-            st.button("Save Annotations", key="save_changes", on_click=save_all_data)
-        st.write(get_current_line()["original"])
-
-        st.subheader("English Translation")
-        st.write(get_current_line()["english"])
-
-        # Display tagged text
-        st.subheader("Tagged Text")
-        render_tagged_text()
+    with section_timer("entity_status"):
+        has_entities = add_entity_status()
+    if has_entities:
+        with section_timer("legend"):
+            st.subheader("Named Entity Categories")
+            legend_html = ""
+            for tag, color in TAG_COLORS.items():
+                legend_html += f'<span style="background-color: {color}; padding: 4px; margin:4px; border-radius:4px;">{tag}</span> '
+            st.markdown(legend_html, unsafe_allow_html=True)
+            st.markdown("---")
+        review_mode = st.radio("Review Mode", REVIEW_MODES, horizontal=True, key="review_mode")
+        if review_mode == "Page of lines":
+            with section_timer("review_window"):
+                review_window()
+        else:
+            with section_timer("line"):
+                max_lines = len(get_current_data()["tagged_elements"])
+                st.number_input(
+                    f"Select Line Number / {max_lines}",
+                    min_value=1,
+                    max_value=max_lines,
+                    value=1,
+                    key="current_line",
+                )
+                cols = st.columns([1, 2, 1])
+                with cols[0]:
+                    st.subheader("Original Text")
+                with cols[-1]:
+                    st.button("Save Annotations", key="save_changes", on_click=save_all_data)
+                st.write(get_current_line()["original"])
+
+                st.subheader("English Translation")
+                st.write(get_current_line()["english"])
+
+                # Display tagged text
+                st.subheader("Tagged Text")
+                render_tagged_text()
+                st.markdown("---")
+            with section_timer("tags_review"):
+                tags_review()
+                manual_tagging()
         st.markdown("---")
-        tags_review()
-        manual_tagging()
+        with section_timer("bulk_corrections"):
+            bulk_corrections()
         st.markdown("---")
-        show_file_statistics()
+        with section_timer("statistics"):
+            show_file_statistics()
         st.markdown("---")
-        download_data()
-        print("NER Review page loaded in", time.time() - start_time, "seconds.")
-
+        with section_timer("download"):
+            download_data()
 
 main()
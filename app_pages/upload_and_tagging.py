@@ -1,18 +1,23 @@
 import streamlit as st
 from app_pages.common import (
+    get_corpus_index,
+    get_search_index,
     init_session_state, 
-    set_text_session_data
+    set_text_session_data,
+    show_job_status,
+    submit_job,
 )
 from ner_annotator.utils import (
-    get_all_files,
     get_llm_configs,
-    save_ner_tags,
     save_text_with_hash,
 )
-from ner_annotator.constants import DATASET_DIR
-from ner_annotator.llm_tagger import get_ner_tags
-from stqdm import stqdm
-import time
+from ner_annotator.corpus_pack import get_corpus_pack
+from ner_annotator.documents import get_document_cache
+from ner_annotator.identity import document_id
+from ner_annotator.profiling import section_timer
+from ner_annotator.store import get_store
+
+MAX_SEARCH_RESULTS = 200
 
 text_states = {
     1: "File received. Please wait until the contents show in the text box. Loading...",
@@ -21,31 +26,29 @@ text_states = {
 }
 
 
-def set_tagged_result(text, ner_tags):
-    set_text_session_data(**save_ner_tags(text, ner_tags))
-    st.success("NER tagging completed. Now you can move to reviewing the results.")
-
-
-def start_ner_tagging(text):
-    if text:
-        model_id = st.session_state.get("selected_model_id")
-        chunk_size = st.session_state.get("chunk_size")
-        with st.spinner("LLM-based NER Tagging...Will take a while for large texts."):
-            show_message(message="Tagging in progress...")
-            ner_tags = get_ner_tags(
-                text, model_id=model_id, chunk_size=chunk_size, tqdm=stqdm
-            )
-        print("Total NER Tags:", len(ner_tags))
-        set_tagged_result(text, ner_tags)
+def start_ner_tagging(text_hash):
+    if text_hash:
+        submit_job(
+            "tagging",
+            {
+                "model_id": st.session_state.get("selected_model_id"),
+                "chunk_size": st.session_state.get("chunk_size"),
+            },
+            text_hash=text_hash,
+        )
+        show_message(
+            message="Tagging started in the background. You can leave this page; "
+            "the results are saved when the job finishes."
+        )
 
 
-def add_text_if_not_exists(text):
+def add_text_if_not_exists(text_hash, text, filename=None):
     """
     Process the text for NER tagging.
     This function should be replaced with the actual NER processing logic.
     """
 
-    data = save_text_with_hash(text)
+    data = save_text_with_hash(text_hash, text, filename)
     set_text_session_data(**data)
     
     if "tagged" in data and data["tagged"]:
@@ -81,17 +84,34 @@ def select_ner_config():
         )
 
 
-def initiate_ner_tagging(text):
+def initiate_ner_tagging(text, filename):
     if not text:
         st.warning("Please provide some text first.")
         return
     print("Starting NER tagging on...")
     print(text[:50])
     print("Total length:", len(text))
-    # set_current_hash(text)
+    # The session must be keyed by the text that is actually tagged and stored
+    text_hash = document_id(text)
+    if st.session_state.get("current_hash") != text_hash:
+        init_session_state(text, text_hash, filename)
     
-    if add_text_if_not_exists(text):
-        start_ner_tagging(text)
+    if add_text_if_not_exists(text_hash, text, filename):
+        start_ner_tagging(text_hash)
+
+
+def open_packed_document(name):
+    """
+    Open a tagged corpus file straight from the corpus pack, without hashing or storing its text.
+    """
+    pack = get_corpus_pack()
+    doc_id = pack.doc_id_for_name(name) if pack is not None else None
+    data = get_document_cache().get(doc_id) if doc_id else None
+    if data is None:
+        st.error(f"'{name}' is not in the corpus pack.")
+        return
+    init_session_state(data["text"], doc_id, name)
+    st.success("Tags already exists. You can now proceed to reviewing tags.")
 
 
 def show_message(message, message_type="info"):
@@ -110,16 +130,15 @@ def show_message(message, message_type="info"):
 def set_current_hash(key, filename):
     text = st.session_state.get(key)
     if text:
-        text_hash = hash(text)
+        text_hash = document_id(text)
         init_session_state(text, text_hash, filename)
 
 
 def main():
-    start_time = time.time()
     st.title("📜 LLM-based Marsiya Named Entity Tagging")
 
-    select_ner_config()
-    print("Configurations loaded in", time.time() - start_time, "seconds.")
+    with section_timer("configuration"):
+        select_ner_config()
     st.markdown("### Choose your input method:")
 
     # Tabs for three options
@@ -144,7 +163,9 @@ def main():
             if st.session_state.get("uploaded_file_text"):
                 show_message(message=text_states[2], message_type="success")
                 if st.button("🖋️ Tag this file", key="tag_file"):
-                    initiate_ner_tagging(st.session_state["uploaded_file_text"])
+                    initiate_ner_tagging(
+                        st.session_state["uploaded_file_text"], uploaded_file.name
+                    )
             else:
                 show_message(message=text_states[1])
 
@@ -159,29 +180,38 @@ def main():
         if pasted_text:
             show_message(message=text_states[3], message_type="success")
             if st.button("🖋️ Tag this file", key="tag_pasted_text"):
-                initiate_ner_tagging(pasted_text)
+                initiate_ner_tagging(pasted_text, "Pasted Text")
 
     with tab3:
         st.markdown("Search from existing marsiyas:")
         tagged_filter = st.toggle("🔖 Show only tagged files", value=False)
-        all_marsiya_files: dict = st.session_state.get(
-            "all_marsiya_files", get_all_files(f"{DATASET_DIR}")
-        )
+        corpus_index = get_corpus_index()
         # Filter based on 'tagged' flag
-        filtered_files = [
-            name
-            for name, meta in all_marsiya_files.items()
-            if tagged_filter and meta["tagged"] or not tagged_filter
-        ]
+        filtered_files = corpus_index.names(tagged_only=tagged_filter)
+
+        search_query = st.text_input(
+            "🔎 Search all marsiyas for a name or phrase", key="corpus_search_query"
+        )
+        if search_query:
+            with section_timer("search"):
+                search_results = get_search_index().search_lines(
+                    search_query, get_store(), limit=MAX_SEARCH_RESULTS
+                )
+            st.caption(f"{len(search_results)} matching lines (showing at most {MAX_SEARCH_RESULTS}).")
+            if search_results:
+                st.dataframe(search_results, use_container_width=True, hide_index=True)
+                matching_files = {r["File"] for r in search_results}
+                filtered_files = [name for name in filtered_files if name in matching_files]
 
         selected_file = st.selectbox("Select a marsiya", options=filtered_files)
 
         if selected_file:
             # In a real app, this would load content from a file or DB
             st.info(
-                f"Selected Marsiya: {selected_file} {'(Tagged)' if all_marsiya_files[selected_file]['tagged'] else ''}"
+                f"Selected Marsiya: {selected_file} {'(Tagged)' if corpus_index[selected_file]['tagged'] else ''}"
             )
-            content = f"{selected_file}\nContent: {all_marsiya_files[selected_file]['content']}"
+            file_content = corpus_index.read(selected_file)
+            content = f"{selected_file}\nContent: {file_content}"
             st.text_area(
                 "Marsiya Content", 
                 value=content, 
@@ -190,9 +220,14 @@ def main():
                 key="existing_file_text", 
                 kwargs={"key": "existing_file_text", "filename": selected_file}
             )
-            if st.button("🖋️ Tag this file", key="tag_existing_file"):
-                initiate_ner_tagging(all_marsiya_files[selected_file]['content'])
-
-    print("File upload and tagging completed in", time.time() - start_time, "seconds.")
+            pack = get_corpus_pack()
+            if pack is not None and pack.doc_id_for_name(selected_file):
+                if st.button("📖 Open for review", key="open_packed_file"):
+                    open_packed_document(selected_file)
+            elif st.button("🖋️ Tag this file", key="tag_existing_file"):
+                initiate_ner_tagging(file_content, selected_file)
+
+    if show_job_status("tagging") is not None:
+        st.markdown("Once tagging is done, move to reviewing the results.")
     
 main()
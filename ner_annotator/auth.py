@@ -1,3 +1,7 @@
+import copy
+import os
+import threading
+
 import streamlit_authenticator as stauth
 from streamlit_authenticator.utilities.exceptions import LoginError
 import yaml
@@ -5,9 +9,28 @@ from yaml.loader import SafeLoader
 import streamlit as st
 
 
+# auth_file -> (mtime_ns, parsed config)
+_auth_configs = dict()
+_auth_configs_lock = threading.Lock()
+
+
+def load_auth_config(auth_file):
+    """
+    Parsed auth config, re-read only when the file changes. Every caller gets its
+    own copy because the authenticator updates the credentials in place.
+    """
+    mtime_ns = os.stat(auth_file).st_mtime_ns
+    with _auth_configs_lock:
+        cached = _auth_configs.get(auth_file)
+        if cached is None or cached[0] != mtime_ns:
+            with open(auth_file) as file:
+                cached = (mtime_ns, yaml.load(file, Loader=SafeLoader))
+            _auth_configs[auth_file] = cached
+    return copy.deepcopy(cached[1])
+
+
 def add_authentication(auth_file):
-    with open(auth_file) as file:
-        config = yaml.load(file, Loader=SafeLoader)
+    config = load_auth_config(auth_file)
     
     st.session_state['credentials_config'] = config
 
@@ -21,6 +44,10 @@ def add_authentication(auth_file):
     return authenticator, config
 
 
+def is_admin() -> bool:
+    return bool(st.session_state.get('authentication_status')) and "admin" in (st.session_state.get('roles') or [])
+
+
 def authenticate(auth_file):
     try:
         authenticator, auth_config = add_authentication(auth_file)
@@ -37,7 +64,7 @@ def authenticate(auth_file):
         if st.session_state['authentication_status']:
             name = st.session_state['name']
             st.sidebar.title(f'Welcome {name}!')
-            if "admin" in st.session_state['roles']:
+            if is_admin():
                 st.sidebar.title("Admin Panel")
                 st.sidebar.write("You have admin access.")
         else:
@@ -1,6 +1,45 @@
+import os
+
 URDU_LETTERS_THRESHOLD = 0.7
 CHUNK_SIZE = 40
 MAX_CONCURRENT_REQUESTS = 5
-UPLOAD_DIR = "uploads"
+UPLOAD_DIR_ENV = "NER_UPLOAD_DIR"
+# The store, journal and indexes all live here; the load test points it at a scratch directory
+UPLOAD_DIR = os.getenv(UPLOAD_DIR_ENV, "uploads")
 DATASET_DIR = "dataset/marsiya-all"
-RESULTS_DIR = "results"
\ No newline at end of file
+RESULTS_DIR = "results"
+ANNOTATIONS_DB = f"{UPLOAD_DIR}/annotations.db"
+JOURNAL_DIR = f"{UPLOAD_DIR}/journal"
+JOURNAL_FSYNC_INTERVAL = 0.5
+JOURNAL_FSYNC_BATCH = 32
+JOURNAL_COMPACT_INTERVAL = 30
+SEARCH_INDEX_PATH = f"{UPLOAD_DIR}/search_index.bin"
+DOCUMENT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DOCUMENT_CACHE_MAX_DOCUMENTS = 256
+JOB_MAX_WORKERS = 2
+JOB_POLL_INTERVAL = 1.0
+JOB_PROGRESS_INTERVAL = 0.5
+JOB_CANCEL_GRACE = 10
+EMAIL_COMPRESS_THRESHOLD = 256 * 1024
+EMAIL_MAX_RETRIES = 3
+EMAIL_RETRY_BACKOFF = 2.0
+EMAIL_POOL_SIZE = 1
+EMAIL_IDLE_TIMEOUT = 60
+RENDER_SAMPLE_WINDOW = 500
+CORPUS_PACK_PATH = f"{UPLOAD_DIR}/corpus.pack"
+FEW_SHOT_COLLECTION = "verified_lines"
+FEW_SHOT_EMBEDDING_DIM = 512
+FEW_SHOT_CANDIDATES = 4
+FEW_SHOT_MAX_EXAMPLES = 12
+PROMPT_TOKEN_BUDGET = 3000
+NEAR_DUPLICATE_INDEX_PATH = f"{UPLOAD_DIR}/near_duplicates.bin"
+NEAR_DUPLICATE_PERMUTATIONS = 64
+NEAR_DUPLICATE_BANDS = 16
+NEAR_DUPLICATE_THRESHOLD = 0.7
+NEAR_DUPLICATE_MIN_TOKENS = 3
+TRANSLATION_MEMORY_FUZZY_THRESHOLD = 0.85
+TRANSLATION_MEMORY_INDEX_PATH = f"{UPLOAD_DIR}/translation_memory.bin"
+PIPELINE_MAX_WORKERS = 0
+PIPELINE_MIN_DOCUMENTS = 16
+PIPELINE_SHARDS_PER_WORKER = 4
+PIPELINE_SHARED_WORKERS = 2
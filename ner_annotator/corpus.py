@@ -0,0 +1,142 @@
+"""
+Compact index over the Marsiya corpus.
+
+The index only keeps name, path, size, modification time and content hash for
+every file and is persisted next to the dataset, so listing the corpus does not
+read any file contents. Contents are read on demand.
+"""
+import json
+import os
+import threading
+
+from ner_annotator.store import AnnotationStore
+
+
+CORPUS_FILE_SUFFIX = ".pdf.json.txt"
+CORPUS_INDEX_FILE = "index.json"
+
+
+def read_corpus_text(file_path: str) -> str:
+    """
+    Read a corpus file, normalising newlines like ``open(..., "r")``.
+    """
+    with open(file_path, "rb") as f:
+        text = f.read().decode("utf-8")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def get_corpus_file_name(file: str) -> str:
+    return file.replace('-', ' ').replace(CORPUS_FILE_SUFFIX, '')
+
+
+class CorpusIndex:
+    def __init__(self, dataset_dir: str, entries: dict):
+        self.dataset_dir = dataset_dir
+        self.entries = entries
+        self._by_hash = {e["content_hash"]: name for name, e in entries.items()}
+        # Document status version of the store the tagged flags were read at
+        self.status_version = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, name: str) -> dict:
+        return self.entries[name]
+
+    def names(self, tagged_only: bool = False) -> list:
+        return [
+            name for name, entry in self.entries.items()
+            if entry["tagged"] or not tagged_only
+        ]
+
+    def name_for_hash(self, content_hash: str):
+        return self._by_hash.get(content_hash)
+
+    def read(self, name: str) -> str:
+        return read_corpus_text(self.entries[name]["path"])
+
+    def refresh_tagged(self, store: AnnotationStore):
+        """
+        Update the tagged flags from the annotation store with a single query,
+        if any document status changed since the last refresh.
+        """
+        with self._lock:
+            version = store.get_status_version()
+            if version == self.status_version:
+                return self
+            tagged_hashes = store.get_doc_ids_with_status("tagged")
+            for entry in self.entries.values():
+                entry["tagged"] = entry["content_hash"] in tagged_hashes
+            self.status_version = version
+        return self
+
+
+def iter_corpus_files(dataset_dir: str):
+    """
+    ``(file name, path, stat)`` of every corpus file under ``dataset_dir``, nested directories included.
+    """
+    for root, _, files in os.walk(dataset_dir):
+        for file in sorted(files):
+            if file.endswith(CORPUS_FILE_SUFFIX):
+                file_path = os.path.join(root, file)
+                yield file, file_path, os.stat(file_path)
+
+
+def build_corpus_index(dataset_dir: str, previous: dict = None, workers: int = None) -> CorpusIndex:
+    """
+    Walk the dataset directory and hash every corpus file in worker processes (see ``pipeline``).
+    Files whose size and mtime did not change since ``previous`` are not re-read.
+    """
+    from ner_annotator.pipeline import hash_files, map_shards
+
+    previous = {e["path"]: e for e in (previous or {}).values()}
+    entries = dict()
+    to_hash = list()
+    for file, file_path, stat in iter_corpus_files(dataset_dir):
+        old = previous.get(file_path)
+        if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime:
+            content_hash = old["content_hash"]
+        else:
+            content_hash = None
+            to_hash.append(file_path)
+
+        file_name = get_corpus_file_name(file)
+        entries[file_name] = {
+            "name": file_name,
+            "path": file_path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "content_hash": content_hash,
+            "tagged": False,
+        }
+
+    hashes = dict(zip(to_hash, map_shards(
+        hash_files, to_hash, sizes=[os.path.getsize(path) for path in to_hash], workers=workers
+    )))
+    for entry in entries.values():
+        if entry["content_hash"] is None:
+            entry["content_hash"] = hashes[entry["path"]]
+
+    with open(os.path.join(dataset_dir, CORPUS_INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump(list(entries.values()), f, ensure_ascii=False)
+    print(f"Indexed {len(entries)} corpus files.")
+    return CorpusIndex(dataset_dir, entries)
+
+
+def load_corpus_index(dataset_dir: str) -> CorpusIndex:
+    """
+    Load the persisted index, rebuilding it only if a corpus file was added, removed
+    or changed since it was written. Only file metadata is compared, no contents are read.
+    """
+    index_path = os.path.join(dataset_dir, CORPUS_INDEX_FILE)
+    entries = None
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            entries = {e["name"]: e for e in json.load(f)}
+        indexed = {e["path"]: (e["size"], e["mtime"]) for e in entries.values()}
+        current = {path: (stat.st_size, stat.st_mtime) for _, path, stat in iter_corpus_files(dataset_dir)}
+        if indexed == current:
+            return CorpusIndex(dataset_dir, entries)
+
+    return build_corpus_index(dataset_dir, previous=entries)
@@ -0,0 +1,211 @@
+"""
+Prebuilt pack of the tagged corpus for instant loading of known documents.
+
+``python -m ner_annotator.corpus_pack`` writes every tagged document of the
+annotation store (text, lines with spans, translations, review state, LLM
+judgements and a prebuilt entity index) into one binary file:
+
+    header  | record | record | ... | index
+
+The header holds the offset and length of the index, and the index maps every
+document id to the offset and length of its record and to the ``updated_at``
+it was packed at, and the name of every corpus file to the document with its
+content hash. The index and the records are JSON, so nothing read from the
+file is unpickled. A record is the length of the document, the document
+without its entity index, then the ``(tag, entity)`` pairs of every line that
+the entity index is rebuilt from:
+
+    document length | document | line entities
+
+The app memory-maps the pack, so opening a known document decodes one slice
+of the file instead of querying the store, and the entity index is only
+decoded when the document is opened for review (see ``get_entity_index``)
+instead of parsing the entities of every line. A record is only used while
+``updated_at`` in the store still matches; documents edited after the build
+are read from the store.
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from ner_annotator.constants import CORPUS_PACK_PATH, DATASET_DIR
+from ner_annotator.corpus import CorpusIndex, load_corpus_index
+from ner_annotator.entities import EntityIndex, index_line
+from ner_annotator.journal import get_journal
+from ner_annotator.pipeline import map_shards, pack_documents
+from ner_annotator.store import AnnotationStore, get_store
+
+
+PACK_MAGIC = b"NERPACK\x00"
+PACK_VERSION = 4
+# magic, version, document count, index offset, index length
+HEADER = struct.Struct("<8sIIQQ")
+# length of the encoded document
+RECORD_HEADER = struct.Struct("<Q")
+
+
+def pack_document(store: AnnotationStore, doc_id: str):
+    """
+    Record of a document and its entity index, or None if it does not exist.
+    """
+    data = store.get_document(doc_id)
+    if data is None:
+        return None
+    tagged_elements = data.get("tagged_elements", [])
+    for line in tagged_elements:
+        if "spans" not in line or "entity_status" not in line:
+            index_line(line)
+    document = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    line_entities = json.dumps(EntityIndex(tagged_elements).line_entities, ensure_ascii=False).encode("utf-8")
+    return RECORD_HEADER.pack(len(document)) + document + line_entities
+
+
+def build_corpus_pack(
+    path: str = CORPUS_PACK_PATH,
+    store: AnnotationStore = None,
+    corpus_index: CorpusIndex = None,
+    workers: int = None,
+) -> int:
+    """
+    Pack every tagged document of the store. Returns the number of packed documents.
+    The records are built in worker processes (see ``pipeline``).
+    """
+    store = store or get_store()
+    corpus_index = corpus_index or load_corpus_index(DATASET_DIR)
+    # Pending review edits of this process must be in the store before it is snapshotted;
+    # a running server folds its own journal within JOURNAL_COMPACT_INTERVAL
+    get_journal().compact()
+
+    docs = dict()
+    names = dict()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * HEADER.size)
+        tagged_docs = [doc for doc in store.list_documents() if doc["tagged"]]
+        records = map_shards(pack_documents, [doc["doc_id"] for doc in tagged_docs], workers=workers)
+        for doc, record in zip(tagged_docs, records):
+            if record is None:
+                continue
+            docs[doc["doc_id"]] = (f.tell(), len(record), doc["updated_at"])
+            f.write(record)
+
+        # Corpus files are listed by file name, which may differ from the stored filename
+        for name in corpus_index.names():
+            content_hash = corpus_index[name]["content_hash"]
+            if content_hash in docs:
+                names[name] = content_hash
+
+        index = json.dumps(
+            {"docs": docs, "names": names, "built_at": time.time()}, ensure_ascii=False
+        ).encode("utf-8")
+        index_offset = f.tell()
+        f.write(index)
+        f.seek(0)
+        f.write(HEADER.pack(PACK_MAGIC, PACK_VERSION, len(docs), index_offset, len(index)))
+    os.replace(tmp_path, path)
+    print(f"Packed {len(docs)} tagged documents into {path}.")
+    return len(docs)
+
+
+class CorpusPack:
+    def __init__(self, path: str = CORPUS_PACK_PATH):
+        self.path = path
+        self._file = open(path, "rb")
+        self.mtime_ns = os.fstat(self._file.fileno()).st_mtime_ns
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, index_offset, index_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {PACK_VERSION} corpus pack.")
+        index = self._load(index_offset, index_length)
+        # doc_id -> (offset, length, updated_at)
+        self.docs = index["docs"]
+        # file name -> doc_id
+        self.names = index["names"]
+        self.built_at = index["built_at"]
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.docs
+
+    def _load(self, offset: int, length: int):
+        return json.loads(self._mmap[offset:offset + length].decode("utf-8"))
+
+    def doc_id_for_name(self, name: str):
+        return self.names.get(name)
+
+    def _record(self, doc_id: str, updated_at: float = None):
+        entry = self.docs.get(doc_id)
+        if entry is None:
+            return None
+        offset, length, packed_at = entry
+        if updated_at is not None and updated_at != packed_at:
+            return None
+        (document_length,) = RECORD_HEADER.unpack_from(self._mmap, offset)
+        return offset + RECORD_HEADER.size, document_length, offset + length
+
+    def get(self, doc_id: str, updated_at: float = None):
+        """
+        Packed document dictionary of ``doc_id``, without its entity index, or None if it
+        is not packed or, when ``updated_at`` is given, it changed in the store since the
+        pack was built.
+        """
+        record = self._record(doc_id, updated_at)
+        if record is None:
+            return None
+        document_offset, document_length, _ = record
+        return self._load(document_offset, document_length)
+
+    def get_entity_index(self, doc_id: str, updated_at: float = None):
+        """
+        Prebuilt ``EntityIndex`` of ``doc_id``, under the same conditions as ``get``.
+        """
+        record = self._record(doc_id, updated_at)
+        if record is None:
+            return None
+        document_offset, document_length, end = record
+        index_offset = document_offset + document_length
+        return EntityIndex.from_line_entities(self._load(index_offset, end - index_offset))
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+_pack = None
+_pack_lock = threading.Lock()
+
+
+def get_corpus_pack(path: str = CORPUS_PACK_PATH):
+    """
+    The memory-mapped corpus pack, reopened when it is rebuilt. None if there is no pack.
+    """
+    global _pack
+    with _pack_lock:
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if _pack is None or _pack.path != path or _pack.mtime_ns != mtime_ns:
+            # The previous mapping is closed when the last thread using it lets go of it
+            try:
+                _pack = CorpusPack(path)
+            except ValueError as e:
+                print(f"Ignoring corpus pack: {e}")
+                _pack = None
+    return _pack
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack the tagged corpus for instant loading.")
+    parser.add_argument("--output", default=CORPUS_PACK_PATH)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    build_corpus_pack(args.output, workers=args.workers)
@@ -0,0 +1,189 @@
+"""
+Process-wide cache of open documents.
+
+All sessions share one LRU cache of document dictionaries keyed by document id,
+so a session only needs to remember the ids it has opened and its cursors.
+Documents are evicted least recently used first once the estimated size of the
+cache exceeds its memory cap or the cache holds too many documents, and are
+reloaded on the next access, from the corpus pack if it holds an up to date
+copy and from the annotation store otherwise. The estimate includes the
+derived review state (line models, entity index and review counts). Review
+edits are journaled as they happen, and uploads are stored before they are
+cached, so an evicted document never holds unsaved changes.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+from ner_annotator.constants import DOCUMENT_CACHE_MAX_BYTES, DOCUMENT_CACHE_MAX_DOCUMENTS
+from ner_annotator.corpus_pack import get_corpus_pack
+from ner_annotator.journal import get_journal
+from ner_annotator.store import AnnotationStore, get_store
+
+
+# Rough per-line cost of the dict, spans and entity status
+LINE_OVERHEAD_BYTES = 2048
+PREDICTION_OVERHEAD_BYTES = 512
+# Rough cost of the objects of a line model, per span, and per entry of the entity index
+LINE_MODEL_OVERHEAD_BYTES = 512
+SPAN_OVERHEAD_BYTES = 256
+ENTITY_INDEX_ENTRY_BYTES = 256
+# Dicts and matrix object of the review counts of a line, besides the matrix data
+LINE_COUNTS_OVERHEAD_BYTES = 1024
+
+
+def estimate_line_model_size(line_model) -> int:
+    # The text, plus the tagged XML and the HTML rendering the model caches
+    return (
+        LINE_MODEL_OVERHEAD_BYTES
+        + 3 * sys.getsizeof(line_model.text)
+        + SPAN_OVERHEAD_BYTES * len(line_model.spans)
+    )
+
+
+def estimate_document_size(data: dict) -> int:
+    size = sys.getsizeof(data.get("text", ""))
+    for line in data.get("tagged_elements", []):
+        size += LINE_OVERHEAD_BYTES
+        for field in ("original", "tagged", "english"):
+            size += sys.getsizeof(line.get(field) or "")
+    for response in data.get("llm_judgement", []):
+        for model_response in response.values():
+            if model_response:
+                size += PREDICTION_OVERHEAD_BYTES * len(model_response.get("predictions", []))
+    for line_model in (data.get("line_models") or {}).values():
+        size += estimate_line_model_size(line_model)
+    if data.get("entity_index") is not None:
+        size += ENTITY_INDEX_ENTRY_BYTES * sum(len(e) for e in data["entity_index"].line_entities)
+    if data.get("review_stats") is not None:
+        for counts in data["review_stats"].line_counts:
+            size += LINE_COUNTS_OVERHEAD_BYTES + counts["confusion_matrix"].matrix.nbytes
+    return size
+
+
+class DocumentCache:
+    def __init__(
+        self,
+        store: AnnotationStore = None,
+        max_bytes: int = DOCUMENT_CACHE_MAX_BYTES,
+        max_documents: int = DOCUMENT_CACHE_MAX_DOCUMENTS,
+    ):
+        self.store = store or get_store()
+        self.max_bytes = max_bytes
+        self.max_documents = max_documents
+        self.total_bytes = 0
+        # doc_id -> [data, estimated size]
+        self._docs = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, doc_id: str) -> bool:
+        with self._lock:
+            return doc_id in self._docs
+
+    def get(self, doc_id: str):
+        """
+        Document dictionary of ``doc_id``, loaded from the store on a miss.
+        Returns None if the document is neither cached nor stored.
+        """
+        with self._lock:
+            if doc_id in self._docs:
+                self._docs.move_to_end(doc_id)
+                return self._docs[doc_id][0]
+
+        journal = get_journal()
+        if journal.has_pending(doc_id):
+            journal.compact()
+        data = None
+        pack = get_corpus_pack()
+        if pack is not None and doc_id in pack:
+            data = pack.get(doc_id, updated_at=self.store.get_updated_at(doc_id))
+        if data is None:
+            data = self.store.get_document(doc_id)
+        if data is None:
+            return None
+        with self._lock:
+            # Another session may have loaded it meanwhile
+            if doc_id in self._docs:
+                self._docs.move_to_end(doc_id)
+                return self._docs[doc_id][0]
+            return self.put(doc_id, data)
+
+    def put(self, doc_id: str, data: dict) -> dict:
+        with self._lock:
+            self.discard(doc_id)
+            size = estimate_document_size(data)
+            self._docs[doc_id] = [data, size]
+            self.total_bytes += size
+            self._evict(keep=doc_id)
+            return data
+
+    def update(self, doc_id: str, **fields) -> dict:
+        """
+        Update fields of a cached (or stored) document in place and re-estimate its size.
+        Loading the document and estimating its size happen outside the cache lock, so
+        a slow store read or journal fold does not block the other sessions.
+        """
+        data = self.get(doc_id)
+        if data is None:
+            data = dict()
+        data.update(fields)
+        size = estimate_document_size(data)
+        with self._lock:
+            entry = self._docs.get(doc_id)
+            if entry is None:
+                # Evicted meanwhile, or neither cached nor stored
+                entry = self._docs[doc_id] = [data, 0]
+            elif entry[0] is not data:
+                # Replaced by another session meanwhile
+                entry[0].update(fields)
+                size = estimate_document_size(entry[0])
+            self.total_bytes += size - entry[1]
+            entry[1] = size
+            self._docs.move_to_end(doc_id)
+            self._evict(keep=doc_id)
+            return entry[0]
+
+    def put_line_model(self, doc_id: str, line_no: int, line_model):
+        """
+        Keep the line model of a cached document in its ``line_models`` and count its size.
+        """
+        with self._lock:
+            entry = self._docs.get(doc_id)
+            if entry is None:
+                return line_model
+            line_models = entry[0].setdefault("line_models", dict())
+            old = line_models.get(line_no)
+            line_models[line_no] = line_model
+            delta = estimate_line_model_size(line_model) - (estimate_line_model_size(old) if old is not None else 0)
+            entry[1] += delta
+            self.total_bytes += delta
+            self._evict(keep=doc_id)
+            return line_model
+
+    def discard(self, doc_id: str):
+        with self._lock:
+            entry = self._docs.pop(doc_id, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+    def _evict(self, keep: str):
+        while (self.total_bytes > self.max_bytes or len(self._docs) > self.max_documents) and len(self._docs) > 1:
+            doc_id, (_, size) = next(iter(self._docs.items()))
+            if doc_id == keep:
+                self._docs.move_to_end(doc_id)
+                continue
+            del self._docs[doc_id]
+            self.total_bytes -= size
+            print(f"Evicted document {doc_id} from the document cache.")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_document_cache() -> DocumentCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DocumentCache()
+    return _cache
@@ -0,0 +1,294 @@
+"""
+Entity spans of tagged lines and a document-wide entity index.
+
+Spans are parsed once, when the tagging results arrive, and stored with every
+line as ``[start, end, tag, entity]``, with character offsets into the untagged
+text. The pages render and review lines from the stored spans instead of
+re-running the tag regex on every rerun.
+"""
+import re
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+
+TAG_PATTERN = re.compile(r"<(.*?)>(.*?)</\1>")
+
+
+def extract_entities(tagged_text):
+    return [(match[0], match[1]) for match in TAG_PATTERN.findall(tagged_text)]
+
+
+def extract_spans(tagged_text):
+    """
+    Offsets of the tagged entities in the text with all tags removed.
+    """
+    spans = list()
+    removed = 0
+    for match in TAG_PATTERN.finditer(tagged_text):
+        tag, entity = match.group(1), match.group(2)
+        start = match.start() - removed
+        spans.append([start, start + len(entity), tag, entity])
+        removed += len(tag) * 2 + 5  # <TAG> and </TAG>
+    return spans
+
+
+def strip_tags(tagged_text):
+    return TAG_PATTERN.sub(r"\2", tagged_text)
+
+
+def iter_segments(line):
+    """
+    Split a tagged line into ``(text, tag)`` segments using its spans; untagged text has tag None.
+    """
+    tagged_text = line['tagged']
+    position = 0
+    removed = 0
+    for start, end, tag, entity in line.get('spans', []):
+        tagged_start = start + removed
+        if tagged_start > position:
+            yield tagged_text[position:tagged_start], None
+        yield entity, tag
+        removed += len(tag) * 2 + 5
+        position = end + removed
+    if position < len(tagged_text):
+        yield tagged_text[position:], None
+
+
+def span_key(start, end):
+    """
+    Key of the status of the entity at ``start:end``; strings, so statuses survive JSON.
+    """
+    return f"{start}:{end}"
+
+
+def build_entity_status(spans):
+    """
+    Review status of every tagged span, keyed by its offsets so repeated entities stay apart.
+    """
+    return {
+        span_key(start, end): {
+            'entity': entity,
+            'tag': tag,
+            'user_updated': None,
+            'start': start,
+            'end': end,
+        }
+        for start, end, tag, entity in spans
+    }
+
+
+def iter_entity_status(entity_status):
+    """
+    ``(key, status)`` pairs of the entities of a status, without the ``user_verified`` flag.
+    """
+    return [(key, status) for key, status in entity_status.items() if key != 'user_verified']
+
+
+def normalize_entity_status(line):
+    """
+    Re-key a status stored before it was keyed by span (by entity surface text) in place:
+    every occurrence of an entity gets a copy of the status of its surface text.
+    """
+    entity_status = line.get('entity_status')
+    if not entity_status or all('start' in status for _, status in iter_entity_status(entity_status)):
+        return line
+    by_entity = {
+        key: status for key, status in iter_entity_status(entity_status) if 'start' not in status
+    }
+    normalized = {key: status for key, status in iter_entity_status(entity_status) if 'start' in status}
+    for start, end, tag, entity in line['spans']:
+        key = span_key(start, end)
+        if key in normalized or entity not in by_entity:
+            continue
+        normalized[key] = {
+            'entity': entity,
+            'tag': by_entity[entity]['tag'],
+            'user_updated': by_entity[entity]['user_updated'],
+            'start': start,
+            'end': end,
+        }
+    if entity_status.get('user_verified'):
+        normalized['user_verified'] = True
+    line['entity_status'] = normalized
+    return line
+
+
+def index_line(line):
+    """
+    Add spans (and entity status, if the line has none yet) to a tagged line in place.
+    """
+    line['spans'] = extract_spans(line['tagged'])
+    if 'entity_status' not in line:
+        line['entity_status'] = build_entity_status(line['spans'])
+    return normalize_entity_status(line)
+
+
+def get_line_entities(line):
+    """
+    ``(tag, entity)`` pairs of a line, read from its spans.
+    """
+    return [(tag, entity) for _, _, tag, entity in line.get('spans', [])]
+
+
+class TaggedLine:
+    """
+    Compact, editable model of one tagged line: the untagged text plus the spans
+    ``[start, end, tag, entity]`` sorted by start. Edits locate a span by bisecting
+    the start offsets, so they touch only that occurrence; the tagged XML and the
+    HTML rendering are generated on first use after an edit.
+    """
+    __slots__ = ('text', 'spans', 'starts', '_tagged', '_html')
+
+    def __init__(self, text, spans=()):
+        self.text = text
+        self.spans = sorted(list(span) for span in spans)
+        self.starts = [span[0] for span in self.spans]
+        self._tagged = None
+        self._html = None
+
+    @classmethod
+    def from_line(cls, line):
+        if 'spans' not in line:
+            line['spans'] = extract_spans(line['tagged'])
+        text = "".join(segment for segment, _ in iter_segments(line))
+        return cls(text, line['spans'])
+
+    def _changed(self):
+        self._tagged = None
+        self._html = None
+
+    def span_at(self, start):
+        i = bisect_left(self.starts, start)
+        if i < len(self.starts) and self.starts[i] == start:
+            return i
+        return None
+
+    def overlaps(self, start, end):
+        i = bisect_right(self.starts, start)
+        if i > 0 and self.spans[i - 1][1] > start:
+            return True
+        return i < len(self.starts) and self.starts[i] < end
+
+    def occurrences(self, entity, tag=None):
+        """
+        Start offsets of the spans of ``entity`` (with ``tag``, if given).
+        """
+        return [
+            start for start, _, span_tag, span_entity in self.spans
+            if span_entity == entity and (tag is None or span_tag == tag)
+        ]
+
+    def find_untagged(self, phrase):
+        """
+        Start of the first occurrence of ``phrase`` that does not overlap a tagged span.
+        """
+        start = self.text.find(phrase)
+        while start != -1:
+            if not self.overlaps(start, start + len(phrase)):
+                return start
+            start = self.text.find(phrase, start + 1)
+        return None
+
+    def add(self, start, end, tag):
+        if self.overlaps(start, end):
+            raise ValueError(f"Span {start}-{end} overlaps an existing tag.")
+        i = bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.spans.insert(i, [start, end, tag, self.text[start:end]])
+        self._changed()
+
+    def retag(self, start, tag):
+        i = self.span_at(start)
+        if i is None:
+            raise KeyError(f"No tagged span starts at {start}.")
+        self.spans[i][2] = tag
+        self._changed()
+
+    def remove(self, start):
+        i = self.span_at(start)
+        if i is None:
+            raise KeyError(f"No tagged span starts at {start}.")
+        del self.starts[i]
+        del self.spans[i]
+        self._changed()
+
+    def segments(self):
+        position = 0
+        for start, end, tag, entity in self.spans:
+            if start > position:
+                yield self.text[position:start], None
+            yield entity, tag
+            position = end
+        if position < len(self.text):
+            yield self.text[position:], None
+
+    @property
+    def tagged(self):
+        if self._tagged is None:
+            self._tagged = "".join(
+                segment if tag is None else f"<{tag}>{segment}</{tag}>"
+                for segment, tag in self.segments()
+            )
+        return self._tagged
+
+    def html(self, colors, default_color="#E5E7E9"):
+        if self._html is None:
+            self._html = "".join(
+                segment if tag is None else (
+                    f'<span style="background-color: {colors.get(tag.upper(), default_color)}; '
+                    f'padding: 2px;" title="{tag}">{segment}</span>'
+                )
+                for segment, tag in self.segments()
+            )
+        return self._html
+
+    def to_line(self, line):
+        """
+        Write the tagged text and spans back into the line dict that is stored and exported.
+        """
+        line['tagged'] = self.tagged
+        line['spans'] = [list(span) for span in self.spans]
+        return line
+
+
+class EntityIndex:
+    """
+    Document-wide map from entity surface form to the lines it occurs in, with its tag.
+    """
+
+    def __init__(self, tagged_elements):
+        self.occurrences = defaultdict(dict)
+        self.line_entities = [list() for _ in tagged_elements]
+        for line_no, line in enumerate(tagged_elements):
+            self._add_line(line_no, line)
+
+    @classmethod
+    def from_line_entities(cls, line_entities) -> "EntityIndex":
+        """
+        Index rebuilt from the ``(tag, entity)`` pairs of every line, as saved from
+        ``line_entities``, without parsing the lines again.
+        """
+        index = cls([])
+        index.line_entities = [[(tag, entity) for tag, entity in entities] for entities in line_entities]
+        for line_no, entities in enumerate(index.line_entities):
+            for tag, entity in entities:
+                index.occurrences[entity][line_no] = tag
+        return index
+
+    def _add_line(self, line_no, line):
+        self.line_entities[line_no] = get_line_entities(line)
+        for tag, entity in self.line_entities[line_no]:
+            self.occurrences[entity][line_no] = tag
+
+    def update_line(self, line_no, line):
+        for _, entity in self.line_entities[line_no]:
+            self.occurrences[entity].pop(line_no, None)
+            if not self.occurrences[entity]:
+                del self.occurrences[entity]
+        self._add_line(line_no, line)
+
+    def find(self, entity):
+        """
+        ``{line_no: tag}`` of every line the entity occurs in.
+        """
+        return dict(self.occurrences.get(entity, {}))
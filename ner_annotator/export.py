@@ -0,0 +1,225 @@
+"""
+Export of NER review and LLM judgement data.
+
+Rows are produced lazily from the annotation records and streamed into the
+writer, so combining many documents never builds intermediate DataFrames or
+re-reads generated files.
+"""
+import csv
+import io
+from itertools import islice
+
+from openpyxl import Workbook
+
+from ner_annotator.entities import iter_entity_status
+from ner_annotator.tracing import span
+
+
+NER_TAG_COLUMNS = [
+    "File Name",
+    "Sentence",
+    "NER Tagged",
+    "English",
+    "Entity",
+    "LLM-NER-Tag",
+    "Reviewed",
+    "Correct",
+    "User Corrected",
+]
+
+LLM_JUDGEMENT_COLUMNS = [
+    "File Name",
+    "Entity",
+    "Tag",
+    "Correct",
+    "Alternative",
+    "LLM",
+]
+
+BOOLEAN_COLUMNS = {"Reviewed", "Correct"}
+
+PARQUET_BATCH_SIZE = 5000
+
+
+def get_export_file_name(file_name):
+    return (file_name or "").replace('.pdf.json.txt', '.txt')
+
+
+def iter_ner_tag_records(file_name, tagged_elements):
+    """
+    One row per reviewed entity of every line.
+    """
+    file_name = get_export_file_name(file_name)
+    for item in tagged_elements:
+        if "entity_status" not in item:
+            continue
+        user_verified = item["entity_status"].get("user_verified", False)
+        for _, status in iter_entity_status(item["entity_status"]):
+            yield (
+                file_name,
+                item['original'],
+                item["tagged"],
+                item['english'],
+                status["entity"],
+                status["tag"],
+                user_verified,
+                user_verified and status['user_updated'] is None,
+                status["user_updated"] if status['user_updated'] is not None else "NA",
+            )
+
+
+def iter_llm_judgement_records(file_name, llm_judgement):
+    """
+    One row per entity prediction of every judge model.
+    """
+    file_name = get_export_file_name(file_name)
+    for response in llm_judgement:
+        for model, model_response in response.items():
+            if not model_response:
+                continue
+            for prediction in model_response.get('predictions', []):
+                yield (
+                    file_name,
+                    prediction["entity"],
+                    prediction.get("tag"),
+                    prediction["correct"],
+                    prediction.get("alternative") if not prediction["correct"] else "NA",
+                    model,
+                )
+
+
+def write_excel(records, columns, sheet_name):
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(title=sheet_name)
+    worksheet.append(columns)
+    for record in records:
+        worksheet.append(record)
+    output = io.BytesIO()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+
+def write_csv(records, columns, sheet_name=None):
+    output = io.BytesIO()
+    # utf-8-sig so that Excel opens the Urdu text correctly
+    text_output = io.TextIOWrapper(output, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text_output)
+    writer.writerow(columns)
+    writer.writerows(records)
+    text_output.flush()
+    text_output.detach()
+    output.seek(0)
+    return output
+
+
+def get_arrow_schema(columns):
+    import pyarrow as pa
+
+    return pa.schema([
+        (column, pa.bool_() if column in BOOLEAN_COLUMNS else pa.string())
+        for column in columns
+    ])
+
+
+def iter_record_batches(records, schema):
+    """
+    Arrow record batches of up to ``PARQUET_BATCH_SIZE`` records.
+    """
+    import pyarrow as pa
+
+    records = iter(records)
+    while batch := list(islice(records, PARQUET_BATCH_SIZE)):
+        yield pa.RecordBatch.from_arrays(
+            [
+                pa.array(
+                    [v if v is None or column in BOOLEAN_COLUMNS else str(v) for v in values],
+                    type=schema.field(column).type,
+                )
+                for column, values in zip(schema.names, zip(*batch))
+            ],
+            schema=schema,
+        )
+
+
+def records_to_ipc(records, columns) -> bytes:
+    """
+    Records as an Arrow IPC stream, e.g. to pass them between processes.
+    """
+    import pyarrow as pa
+
+    schema = get_arrow_schema(columns)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for batch in iter_record_batches(records, schema):
+            writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def iter_ipc_batches(streams):
+    """
+    Record batches of Arrow IPC streams written by ``records_to_ipc``.
+    """
+    import pyarrow as pa
+
+    for stream in streams:
+        yield from pa.ipc.open_stream(stream)
+
+
+def iter_batch_records(batches):
+    for batch in batches:
+        yield from zip(*(column.to_pylist() for column in batch.columns))
+
+
+def write_parquet(records, columns, sheet_name=None):
+    return write_parquet_batches(iter_record_batches(records, get_arrow_schema(columns)), columns)
+
+
+def write_parquet_batches(batches, columns, sheet_name=None):
+    import pyarrow.parquet as pq
+
+    output = io.BytesIO()
+    with pq.ParquetWriter(output, get_arrow_schema(columns)) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+    output.seek(0)
+    return output
+
+
+EXPORT_FORMATS = {
+    "Excel": {
+        "writer": write_excel,
+        "extension": "xlsx",
+        "mime": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    },
+    "CSV": {
+        "writer": write_csv,
+        "extension": "csv",
+        "mime": "text/csv",
+    },
+    "Parquet": {
+        "writer": write_parquet,
+        "extension": "parquet",
+        "mime": "application/vnd.apache.parquet",
+    },
+}
+
+
+def export_records(records, columns, sheet_name, export_format="Excel"):
+    with span("export", export_format=export_format, sheet_name=sheet_name) as export_span:
+        output = EXPORT_FORMATS[export_format]["writer"](records, columns, sheet_name)
+        export_span.set_attribute("bytes", output.getbuffer().nbytes)
+        return output
+
+
+def export_record_batches(batches, columns, sheet_name, export_format="Excel"):
+    """
+    Like ``export_records`` for Arrow record batches; Parquet is written from the batches directly.
+    """
+    with span("export", export_format=export_format, sheet_name=sheet_name) as export_span:
+        if export_format == "Parquet":
+            output = write_parquet_batches(batches, columns, sheet_name)
+        else:
+            output = EXPORT_FORMATS[export_format]["writer"](iter_batch_records(batches), columns, sheet_name)
+        export_span.set_attribute("bytes", output.getbuffer().nbytes)
+        return output
@@ -0,0 +1,248 @@
+"""
+Few-shot examples for the tagger, retrieved from verified lines.
+
+Lines that annotators verified on the review page are kept in a local chromadb
+collection under ``chroma_data_dir``. For every chunk the tagger retrieves the
+verified lines most similar to the chunk and uses them as the examples of the
+system prompt instead of the static example, adding them by similarity until
+the prompt would exceed ``PROMPT_TOKEN_BUDGET`` tokens.
+
+Lines are embedded locally with hashed character trigrams of the normalised
+Urdu tokens, so no embedding model has to be downloaded or called. The
+collection is synced incrementally from the annotation store before tagging;
+tagging jobs run in several processes, so a sync holds a file lock on the
+collection directory and only one process writes to it at a time. A chunk
+for which no verified line fits the budget keeps the static example if that
+fits, and is sent without an example otherwise.
+
+``python -m ner_annotator.few_shot sync`` syncs the collection and
+``python -m ner_annotator.few_shot measure FILE`` compares the prompt tokens of
+a file with retrieved and with static examples without calling an LLM.
+"""
+import argparse
+import fcntl
+import json
+import os
+import threading
+import zlib
+from functools import lru_cache
+
+from ner_annotator.constants import (
+    FEW_SHOT_COLLECTION,
+    FEW_SHOT_EMBEDDING_DIM,
+    FEW_SHOT_CANDIDATES,
+    FEW_SHOT_MAX_EXAMPLES,
+)
+from ner_annotator.search import tokenize
+from ner_annotator.store import AnnotationStore, get_store
+from settings import chroma_data_dir
+
+
+SYNC_BATCH_SIZE = 1000
+SYNC_STATE_FILE = "few_shot_sync.json"
+SYNC_LOCK_FILE = "few_shot_sync.lock"
+EXAMPLES_HEADER = "Examples of verified lines -- \n\nInput: \n"
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # The encoding is downloaded on first use
+        print(f"Falling back to estimated token counts: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 3 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list) -> int:
+    return sum(count_tokens(message["content"]) for message in messages)
+
+
+def embed_lines(lines: list):
+    """
+    L2-normalised hashed character trigram vectors of the normalised tokens.
+    """
+    import numpy as np
+
+    vectors = np.zeros((len(lines), FEW_SHOT_EMBEDDING_DIM), dtype=np.float32)
+    for i, line in enumerate(lines):
+        for token in tokenize(line):
+            padded = f"#{token}#"
+            for j in range(max(len(padded) - 2, 1)):
+                h = zlib.crc32(padded[j:j + 3].encode())
+                vectors[i, h % FEW_SHOT_EMBEDDING_DIM] += 1.0 if h & 0x80000000 else -1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def format_examples(examples: list) -> str:
+    """
+    Render examples like the static example of the Marsiya prompt.
+    """
+    output = json.dumps(
+        {
+            "tagged_elements": [
+                {"original": e["original"], "tagged": e["tagged"], "english": e["english"]}
+                for e in examples
+            ]
+        },
+        ensure_ascii=False,
+        indent=4,
+    )
+    lines = "\n".join(e["original"] for e in examples)
+    return f"{EXAMPLES_HEADER}{lines}\n\n\nOutput:\n{output}\n"
+
+
+class ExampleIndex:
+    def __init__(self, path: str = chroma_data_dir):
+        import chromadb
+
+        self.path = path
+        self.client = chromadb.PersistentClient(path=path)
+        self.collection = self.client.get_or_create_collection(
+            FEW_SHOT_COLLECTION, metadata={"hnsw:space": "cosine"}
+        )
+        self._lock = threading.Lock()
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def _read_synced_at(self) -> float:
+        try:
+            with open(os.path.join(self.path, SYNC_STATE_FILE)) as f:
+                return json.load(f)["synced_at"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0
+
+    def _write_synced_at(self, synced_at: float):
+        with open(os.path.join(self.path, SYNC_STATE_FILE), "w") as f:
+            json.dump({"synced_at": synced_at}, f)
+
+    def sync(self, store: AnnotationStore = None) -> int:
+        """
+        Upsert the verified lines of documents changed since the last sync.
+        Returns the number of upserted lines.
+        """
+        store = store or get_store()
+        with self._lock, open(os.path.join(self.path, SYNC_LOCK_FILE), "a") as lock_file:
+            # Other processes wait and then find the lines already synced
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            lines = store.get_verified_lines(since=self._read_synced_at())
+            for i in range(0, len(lines), SYNC_BATCH_SIZE):
+                batch = lines[i:i + SYNC_BATCH_SIZE]
+                self.collection.upsert(
+                    ids=[f"{line['doc_id']}:{line['line_no']}" for line in batch],
+                    documents=[line["original"] for line in batch],
+                    embeddings=embed_lines([line["original"] for line in batch]),
+                    metadatas=[
+                        {
+                            "doc_id": line["doc_id"],
+                            "tagged": line["tagged"],
+                            "english": line["english"] or "",
+                        }
+                        for line in batch
+                    ],
+                )
+            if lines:
+                self._write_synced_at(max(line["updated_at"] for line in lines))
+                print(f"Synced {len(lines)} verified lines into the few-shot index.")
+        return len(lines)
+
+    def select_examples(self, lines: list, token_budget: int, max_examples: int = FEW_SHOT_MAX_EXAMPLES) -> list:
+        """
+        Verified lines most similar to ``lines`` whose rendered examples fit in ``token_budget``.
+        """
+        count = self.count()
+        if not lines or not count or token_budget <= count_tokens(format_examples([])):
+            return []
+        result = self.collection.query(
+            query_embeddings=embed_lines(lines),
+            n_results=min(FEW_SHOT_CANDIDATES, count),
+            include=["documents", "metadatas", "distances"],
+        )
+        chunk_lines = set(lines)
+        # original -> (distance, example)
+        candidates = dict()
+        for documents, metadatas, distances in zip(
+            result["documents"], result["metadatas"], result["distances"]
+        ):
+            for original, metadata, distance in zip(documents, metadatas, distances):
+                if original in chunk_lines:
+                    continue
+                if original not in candidates or distance < candidates[original][0]:
+                    candidates[original] = (distance, {
+                        "original": original,
+                        "tagged": metadata["tagged"],
+                        "english": metadata["english"],
+                    })
+
+        examples = list()
+        for _, example in sorted(candidates.values(), key=lambda c: c[0]):
+            if len(examples) == max_examples:
+                break
+            if count_tokens(format_examples(examples + [example])) <= token_budget:
+                examples.append(example)
+        return examples
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_example_index():
+    """
+    The few-shot index, synced with the store. None if it cannot be opened or holds no examples yet.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            try:
+                _index = ExampleIndex()
+            except Exception as e:
+                print(f"Few-shot index unavailable, using the static examples: {e}")
+                return None
+    try:
+        _index.sync()
+    except Exception as e:
+        print(f"Error syncing the few-shot index: {e}")
+    return _index if _index.count() else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Few-shot example index of verified lines.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("sync", help="Sync the verified lines of the store into the index")
+    measure_parser = subparsers.add_parser(
+        "measure", help="Compare the prompt tokens of a file with retrieved and static examples"
+    )
+    measure_parser.add_argument("file")
+    measure_parser.add_argument("--chunk-size", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "sync":
+        index = get_example_index()
+        print(f"{index.count() if index else 0} verified lines in the few-shot index.")
+    else:
+        from ner_annotator.llm_tagger import CHUNK_SIZE, get_ner_prompt_messages_per_chunk
+
+        with open(args.file, encoding="utf-8") as f:
+            text = f.read()
+        chunk_size = args.chunk_size or CHUNK_SIZE
+        static = get_ner_prompt_messages_per_chunk(text, chunk_size)
+        dynamic = get_ner_prompt_messages_per_chunk(text, chunk_size, example_index=get_example_index())
+        static_tokens = sum(count_message_tokens(m) for m in static)
+        dynamic_tokens = sum(count_message_tokens(m) for m in dynamic)
+        print(f"{len(static)} chunks")
+        print(f"Static examples:    {static_tokens} input tokens")
+        print(f"Retrieved examples: {dynamic_tokens} input tokens "
+              f"({1 - dynamic_tokens / max(static_tokens, 1):.1%} fewer)")
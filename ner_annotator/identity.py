@@ -0,0 +1,17 @@
+"""
+Stable, content-addressed document identity.
+
+A document id is the MD5 hex digest of the UTF-8 text. It is the same in every
+process and across restarts, so session state, the annotation store, the
+corpus and search indexes and the exports all use it as their key. MD5 is
+kept because existing uploads and indexes are already keyed by it.
+"""
+import hashlib
+
+
+def document_id(text: str) -> str:
+    """
+    Document id of ``text``. Callers compute it once where a text enters the app
+    and pass the id along, instead of hashing the text again in every helper.
+    """
+    return hashlib.md5(text.encode()).hexdigest()
@@ -0,0 +1,61 @@
+"""
+On-disk format of the persisted indexes: a fixed preamble, a JSON header and
+raw ``array`` buffers, so loading an index parses JSON and copies arrays, and
+never unpickles anything read from disk.
+
+    magic | version | header length | header (JSON) | array | array | ...
+
+The header records the byte order and the type code and length of every
+array; arrays written on a machine of the other byte order are swapped.
+"""
+import json
+import os
+import struct
+import sys
+from array import array
+
+
+# Magic, format version and header length
+PREAMBLE = struct.Struct("<7sBI")
+
+
+def write_index_file(path: str, magic: bytes, version: int, header: dict, arrays: list = ()):
+    """
+    Atomically write ``header`` and ``arrays`` (``array.array`` buffers) to ``path``.
+    """
+    header = dict(header, byteorder=sys.byteorder, arrays=[[a.typecode, len(a)] for a in arrays])
+    encoded = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Indexes are saved by several processes
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(PREAMBLE.pack(magic, version, len(encoded)))
+        f.write(encoded)
+        for buffer in arrays:
+            buffer.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def read_index_file(path: str, magic: bytes, version: int):
+    """
+    ``(header, arrays)`` of an index file, or None if it is missing or was written
+    in another format or version.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size:
+            return None
+        file_magic, file_version, header_size = PREAMBLE.unpack(preamble)
+        if file_magic != magic or file_version != version:
+            return None
+        header = json.loads(f.read(header_size).decode("utf-8"))
+        arrays = list()
+        for typecode, length in header["arrays"]:
+            buffer = array(typecode)
+            buffer.frombytes(f.read(buffer.itemsize * length))
+            if header["byteorder"] != sys.byteorder:
+                buffer.byteswap()
+            arrays.append(buffer)
+    return header, arrays
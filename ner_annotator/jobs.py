@@ -0,0 +1,249 @@
+"""
+Background jobs for LLM tagging and judging.
+
+Jobs are persisted in the ``jobs`` table of the annotation store and executed
+by a small pool of worker processes, one process per running job, so a long
+LLM run neither blocks a Streamlit script thread nor dies with a rerun or page
+navigation. Workers report progress and check for cancellation through the
+store; a worker that ignores a cancel request is terminated after a grace
+period. Jobs that were running when the server stopped are queued again on
+the next start, and results are written to the store like any other save.
+"""
+import atexit
+import multiprocessing
+import threading
+import time
+import traceback
+import uuid
+
+from ner_annotator.constants import (
+    JOB_MAX_WORKERS,
+    JOB_POLL_INTERVAL,
+    JOB_PROGRESS_INTERVAL,
+    JOB_CANCEL_GRACE,
+)
+from ner_annotator.documents import get_document_cache
+from ner_annotator.store import AnnotationStore, get_store
+from ner_annotator.tracing import configure_tracing, document_context, span
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobProgress:
+    """
+    Drop-in replacement for ``tqdm`` that records the progress of a job in the
+    store and stops the job when a cancel is requested.
+    """
+
+    def __init__(self, store: AnnotationStore, job_id: str, interval: float = JOB_PROGRESS_INTERVAL):
+        self.store = store
+        self.job_id = job_id
+        self.interval = interval
+
+    def check_cancelled(self):
+        if self.store.is_job_cancel_requested(self.job_id):
+            raise JobCancelled(self.job_id)
+
+    def __call__(self, iterable, total=None, desc=None, **kwargs):
+        if total is None and hasattr(iterable, "__len__"):
+            total = len(iterable)
+        self.store.update_job(self.job_id, done=0, total=total, message=desc)
+        self.check_cancelled()
+        done = 0
+        last_update = time.monotonic()
+        for item in iterable:
+            yield item
+            done += 1
+            if time.monotonic() - last_update >= self.interval or done == total:
+                self.store.update_job(self.job_id, done=done)
+                last_update = time.monotonic()
+                self.check_cancelled()
+
+
+def run_tagging_job(store: AnnotationStore, job: dict, progress: JobProgress):
+    from ner_annotator.llm_tagger import get_ner_tags
+    from ner_annotator.utils import save_ner_tags
+
+    params = job["params"]
+    text = store.get_text(job["doc_id"])
+    ner_tags = get_ner_tags(
+        text, model_id=params["model_id"], chunk_size=params["chunk_size"], tqdm=progress,
+        doc_id=job["doc_id"],
+    )
+    progress.check_cancelled()
+    save_ner_tags(job["doc_id"], ner_tags)
+    return f"Tagged {len(ner_tags)} lines."
+
+
+def run_judging_job(store: AnnotationStore, job: dict, progress: JobProgress):
+    from ner_annotator.llm_judge import run_evaluation
+    from ner_annotator.utils import save_llm_judgement
+
+    params = job["params"]
+    data = store.get_document(job["doc_id"])
+    results = run_evaluation(
+        data["tagged_elements"], params["models"],
+        params["sentence_chunk_size"], params["context_size"],
+        tqdm=progress,
+    )
+    progress.check_cancelled()
+    save_llm_judgement(job["doc_id"], results)
+    return f"Judged {len(results)} chunks."
+
+
+JOB_HANDLERS = {
+    "tagging": run_tagging_job,
+    "judging": run_judging_job,
+}
+
+
+def run_job(job_id: str):
+    """
+    Entry point of a worker process.
+    """
+    configure_tracing()
+    store = get_store()
+    job = store.get_job(job_id)
+    print(f"Running {job['kind']} job {job_id} for {job['doc_id']}...")
+    try:
+        with document_context(job["doc_id"]), span(f"job.{job['kind']}", job_id=job_id):
+            message = JOB_HANDLERS[job["kind"]](store, job, JobProgress(store, job_id))
+    except JobCancelled:
+        store.update_job(job_id, status="cancelled", finished_at=time.time())
+        print(f"Job {job_id} cancelled.")
+        return
+    except Exception as e:
+        traceback.print_exc()
+        store.update_job(
+            job_id, status="failed", error=f"{type(e).__name__}: {e}", finished_at=time.time()
+        )
+        return
+    store.update_job(job_id, status="done", message=message, finished_at=time.time())
+    print(f"Job {job_id} done: {message}")
+
+
+class JobRunner:
+    def __init__(
+        self,
+        store: AnnotationStore = None,
+        max_workers: int = JOB_MAX_WORKERS,
+        poll_interval: float = JOB_POLL_INTERVAL,
+        cancel_grace: float = JOB_CANCEL_GRACE,
+    ):
+        self.store = store or get_store()
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.cancel_grace = cancel_grace
+        self.on_finished = list()
+
+        # spawn, so workers do not inherit the server's threads and open connections
+        self._context = multiprocessing.get_context("spawn")
+        # job_id -> {"process", "cancel_seen_at"}
+        self._workers = dict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+        requeued = self.store.requeue_interrupted_jobs()
+        if requeued:
+            print(f"Requeued {requeued} interrupted jobs.")
+
+        self._thread = threading.Thread(target=self._run, name="job-runner", daemon=True)
+        self._thread.start()
+
+    def submit(self, kind: str, doc_id: str, params: dict) -> str:
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = uuid.uuid4().hex
+        self.store.create_job(job_id, kind, doc_id, params)
+        self._wake.set()
+        return job_id
+
+    def cancel(self, job_id: str):
+        self.store.request_job_cancel(job_id)
+        self._wake.set()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self._lock:
+                    self._reap_workers()
+                    self._enforce_cancellations()
+                    self._start_queued_jobs()
+            except Exception as e:
+                print(f"Job runner error: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _reap_workers(self):
+        for job_id, worker in list(self._workers.items()):
+            process = worker["process"]
+            if process.is_alive():
+                continue
+            process.join()
+            del self._workers[job_id]
+            job = self.store.get_job(job_id)
+            if job["status"] == "running":
+                # The worker exited without recording a result, e.g. it was terminated
+                if job["cancel_requested"]:
+                    self.store.update_job(job_id, status="cancelled", finished_at=time.time())
+                else:
+                    self.store.update_job(
+                        job_id, status="failed", finished_at=time.time(),
+                        error=f"Worker exited with code {process.exitcode}.",
+                    )
+                job = self.store.get_job(job_id)
+            for callback in self.on_finished:
+                callback(job)
+
+    def _enforce_cancellations(self):
+        now = time.monotonic()
+        for job_id, worker in self._workers.items():
+            if worker["cancel_seen_at"] is None:
+                if self.store.is_job_cancel_requested(job_id):
+                    worker["cancel_seen_at"] = now
+            elif now - worker["cancel_seen_at"] > self.cancel_grace:
+                print(f"Terminating job {job_id} after cancel request.")
+                worker["process"].terminate()
+
+    def _start_queued_jobs(self):
+        free_workers = self.max_workers - len(self._workers)
+        if free_workers <= 0:
+            return
+        # Oldest first
+        for job in reversed(self.store.list_jobs(statuses=("queued",))):
+            if free_workers == 0:
+                break
+            if not self.store.claim_job(job["job_id"]):
+                continue
+            process = self._context.Process(
+                target=run_job,
+                args=(job["job_id"],),
+                name=f"job-{job['kind']}-{job['job_id'][:8]}",
+                daemon=True,
+            )
+            process.start()
+            self._workers[job["job_id"]] = {"process": process, "cancel_seen_at": None}
+            free_workers -= 1
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner() -> JobRunner:
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner()
+            # Cached copies of the document are stale once a job wrote its results
+            _runner.on_finished.append(lambda job: get_document_cache().discard(job["doc_id"]))
+            atexit.register(_runner.close)
+    return _runner
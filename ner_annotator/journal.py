@@ -0,0 +1,252 @@
+"""
+Append-only journal for review edits.
+
+Every review action appends one small JSON record holding the new state of the
+edited line. Records are fsynced in batches by a background thread and
+periodically folded into the annotation store, so a save never pays for the
+size of the document.
+
+Every process writes its own journal file, ``review.<pid>.journal``, and holds
+an exclusive lock on ``review.<pid>.lock`` while it runs. A process only ever
+rotates and folds its own files, so command line tools that open the journal
+next to the server never touch the server's records. Files of processes whose
+lock is free, i.e. that crashed or exited, are folded in the next time a
+journal is opened.
+"""
+import atexit
+import fcntl
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+from ner_annotator.constants import (
+    JOURNAL_DIR,
+    JOURNAL_FSYNC_INTERVAL,
+    JOURNAL_FSYNC_BATCH,
+    JOURNAL_COMPACT_INTERVAL,
+)
+from ner_annotator.store import AnnotationStore, get_store
+
+
+JOURNAL_FILE = "review.{pid}.journal"
+LOCK_FILE = "review.{pid}.lock"
+RECOVERY_LOCK_FILE = "recovery.lock"
+# The single journal file written before journals were per process
+LEGACY_JOURNAL_FILE = "review.journal"
+PID_PATTERN = re.compile(r"^review\.(\d+)\.")
+
+
+class EditJournal:
+    def __init__(
+        self,
+        store: AnnotationStore,
+        journal_dir: str = JOURNAL_DIR,
+        fsync_interval: float = JOURNAL_FSYNC_INTERVAL,
+        fsync_batch: int = JOURNAL_FSYNC_BATCH,
+        compact_interval: float = JOURNAL_COMPACT_INTERVAL,
+    ):
+        self.store = store
+        self.journal_dir = journal_dir
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.compact_interval = compact_interval
+
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pending_docs = set()
+        self._unsynced = 0
+
+        os.makedirs(journal_dir, exist_ok=True)
+        # Fold whatever exited processes left behind before accepting new records
+        self._recover_orphaned_files()
+        pid = os.getpid()
+        self._lock_file = open(os.path.join(journal_dir, LOCK_FILE.format(pid=pid)), "a")
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        self._path = os.path.join(journal_dir, JOURNAL_FILE.format(pid=pid))
+        self._file = open(self._path, "a", encoding="utf-8")
+
+        self._worker = threading.Thread(
+            target=self._run, name="edit-journal", daemon=True
+        )
+        self._worker.start()
+
+    def append(self, doc_id: str, line_no: int, action: str, line: dict):
+        """
+        Append a review action. Returns as soon as the record is handed to the OS;
+        fsync happens in batches.
+        """
+        self.append_many(doc_id, [(line_no, action, line)])
+
+    def append_many(self, doc_id: str, items: list):
+        """
+        Append ``(line_no, action, line)`` review actions of one document in a single write.
+        """
+        if not items:
+            return
+        now = time.time()
+        records = "".join(
+            json.dumps({
+                "ts": now,
+                "action": action,
+                "doc_id": doc_id,
+                "line_no": line_no,
+                "line": line,
+            }, ensure_ascii=False) + "\n"
+            for line_no, action, line in items
+        )
+        with self._lock:
+            self._file.write(records)
+            self._file.flush()
+            self._pending_docs.add(doc_id)
+            self._unsynced += len(items)
+            if self._unsynced >= self.fsync_batch:
+                self._fsync()
+
+    def has_pending(self, doc_id: str = None) -> bool:
+        with self._lock:
+            return doc_id in self._pending_docs if doc_id else bool(self._pending_docs)
+
+    def pending_lines(self) -> set:
+        """
+        ``(doc_id, line_no)`` of every line with journaled edits that are not folded into
+        the store yet, in the journals of all processes. Edits of other running processes
+        are folded by them only, and would overwrite changes made to those lines meanwhile.
+        """
+        with self._lock:
+            self._file.flush()
+        lines = set()
+        for file_path in glob.glob(os.path.join(self.journal_dir, "review.*journal*")):
+            try:
+                with open(file_path, "r", encoding="utf-8") as f:
+                    for record in f:
+                        try:
+                            record = json.loads(record)
+                        except json.JSONDecodeError:
+                            # A record the owner is still writing
+                            continue
+                        lines.add((record["doc_id"], record["line_no"]))
+            except FileNotFoundError:
+                # Folded and removed meanwhile
+                continue
+        return lines
+
+    def compact(self):
+        """
+        Fold all journaled records into the store and truncate the journal. Rotated
+        files left by a fold that failed are retried even when nothing new was journaled.
+        """
+        with self._compact_lock:
+            with self._lock:
+                if self._pending_docs:
+                    self._fsync()
+                    self._file.close()
+                    self._rotate_active_file()
+                    self._file = open(self._path, "a", encoding="utf-8")
+                    self._pending_docs = set()
+            return self._fold_rotated_files()
+
+    def close(self):
+        self._stop.set()
+        self._worker.join(timeout=self.fsync_interval * 2)
+        self.compact()
+        with self._lock:
+            self._file.close()
+            if os.path.exists(self._path) and os.path.getsize(self._path) == 0:
+                os.remove(self._path)
+            os.remove(self._lock_file.name)
+            self._lock_file.close()
+
+    def _fsync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def _rotate_active_file(self, path=None):
+        path = path or self._path
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            os.replace(path, f"{path}.{time.time_ns()}.compacting")
+
+    def _recover_orphaned_files(self):
+        """
+        Fold the journals of processes that no longer hold their lock.
+        """
+        with open(os.path.join(self.journal_dir, RECOVERY_LOCK_FILE), "a") as recovery_lock:
+            fcntl.flock(recovery_lock.fileno(), fcntl.LOCK_EX)
+            legacy_path = os.path.join(self.journal_dir, LEGACY_JOURNAL_FILE)
+            self._rotate_active_file(legacy_path)
+            self._fold_rotated_files(legacy_path)
+
+            pids = {
+                int(match.group(1))
+                for match in map(PID_PATTERN.match, os.listdir(self.journal_dir))
+                if match
+            }
+            for pid in sorted(pids):
+                lock_path = os.path.join(self.journal_dir, LOCK_FILE.format(pid=pid))
+                with open(lock_path, "a") as lock_file:
+                    try:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # The owner is still running
+                        continue
+                    path = os.path.join(self.journal_dir, JOURNAL_FILE.format(pid=pid))
+                    self._rotate_active_file(path)
+                    self._fold_rotated_files(path)
+                    for file_path in (path, lock_path):
+                        try:
+                            os.remove(file_path)
+                        except FileNotFoundError:
+                            pass
+
+    def _fold_rotated_files(self, path=None):
+        path = path or self._path
+        folded = 0
+        for file_path in sorted(glob.glob(f"{path}.*.compacting")):
+            latest = dict()
+            with open(file_path, "r", encoding="utf-8") as f:
+                for record in f:
+                    try:
+                        record = json.loads(record)
+                    except json.JSONDecodeError:
+                        # A torn write at the end of a crashed journal
+                        continue
+                    latest[(record["doc_id"], record["line_no"])] = (record["line"], record["ts"])
+            if latest:
+                # Decisions are stamped with the time of the edit, not of the fold
+                self.store.save_lines(
+                    [(doc_id, line_no, line, ts) for (doc_id, line_no), (line, ts) in latest.items()]
+                )
+            os.remove(file_path)
+            folded += len(latest)
+        if folded:
+            print(f"Compacted {folded} journaled line edits into the store.")
+        return folded
+
+    def _run(self):
+        last_compaction = time.time()
+        while not self._stop.wait(self.fsync_interval):
+            with self._lock:
+                self._fsync()
+            if time.time() - last_compaction >= self.compact_interval:
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"Error compacting review journal: {e}")
+                last_compaction = time.time()
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal() -> EditJournal:
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = EditJournal(get_store())
+            atexit.register(_journal.close)
+    return _journal
@@ -1,7 +1,7 @@
-import time
-from crewai import LLM
 import concurrent.futures
 
+from ner_annotator.entities import iter_entity_status
+from ner_annotator.tracing import current_context, span
 from ner_annotator.utils import format_llm_response
 from settings import MAX_CONCURRENT_REQUESTS
 from typing import List, Dict
@@ -272,7 +272,7 @@ def get_evaluation_data(tagged_data, sentence_chunk_size=SENTENCES_CHUNK, contex
         context = "\n".join([i['original'] for i in tagged_data[max(0, i-context_size):min(len(tagged_data), i+context_size)]])
         original = d['original']
         tagged = d['tagged']
-        entities = [v for k, v in d['entity_status'].items() if k != 'user_verified' and len(v) > 0]
+        entities = [v for _, v in iter_entity_status(d['entity_status']) if len(v) > 0]
         if not entities:
             continue
         all_sentences_data.append({
@@ -292,15 +292,18 @@ def get_evaluation_data(tagged_data, sentence_chunk_size=SENTENCES_CHUNK, contex
     return messages_chunks
 
 
-def query_llms(messages: List[Dict[str, str]], llm_names: List[str]) -> List[str]:
+def query_llms(messages: List[Dict[str, str]], llm_names: List[str], chunk_index: int = None, parent=None) -> List[str]:
+    # crewai is slow to import, so it is only loaded once a judgement is requested
+    from crewai import LLM
+
     responses = dict()
     for llm in list([LLM(llm_name, response_format=LLMJudgement) for llm_name in llm_names]):
         print(f"Querying {llm.model}...")
         try:
-            start_time = time.time()
-            resp = llm.call(messages)
-            print(f"Response time for {llm.model}: {time.time() - start_time:.2f} seconds")
-            responses[llm.model] = format_llm_response(resp)
+            with span("llm.call", parent=parent, stage="judging", model=llm.model, chunk_index=chunk_index):
+                resp = llm.call(messages)
+            with span("judging.parse", parent=parent, model=llm.model, chunk_index=chunk_index):
+                responses[llm.model] = format_llm_response(resp)
         except Exception as e:
             print(f"Error querying {llm.model}: {e}")
     
@@ -318,9 +321,10 @@ def judge_message_chunks(all_message_chunks: List[List[Dict[str, str]]], llm_nam
         Dict[str, List[str]]: Dictionary with LLM names as keys and their respective responses as values.
     """
     extracted_results = [None] * len(all_message_chunks)
+    parent = current_context()
     with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
         futures = {
-            executor.submit(query_llms, chunk, llm_names): idx
+            executor.submit(query_llms, chunk, llm_names, idx, parent): idx
             for idx, chunk in enumerate(all_message_chunks)
         }
 
@@ -361,7 +365,9 @@ def run_evaluation(
     # import time
     # time.sleep(5)
     # results = json.load(open('judge_responses.json'))
-    all_message_chunks = get_evaluation_data(data, sentence_chunk_size, context_size)
+    with span("judging.chunk", sentence_chunk_size=sentence_chunk_size, context_size=context_size) as chunk_span:
+        all_message_chunks = get_evaluation_data(data, sentence_chunk_size, context_size)
+        chunk_span.set_attribute("chunks", len(all_message_chunks))
     print("Total chunks:", len(all_message_chunks))
     results = judge_message_chunks(all_message_chunks, llm_names, tqdm=tqdm)
     return results
\ No newline at end of file
@@ -1,3 +1,4 @@
+import difflib
 import json
 import re
 from pydantic import BaseModel, Field
@@ -6,12 +7,22 @@ from ner_annotator.constants import (
     URDU_LETTERS_THRESHOLD,
     CHUNK_SIZE,
     MAX_CONCURRENT_REQUESTS,
+    PROMPT_TOKEN_BUDGET,
 )
 import enum
-from typing import Dict, List
-from crewai import LLM
+from typing import TYPE_CHECKING, Dict, List
 import concurrent.futures
 
+from ner_annotator.identity import document_id
+from ner_annotator.search import tokenize
+from ner_annotator.tracing import current_context, span
+
+if TYPE_CHECKING:
+    # crewai pulls in litellm, chromadb and opentelemetry; import it only when tagging
+    from crewai import LLM
+
+    from ner_annotator.few_shot import ExampleIndex
+
 
 class NERMode(enum.Enum):
     GENERAL = "general"
@@ -79,7 +90,7 @@ For example, below is the response for a text with a single line -
 
 """
 
-MARSIYA_NER_SYSTEM_PROMPT = """
+MARSIYA_NER_INSTRUCTIONS = """
 Perform Named Entity Recognition (NER) on the given Urdu Marsiya text with strict adherence to these categories and rules:
 
 ### Entity Categories:
@@ -115,7 +126,9 @@ You also need to provide the English translation of the original string in the o
 
 ### Output Format:
 Return a list with original string, string with tagged entities and its english translation. Make sure you return the output for each line without missing any line in the text:
-Example -- 
+"""
+
+MARSIYA_NER_STATIC_EXAMPLE = """Example -- 
 
 Input: 
 پنڈلیاں سوجی ہیں اور طوق سے چھلتا ہے گلا 
@@ -200,6 +213,8 @@ Output:
 }
 """
 
+MARSIYA_NER_SYSTEM_PROMPT = MARSIYA_NER_INSTRUCTIONS + MARSIYA_NER_STATIC_EXAMPLE
+
 
 def is_mostly_urdu(text: str, threshold=URDU_LETTERS_THRESHOLD) -> bool:
     """
@@ -234,37 +249,156 @@ def is_mostly_urdu(text: str, threshold=URDU_LETTERS_THRESHOLD) -> bool:
     return urdu_ratio >= threshold
 
 
-def get_ner_prompt_messages(text, mode=NERMode.MARSIYA) -> List[Dict[str, str]]:
+def get_user_prompt(text: str, translated_lines: List[str] = ()) -> str:
+    """
+    The translations of ``translated_lines`` are already known, so the model leaves them empty.
+    """
+    prompt = f"Provide the Named entities from the below Urdu text: \n\n{text}\n\n"
+    if translated_lines and len(translated_lines) == len(text.split("\n")):
+        prompt += 'The English translations of all lines are already known. Return an empty string as "english".\n\n'
+    elif translated_lines:
+        known = "\n".join(translated_lines)
+        prompt += (
+            "The English translations of the following lines are already known. "
+            f'Return an empty string as "english" for them: \n\n{known}\n\n'
+        )
+    return prompt
+
+
+def get_ner_prompt_messages(
+    text, mode=NERMode.MARSIYA, examples: str = None, translated_lines: List[str] = ()
+) -> List[Dict[str, str]]:
+    """
+    ``examples`` replaces the static example of the Marsiya prompt.
+    """
     if mode == NERMode.GENERAL:
         system_prompt = GENERAL_NER_SYSTEM_PROMPT
     elif mode == NERMode.MARSIYA:
-        system_prompt = MARSIYA_NER_SYSTEM_PROMPT
+        system_prompt = MARSIYA_NER_SYSTEM_PROMPT if examples is None else MARSIYA_NER_INSTRUCTIONS + examples
     else:
         raise ValueError("Invalid NER mode selected.")
     messages = [
         {"role": "system", "content": system_prompt},
         {
             "role": "user",
-            "content": f"Provide the Named entities from the below Urdu text: \n\n{text}\n\n",
+            "content": get_user_prompt(text, translated_lines),
         },
     ]
     return messages
 
 
 def get_ner_prompt_messages_per_chunk(
-    text: str, chunk_size=CHUNK_SIZE, mode=NERMode.MARSIYA
+    text: str,
+    chunk_size=CHUNK_SIZE,
+    mode=NERMode.MARSIYA,
+    example_index: "ExampleIndex" = None,
+    token_budget: int = PROMPT_TOKEN_BUDGET,
+    translated_lines: set = frozenset(),
 ) -> List[List[Dict[str, str]]]:
+    """
+    With an ``example_index``, the Marsiya prompt of every chunk uses the verified
+    lines most similar to the chunk as examples, within ``token_budget`` prompt tokens.
+    The model is asked not to translate the lines of a chunk that are in ``translated_lines``.
+    """
     lines = [line for line in text.split("\n") if is_mostly_urdu(line)]
     chunk_messages = list()
     for i in range(0, len(lines), chunk_size):
-        chunk = "\n".join(lines[i : i + chunk_size])
-        chunk_messages.append(get_ner_prompt_messages(chunk, mode))
+        chunk_lines = lines[i : i + chunk_size]
+        chunk = "\n".join(chunk_lines)
+        chunk_translated = [line for line in chunk_lines if line in translated_lines]
+        examples = None
+        if example_index is not None and mode == NERMode.MARSIYA:
+            from ner_annotator.few_shot import count_tokens, format_examples
+
+            budget = token_budget - count_tokens(MARSIYA_NER_INSTRUCTIONS) - count_tokens(get_user_prompt(chunk, chunk_translated))
+            selected = example_index.select_examples(chunk_lines, budget)
+            if selected:
+                examples = format_examples(selected)
+            elif count_tokens(MARSIYA_NER_STATIC_EXAMPLE) > budget:
+                # Without a fitting verified line the chunk keeps the static example, if that fits
+                examples = ""
+        chunk_messages.append(get_ner_prompt_messages(chunk, mode, examples, chunk_translated))
 
     return chunk_messages
 
 
+def split_urdu_stanzas(text: str):
+    """
+    The Urdu lines of ``text`` and its stanzas, as lists of indexes into those lines.
+    """
+    lines = list()
+    stanzas = [list()]
+    for line in text.split("\n"):
+        if not line.strip():
+            if stanzas[-1]:
+                stanzas.append(list())
+        elif is_mostly_urdu(line):
+            stanzas[-1].append(len(lines))
+            lines.append(line)
+    return lines, [stanza for stanza in stanzas if stanza]
+
+
+# Smallest similarity of a returned original to a sent line it is matched to out of order
+ELEMENT_MATCH_RATIO = 0.6
+
+
+def align_elements(lines: List[str], tagged_elements: List[dict]) -> Dict[int, dict]:
+    """
+    Match the elements the LLM returned to the ``lines`` they were sent for, as
+    ``{line index: element}``. Elements whose echoed original matches are aligned in
+    order; a stretch of mismatching elements (a rewritten, merged or dropped line) is
+    matched by position if it is as long as the stretch of lines it replaces, and
+    otherwise to the most similar of those lines.
+    """
+    line_keys = [" ".join(tokenize(line)) for line in lines]
+    element_keys = [" ".join(tokenize(element.get("original", ""))) for element in tagged_elements]
+    aligned = dict()
+    matcher = difflib.SequenceMatcher(None, line_keys, element_keys, autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == "equal" or (op == "replace" and i2 - i1 == j2 - j1):
+            aligned.update({i1 + k: tagged_elements[j1 + k] for k in range(i2 - i1)})
+        elif op == "replace":
+            unmatched = list(range(i1, i2))
+            for j in range(j1, j2):
+                ratio, i = max(
+                    ((difflib.SequenceMatcher(None, line_keys[i], element_keys[j]).ratio(), i) for i in unmatched),
+                    default=(0, None),
+                )
+                if ratio >= ELEMENT_MATCH_RATIO:
+                    aligned[i] = tagged_elements[j]
+                    unmatched.remove(i)
+    return aligned
+
+
+def merge_transferred(lines: List[str], transferred: Dict[int, dict], tagged_elements: List[dict]) -> List[dict]:
+    """
+    Put the transferred lines back between the tagged lines, in the order of the text.
+    The tagged elements are aligned to the lines they were sent for (see ``align_elements``),
+    since the LLM may drop or merge lines; elements that match no line are kept at the end.
+    """
+    if not transferred:
+        return tagged_elements
+    sent = [i for i in range(len(lines)) if i not in transferred]
+    aligned = {
+        sent[k]: element for k, element in align_elements([lines[i] for i in sent], tagged_elements).items()
+    }
+    merged = [
+        transferred[i] if i in transferred else aligned[i]
+        for i in range(len(lines))
+        if i in transferred or i in aligned
+    ]
+    aligned_ids = {id(element) for element in aligned.values()}
+    merged.extend(element for element in tagged_elements if id(element) not in aligned_ids)
+    return merged
+
+
+def call_llm(llm: "LLM", messages: List[Dict[str, str]], chunk_index: int, parent=None):
+    with span("llm.call", parent=parent, stage="tagging", model=llm.model, chunk_index=chunk_index):
+        return llm.call(messages)
+
+
 def extract_named_entites_from_chunks(
-    llm: LLM, chunks: List[List[Dict[str, str]]], tqdm=tqdm
+    llm: "LLM", chunks: List[List[Dict[str, str]]], tqdm=tqdm
 ) -> List[TaggedElement]:
     """
     Extract named entities from chunks of text using the specified NER mode.
@@ -276,12 +410,14 @@ def extract_named_entites_from_chunks(
         List[TaggedElement]: List of extracted named entities, in the same order as the input chunks.
     """
     extracted_results = [None] * len(chunks)
+    parent = current_context()
 
     with concurrent.futures.ThreadPoolExecutor(
         max_workers=MAX_CONCURRENT_REQUESTS
     ) as executor:
         futures = {
-            executor.submit(llm.call, chunk): idx for idx, chunk in enumerate(chunks)
+            executor.submit(call_llm, llm, chunk, idx, parent): idx
+            for idx, chunk in enumerate(chunks)
         }
 
         for future in tqdm(
@@ -309,15 +445,114 @@ def get_ner_tags(
     model_id: str = "openai/gpt-4o-mini",
     chunk_size: int = CHUNK_SIZE,
     tqdm=tqdm,
-) -> TaggedElements:
-    chunked_messages = get_ner_prompt_messages_per_chunk(text, chunk_size, mode)
+    llm: "LLM" = None,
+    few_shot: bool = True,
+    reuse_reviewed: bool = True,
+    translation_memory: bool = True,
+    doc_id: str = None,
+) -> List[dict]:
+    """
+    Tag ``text`` chunk by chunk. ``llm`` replaces the model built from ``model_id``,
+    e.g. the local stub used by the load test. With ``few_shot``, the examples of
+    the prompts are retrieved from verified lines once there are any. With
+    ``reuse_reviewed``, near-duplicates of reviewed lines get the reviewed tags
+    and are not sent to the LLM. With ``translation_memory``, the LLM only
+    translates the lines whose translation is not remembered yet. ``doc_id`` is
+    the id of ``text``, computed from it if not given.
+    """
+    doc_id = doc_id or document_id(text)
+    lines, stanzas = split_urdu_stanzas(text)
+    transferred = dict()
+    if reuse_reviewed:
+        with span("tagging.transfer", lines=len(lines)) as transfer_span:
+            try:
+                from ner_annotator.near_duplicates import get_near_duplicate_index
+
+                transferred = get_near_duplicate_index().transfer_annotations(lines, stanzas)
+            except Exception as e:
+                print(f"Error transferring reviewed annotations: {e}")
+            transfer_span.set_attribute("transferred", len(transferred))
+        if transferred:
+            print(f"Reused the reviewed tags of {len(transferred)} of {len(lines)} lines.")
+            text = "\n".join(line for i, line in enumerate(lines) if i not in transferred)
+
+    remaining = [line for i, line in enumerate(lines) if i not in transferred]
+    memory = None
+    # index into remaining -> {"english", "match", "similarity"}
+    found = dict()
+    if translation_memory and remaining:
+        with span("tagging.translation_memory", lines=len(remaining)) as memory_span:
+            try:
+                from ner_annotator.translation_memory import get_translation_memory
+
+                memory = get_translation_memory()
+                found = memory.lookup(remaining)
+                exact = sum(hit["match"] == "exact" for hit in found.values())
+                fuzzy = len(found) - exact
+                memory_span.set_attribute("exact", exact)
+                memory_span.set_attribute("fuzzy", fuzzy)
+                print(
+                    f"Translation memory: {exact} exact and {fuzzy} fuzzy matches of {len(remaining)} lines "
+                    f"({len(found) / len(remaining):.1%} reused)."
+                )
+            except Exception as e:
+                memory, found = None, dict()
+                print(f"Error looking up the translation memory: {e}")
+    translated_lines = {remaining[i] for i in found}
+
+    with span("tagging.chunk", model=model_id, chunk_size=chunk_size) as chunk_span:
+        example_index = None
+        if few_shot and mode == NERMode.MARSIYA:
+            from ner_annotator.few_shot import get_example_index
+
+            example_index = get_example_index()
+        chunked_messages = get_ner_prompt_messages_per_chunk(
+            text, chunk_size, mode, example_index=example_index, translated_lines=translated_lines
+        )
+        chunk_span.set_attribute("chunks", len(chunked_messages))
+        if example_index is not None:
+            from ner_annotator.few_shot import count_message_tokens
+
+            static_tokens = sum(
+                count_message_tokens(m)
+                for m in get_ner_prompt_messages_per_chunk(text, chunk_size, mode, translated_lines=translated_lines)
+            )
+            prompt_tokens = sum(count_message_tokens(m) for m in chunked_messages)
+            chunk_span.set_attribute("prompt_tokens", prompt_tokens)
+            chunk_span.set_attribute("static_prompt_tokens", static_tokens)
+            print(
+                f"Prompt input tokens: {prompt_tokens} with retrieved examples, "
+                f"{static_tokens} with the static example ({1 - prompt_tokens / max(static_tokens, 1):.1%} fewer)."
+            )
     print("Using model:", model_id)
     print("Using chunk size:", chunk_size)
     print("Number of chunks:", len(chunked_messages))
 
-    # with open('uploads/1ce96d97cfd6ebebe655bb60aabf1022.json') as f:
-    #     return json.load(f)['tagged_elements']
+    if not chunked_messages:
+        return merge_transferred(lines, transferred, [])
+
+    if llm is None:
+        from crewai import LLM
 
-    llm = LLM(model=model_id, response_format=TaggedElements)
+        llm = LLM(model=model_id, response_format=TaggedElements)
     responses = extract_named_entites_from_chunks(llm, chunked_messages, tqdm=tqdm)
-    return sum([json.loads(r)["tagged_elements"] for r in responses], [])
+    with span("tagging.parse", model=model_id, responses=len(responses)):
+        tagged_elements = sum([json.loads(r)["tagged_elements"] for r in responses], [])
+    if memory is not None:
+        # The echoed originals may differ from the sent lines, so the lines are matched first
+        aligned = align_elements(remaining, tagged_elements)
+        translated = list()
+        for i, element in aligned.items():
+            if i in found:
+                element["english"] = found[i]["english"]
+            else:
+                translated.append((remaining[i], element.get("english")))
+        missed = sum(i not in aligned for i in found)
+        if missed:
+            print(f"Translation memory: {missed} remembered translations matched no returned line.")
+        try:
+            memory.remember(translated)
+            memory.store.record_translation_run(doc_id, len(remaining), exact, fuzzy, missed)
+        except Exception as e:
+            print(f"Error saving translations to the translation memory: {e}")
+    return merge_transferred(lines, transferred, tagged_elements)
@@ -0,0 +1,368 @@
+"""
+Load test of the Streamlit app with simulated concurrent annotators.
+
+``python -m ner_annotator.loadtest --users 1,4,8`` (run from the repository
+root, like the app) drives the app headlessly with Streamlit's ``AppTest``.
+Every simulated annotator logs in with an account from ``authentication.yaml``,
+opens a tagged document on the review page, then steps through its lines,
+verifies and corrects tags and exports the review data. The sessions run as
+threads of one process, so they share the document cache, store and indexes
+like the sessions of one server instance.
+
+The run never touches the real annotations: unless ``NER_UPLOAD_DIR`` is set,
+it points the upload directory, and with it the annotation store, the review
+journal and the indexes, at a fresh temporary directory before anything is
+imported. The documents are stored there and tagged beforehand by a local
+stub LLM that tags a small gazetteer, so no model provider is called. The report lists latency
+percentiles per interaction and the memory growth per session for each
+number of users, and the capacity: the largest number of users whose p95
+latencies all stay under ``--target-p95``. The exit status is 1 if any level
+misses the target, which makes the run usable as a regression guard.
+"""
+import argparse
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+# Before ner_annotator.constants is imported, which reads the upload directory once
+if __name__ == "__main__" and not os.getenv("NER_UPLOAD_DIR"):
+    os.environ["NER_UPLOAD_DIR"] = tempfile.mkdtemp(prefix="ner-loadtest-")
+
+from ner_annotator.constants import DATASET_DIR, UPLOAD_DIR
+from ner_annotator.corpus import load_corpus_index
+from ner_annotator.documents import get_document_cache
+from ner_annotator.identity import document_id
+from ner_annotator.llm_tagger import get_ner_tags
+from ner_annotator.profiling import PERCENTILES, percentile
+from ner_annotator.utils import save_ner_tags, save_text_with_hash
+from settings import auth_file
+
+
+APP_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+REVIEW_PAGE = "app_pages/reviewing.py"
+PASSWORD_ENV = "NER_LOADTEST_PASSWORD"
+STUB_MODEL_ID = "stub/gazetteer"
+STUB_GAZETTEER = {
+    "حسین": "PERSON",
+    "عباس": "PERSON",
+    "زینب": "PERSON",
+    "اکبر": "PERSON",
+    "کربلا": "LOCATION",
+    "فرات": "LOCATION",
+    "مدینہ": "LOCATION",
+    "محرم": "DATE",
+    "عاشور": "DATE",
+}
+CORRECTION_TAGS = ["PERSON", "LOCATION", "DESIGNATION"]
+
+
+class StubLLM:
+    """
+    Stand-in for ``crewai.LLM`` that tags the words of ``STUB_GAZETTEER`` after
+    an optional delay, returning the same JSON as the tagging prompt asks for.
+    """
+
+    def __init__(self, model: str = STUB_MODEL_ID, latency: float = 0.0):
+        self.model = model
+        self.latency = latency
+        self._pattern = re.compile("|".join(map(re.escape, STUB_GAZETTEER)))
+
+    def call(self, messages) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        text = messages[-1]["content"].split("\n\n", 1)[1].strip()
+        return json.dumps({
+            "tagged_elements": [
+                {
+                    "original": line,
+                    "tagged": self._pattern.sub(
+                        lambda m: f"<{STUB_GAZETTEER[m.group(0)]}>{m.group(0)}</{STUB_GAZETTEER[m.group(0)]}>",
+                        line,
+                    ),
+                    "english": "",
+                }
+                for line in text.split("\n")
+            ]
+        }, ensure_ascii=False)
+
+
+def prepare_documents(count: int, llm: StubLLM) -> list:
+    """
+    Store and tag the first ``count`` corpus files the way "Tag this file" in the
+    search tab does, keyed by the raw file content.
+    """
+    corpus_index = load_corpus_index(DATASET_DIR)
+    doc_ids = list()
+    for name in sorted(corpus_index.names())[:count]:
+        text = corpus_index.read(name)
+        doc_id = document_id(text)
+        data = save_text_with_hash(doc_id, text, name)
+        if not data.get("tagged"):
+            # The few-shot index lives outside the upload directory, so leave it alone
+            save_ner_tags(doc_id, get_ner_tags(text, model_id=llm.model, llm=llm, few_shot=False, doc_id=doc_id))
+            print(f"Tagged {name} with the stub LLM.")
+        doc_ids.append(doc_id)
+    return doc_ids
+
+
+def load_accounts(path: str = auth_file) -> list:
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    return [
+        {"username": username, "name": account.get("name", username), "roles": account.get("roles") or []}
+        for username, account in config["credentials"]["usernames"].items()
+    ]
+
+
+def get_rss_bytes() -> int:
+    import psutil
+
+    return psutil.Process().memory_info().rss
+
+
+class LatencyRecorder:
+    def __init__(self):
+        # interaction -> seconds
+        self.samples = defaultdict(list)
+        self.errors = list()
+        self._lock = threading.Lock()
+
+    def record(self, interaction: str, seconds: float):
+        with self._lock:
+            self.samples[interaction].append(seconds)
+
+    def error(self, interaction: str, message: str):
+        with self._lock:
+            self.errors.append(f"{interaction}: {message}")
+
+    def summary(self) -> dict:
+        with self._lock:
+            snapshot = {name: sorted(samples) for name, samples in self.samples.items()}
+        summary = dict()
+        for name, samples in snapshot.items():
+            row = {"count": len(samples)}
+            for q in PERCENTILES:
+                row[f"p{q}"] = percentile(samples, q)
+            row["max"] = samples[-1]
+            summary[name] = row
+        return summary
+
+
+class SimulatedAnnotator:
+    def __init__(self, account: dict, doc_id: str, recorder: LatencyRecorder, password: str = None, timeout: float = 30):
+        from streamlit.testing.v1 import AppTest
+
+        self.account = account
+        self.doc_id = doc_id
+        self.recorder = recorder
+        self.password = password
+        self.at = AppTest.from_file(APP_SCRIPT, default_timeout=timeout)
+
+    def _run(self, interaction: str, action=None):
+        start_time = time.perf_counter()
+        try:
+            if action is not None:
+                action()
+            self.at.run()
+        except Exception as e:
+            self.recorder.error(interaction, f"{type(e).__name__}: {e}")
+            return False
+        self.recorder.record(interaction, time.perf_counter() - start_time)
+        for exception in self.at.exception:
+            self.recorder.error(interaction, exception.message)
+        return True
+
+    def _widget(self, kind: str, key: str):
+        try:
+            return getattr(self.at, kind)(key=key)
+        except KeyError:
+            return None
+
+    def _button(self, label: str):
+        return next((b for b in self.at.button if b.label == label), None)
+
+    def login(self):
+        session_state = self.at.session_state
+        if self.password is None:
+            # Skip the login form, as if the session had a valid auth cookie
+            session_state["authentication_status"] = True
+            session_state["username"] = self.account["username"]
+            session_state["name"] = self.account["name"]
+            session_state["roles"] = self.account["roles"]
+            return self._run("login")
+
+        self._run("login_form")
+
+        def fill_in():
+            next(w for w in self.at.text_input if w.label == "Username").input(self.account["username"])
+            next(w for w in self.at.text_input if w.label == "Password").input(self.password)
+            self._button("Login").click()
+
+        return self._run("login", fill_in)
+
+    def open_document(self):
+        session_state = self.at.session_state
+        session_state["all_hashes"] = [self.doc_id]
+        session_state["current_hash"] = self.doc_id
+        session_state["selected_model_id"] = STUB_MODEL_ID
+        return self._run("open_document", lambda: self.at.switch_page(REVIEW_PAGE))
+
+    def next_line(self):
+        line = self._widget("number_input", "current_line")
+        if line is None:
+            return self.recorder.error("next_line", "line selector not rendered")
+        if line.max_value is not None and line.value >= line.max_value:
+            return self._run("next_line", lambda: line.set_value(1))
+        return self._run("next_line", line.increment)
+
+    def verify_line(self):
+        button = self._widget("button", "save_tags")
+        if button is not None:
+            self._run("verify_line", button.click)
+
+    def correct_tag(self):
+        correct = self._widget("radio", "correct_0")
+        if correct is None:
+            return
+        if not self._run("correct_tag_open", lambda: correct.set_value("No")):
+            return
+        new_tag = self._widget("selectbox", "newtag_0")
+        update = self._widget("button", "btn_update_0")
+        if new_tag is None or update is None:
+            return
+        tag = next((t for t in CORRECTION_TAGS if t not in correct.label), CORRECTION_TAGS[0])
+
+        def retag():
+            new_tag.set_value(tag)
+            update.click()
+
+        self._run("correct_tag", retag)
+
+    def export(self):
+        session_state = self.at.session_state
+        if "ner_data" in session_state:
+            del session_state["ner_data"]
+            self.at.run()
+        button = self._button("Generate Review Data")
+        if button is None:
+            return self.recorder.error("export", "export button not rendered")
+        self._run("export", button.click)
+
+    def simulate(self, iterations: int, export_every: int):
+        if not self.login() or not self.open_document():
+            return
+        for i in range(1, iterations + 1):
+            self.next_line()
+            self.verify_line()
+            if i % 3 == 0:
+                self.correct_tag()
+            if export_every and i % export_every == 0:
+                self.export()
+
+
+def run_load_test(
+    users: int,
+    doc_ids: list,
+    iterations: int = 20,
+    password: str = None,
+    timeout: float = 30,
+    export_every: int = 10,
+) -> dict:
+    accounts = load_accounts()
+    recorder = LatencyRecorder()
+    rss_before = get_rss_bytes()
+    start_time = time.perf_counter()
+
+    def simulate(i):
+        annotator = SimulatedAnnotator(
+            accounts[i % len(accounts)], doc_ids[i % len(doc_ids)], recorder, password, timeout
+        )
+        annotator.simulate(iterations, export_every)
+        return annotator
+
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        # Keep the sessions alive until the memory is measured
+        annotators = list(executor.map(simulate, range(users)))
+    wall_seconds = time.perf_counter() - start_time
+    rss_after = get_rss_bytes()
+    interactions = recorder.summary()
+    report = {
+        "users": users,
+        "wall_seconds": wall_seconds,
+        "interactions_per_second": sum(r["count"] for r in interactions.values()) / wall_seconds,
+        "interactions": interactions,
+        "errors": recorder.errors,
+        "rss_before_mb": rss_before / 2**20,
+        "rss_after_mb": rss_after / 2**20,
+        "memory_per_session_mb": (rss_after - rss_before) / 2**20 / users,
+        "document_cache_mb": get_document_cache().total_bytes / 2**20,
+    }
+    return report
+
+
+def print_report(report: dict, target_p95: float):
+    print(
+        f"\n{report['users']} users: {report['wall_seconds']:.1f}s, "
+        f"{report['interactions_per_second']:.1f} interactions/s, "
+        f"{report['memory_per_session_mb']:.1f} MB per session "
+        f"(RSS {report['rss_before_mb']:.0f} -> {report['rss_after_mb']:.0f} MB, "
+        f"document cache {report['document_cache_mb']:.1f} MB)"
+    )
+    print(f"  {'interaction':<18}{'count':>7}" + "".join(f"{f'p{q}':>9}" for q in PERCENTILES) + f"{'max':>9}")
+    for name, row in sorted(report["interactions"].items()):
+        flag = "  !" if row["p95"] > target_p95 else ""
+        print(
+            f"  {name:<18}{row['count']:>7}"
+            + "".join(f"{row[f'p{q}']:>9.3f}" for q in PERCENTILES)
+            + f"{row['max']:>9.3f}{flag}"
+        )
+    if report["errors"]:
+        print(f"  {len(report['errors'])} errors, e.g. {report['errors'][0]}")
+
+
+def meets_target(report: dict, target_p95: float) -> bool:
+    return not report["errors"] and all(
+        row["p95"] <= target_p95 for row in report["interactions"].values()
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate concurrent annotators on the review page.")
+    parser.add_argument("--users", default="1,2,4,8", help="Comma separated numbers of concurrent users.")
+    parser.add_argument("--iterations", type=int, default=20, help="Lines each user steps through.")
+    parser.add_argument("--documents", type=int, default=3, help="Documents the users are spread over.")
+    parser.add_argument("--export-every", type=int, default=10, help="Export after this many lines, 0 to skip.")
+    parser.add_argument("--password", default=os.getenv(PASSWORD_ENV),
+                        help=f"Log in through the form with this password (default ${PASSWORD_ENV}); "
+                             "without it the sessions start logged in.")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds the stub LLM waits per chunk.")
+    parser.add_argument("--timeout", type=float, default=30, help="Timeout of a single script run.")
+    parser.add_argument("--target-p95", type=float, default=1.0, help="Seconds every interaction p95 must stay under.")
+    parser.add_argument("--output", help="Write the reports as JSON to this file.")
+    args = parser.parse_args()
+
+    print(f"Using the scratch upload directory {UPLOAD_DIR}.")
+    doc_ids = prepare_documents(args.documents, StubLLM(latency=args.llm_latency))
+    reports = list()
+    capacity = 0
+    for users in [int(n) for n in args.users.split(",")]:
+        report = run_load_test(
+            users, doc_ids, args.iterations, args.password, args.timeout, args.export_every
+        )
+        reports.append(report)
+        print_report(report, args.target_p95)
+        if meets_target(report, args.target_p95):
+            capacity = max(capacity, users)
+    print(f"\nCapacity: {capacity} concurrent users with every p95 under {args.target_p95:.2f}s.")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"target_p95": args.target_p95, "capacity": capacity, "reports": reports}, f, indent=2)
+    raise SystemExit(0 if all(meets_target(r, args.target_p95) for r in reports) else 1)
@@ -0,0 +1,280 @@
+"""
+Review metrics derived from a single label confusion matrix.
+
+The matrix is built once per document from the verified entities; micro, macro,
+weighted and per-type scores are all derived from it, and statistics across
+files are computed by adding the matrices of the individual documents.
+"""
+from collections import Counter
+
+import numpy as np
+
+from ner_annotator.entities import iter_entity_status
+
+
+class ConfusionMatrix:
+    """
+    Square count matrix with true labels as rows and predicted labels as columns.
+    Labels are added on first use, so matrices of different documents can be merged.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = list()
+        self.index = dict()
+        self.matrix = np.zeros((0, 0), dtype=np.int64)
+        for label in labels or []:
+            self._label_index(label)
+
+    def _label_index(self, label):
+        if label not in self.index:
+            self.index[label] = len(self.labels)
+            self.labels.append(label)
+            size = len(self.labels)
+            matrix = np.zeros((size, size), dtype=np.int64)
+            matrix[: size - 1, : size - 1] = self.matrix
+            self.matrix = matrix
+        return self.index[label]
+
+    def add(self, y_true, y_pred, count=1):
+        i, j = self._label_index(y_true), self._label_index(y_pred)
+        self.matrix[i, j] += count
+
+    def update(self, y_true, y_pred):
+        for t, p in zip(y_true, y_pred):
+            self.add(t, p)
+        return self
+
+    def total(self):
+        return int(self.matrix.sum())
+
+    def copy(self):
+        other = ConfusionMatrix(self.labels)
+        other.matrix = self.matrix.copy()
+        return other
+
+    def merge(self, other: "ConfusionMatrix", sign=1):
+        for label in other.labels:
+            self._label_index(label)
+        idx = np.array([self.index[label] for label in other.labels], dtype=np.intp)
+        if len(idx):
+            self.matrix[np.ix_(idx, idx)] += sign * other.matrix
+        return self
+
+    def __iadd__(self, other: "ConfusionMatrix"):
+        return self.merge(other)
+
+    def __isub__(self, other: "ConfusionMatrix"):
+        return self.merge(other, sign=-1)
+
+    def __add__(self, other: "ConfusionMatrix"):
+        result = self.copy()
+        result += other
+        return result
+
+    def counts(self, labels):
+        """
+        True positives, predicted counts and true counts (support) for ``labels``.
+        """
+        tp, predicted, support = (np.zeros(len(labels), dtype=np.int64) for _ in range(3))
+        col_sums = self.matrix.sum(axis=0)
+        row_sums = self.matrix.sum(axis=1)
+        for i, label in enumerate(labels):
+            j = self.index.get(label)
+            if j is None:
+                continue
+            tp[i] = self.matrix[j, j]
+            predicted[i] = col_sums[j]
+            support[i] = row_sums[j]
+        return tp, predicted, support
+
+    def balanced_accuracy(self):
+        row_sums = self.matrix.sum(axis=1)
+        present = row_sums > 0
+        if not present.any():
+            return 0.0
+        recalls = np.diag(self.matrix)[present] / row_sums[present]
+        return float(recalls.mean())
+
+
+def _safe_divide(numerator, denominator):
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(
+        numerator, denominator,
+        out=np.zeros_like(numerator), where=denominator != 0,
+    )
+
+
+def get_classification_metrics(confusion_matrix: ConfusionMatrix, labels):
+    if len(labels) == 0 or confusion_matrix.total() == 0:
+        return {
+            "micro_scores": None,
+            "macro_scores": None,
+            "weighted_scores": None,
+            "df_per_type": None,
+        }
+
+    tp, predicted, support = confusion_matrix.counts(labels)
+    precisions = _safe_divide(tp, predicted)
+    recalls = _safe_divide(tp, support)
+    f1s = _safe_divide(2 * tp, predicted + support)
+
+    micro = {
+        'precision': float(_safe_divide(tp.sum(), predicted.sum())),
+        'recall':    float(_safe_divide(tp.sum(), support.sum())),
+        'f1':        float(_safe_divide(2 * tp.sum(), predicted.sum() + support.sum())),
+    }
+    macro = {
+        'precision': float(precisions.mean()),
+        'recall':    float(recalls.mean()),
+        'f1':        float(f1s.mean()),
+    }
+    weights = _safe_divide(support, support.sum())
+    weighted = {
+        'precision': float((precisions * weights).sum()),
+        'recall':    float((recalls * weights).sum()),
+        'f1':        float((f1s * weights).sum()),
+    }
+
+    import pandas as pd
+
+    df_per_type = pd.DataFrame({
+        'precision': precisions,
+        'recall':    recalls,
+        'f1-score':  f1s,
+        'support':   support,
+    }, index=labels)
+
+    return {
+        "micro_scores": micro,
+        "macro_scores": macro,
+        "weighted_scores": weighted,
+        "df_per_type": df_per_type,
+    }
+
+
+def get_review_counts(tagged_data_elements):
+    """
+    Entity counts and the confusion matrix of verified entities for one document.
+    The user correction is the true label and the LLM tag the prediction.
+    """
+    total_entities = 0
+    total_verified = 0
+    per_category_count = Counter()
+    confusion_matrix = ConfusionMatrix()
+    for element in tagged_data_elements:
+        entity_status = element.get('entity_status', {})
+        verified = entity_status.get('user_verified', False)
+        for _, status in iter_entity_status(entity_status):
+            total_entities += 1
+            final_tag = status['user_updated'] if status['user_updated'] else status['tag']
+            if final_tag is not None:
+                per_category_count[final_tag] += 1
+            if verified:
+                total_verified += 1
+                y_true = status['tag'] if status['user_updated'] is None else status['user_updated']
+                confusion_matrix.add(y_true, status['tag'])
+
+    return {
+        'total_entities': total_entities,
+        'per_category_count': per_category_count,
+        'total_verified': total_verified,
+        'confusion_matrix': confusion_matrix,
+    }
+
+
+def empty_review_counts():
+    return {
+        'total_entities': 0,
+        'per_category_count': Counter(),
+        'total_verified': 0,
+        'confusion_matrix': ConfusionMatrix(),
+    }
+
+
+def add_review_counts(target, counts, sign=1):
+    """
+    Add (or with ``sign=-1`` subtract) ``counts`` into ``target`` in place.
+    """
+    target['total_entities'] += sign * counts['total_entities']
+    target['total_verified'] += sign * counts['total_verified']
+    if sign > 0:
+        target['per_category_count'].update(counts['per_category_count'])
+    else:
+        target['per_category_count'].subtract(counts['per_category_count'])
+    target['confusion_matrix'].merge(counts['confusion_matrix'], sign=sign)
+    return target
+
+
+def merge_review_counts(all_counts):
+    merged = empty_review_counts()
+    for counts in all_counts:
+        add_review_counts(merged, counts)
+    return merged
+
+
+class ReviewStatsAccumulator:
+    """
+    Running review counts of one document, kept per line so that an edit only
+    costs the difference between the old and the new state of the edited line.
+    """
+
+    def __init__(self, tagged_data_elements):
+        self.line_counts = [get_review_counts([element]) for element in tagged_data_elements]
+        self.counts = merge_review_counts(self.line_counts)
+        # Incremented on every edit, so totals over documents can tell what changed
+        self.version = 0
+
+    def update_line(self, line_no, element):
+        """
+        Re-count a single line. Returns the previous and the new counts of the line
+        so that aggregates over several documents can apply the same delta.
+        """
+        old = self.line_counts[line_no]
+        new = get_review_counts([element])
+        add_review_counts(self.counts, old, sign=-1)
+        add_review_counts(self.counts, new)
+        self.line_counts[line_no] = new
+        self.version += 1
+        return old, new
+
+
+class ReviewStatsTotal:
+    """
+    Running review counts summed over several documents. A document's counts are
+    added once and then only re-applied, as a delta, when its accumulator changed.
+    """
+
+    def __init__(self):
+        self.counts = empty_review_counts()
+        # doc_id -> (accumulator, version, counts added to the total)
+        self._added = dict()
+
+    def refresh(self, accumulators):
+        """
+        Bring the total up to date with ``(doc_id, accumulator)`` pairs and return its counts.
+        """
+        for doc_id, accumulator in accumulators:
+            added = self._added.get(doc_id)
+            if added is not None and added[0] is accumulator and added[1] == accumulator.version:
+                continue
+            if added is not None:
+                add_review_counts(self.counts, added[2], sign=-1)
+            snapshot = add_review_counts(empty_review_counts(), accumulator.counts)
+            add_review_counts(self.counts, snapshot)
+            self._added[doc_id] = (accumulator, accumulator.version, snapshot)
+        return self.counts
+
+
+def summarize_review_counts(counts):
+    """
+    Statistics shown in the review page, computed from (possibly merged) review counts.
+    """
+    per_category_count = {k: v for k, v in counts['per_category_count'].items() if v > 0}
+    labels = list(per_category_count.keys())
+    return {
+        'total_entities': counts['total_entities'],
+        'per_category_count': per_category_count,
+        'total_verified': counts['total_verified'],
+        **get_classification_metrics(counts['confusion_matrix'], labels),
+    }
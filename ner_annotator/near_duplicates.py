@@ -0,0 +1,424 @@
+"""
+Near-duplicate detection of reviewed lines and stanzas with MinHash and LSH.
+
+Many Marsiyas share stanzas that differ only in orthography or in a word or
+two. Every reviewed line, and every stanza (block of lines between blank lines)
+with at least two reviewed lines, gets a MinHash signature of the ``mmh3``
+hashes of its character 4-grams, computed over the normalised tokens (see
+``search.normalize_urdu``). Signatures are banded into an LSH table, so the
+candidates of a query are found without comparing against every line, and
+are then confirmed by the Jaccard similarity of their shingles.
+
+When a text is tagged, a stanza that nearly duplicates a reviewed stanza is
+matched line by line, and other lines are looked up on their own. The
+reviewed spans of a match are transferred onto the new line by a character
+alignment, snapped to word boundaries, and the line skips the LLM. A line is
+only transferred if every one of its spans maps onto a similar word.
+
+``python -m ner_annotator.near_duplicates evaluate`` measures the precision
+and recall of the transfer by tagging every reviewed document from the other
+reviewed documents and comparing with its reviewed spans.
+"""
+import argparse
+import difflib
+import json
+import os
+import threading
+from array import array
+from collections import defaultdict
+
+import mmh3
+import numpy as np
+
+from ner_annotator.constants import (
+    NEAR_DUPLICATE_INDEX_PATH,
+    NEAR_DUPLICATE_PERMUTATIONS,
+    NEAR_DUPLICATE_BANDS,
+    NEAR_DUPLICATE_THRESHOLD,
+    NEAR_DUPLICATE_MIN_TOKENS,
+)
+from ner_annotator.entities import TaggedLine
+from ner_annotator.index_file import read_index_file, write_index_file
+from ner_annotator.search import normalize_urdu, tokenize
+from ner_annotator.store import AnnotationStore, get_store
+
+
+INDEX_VERSION = 2
+INDEX_MAGIC = b"NERNDUP"
+SHINGLE_SIZE = 4
+# Smallest prime above 2**32, so (a * x + b) with a, b, x < 2**32 fits in uint64
+MINHASH_PRIME = np.uint64(4294967311)
+ENTITY_MATCH_RATIO = 0.75
+
+_rng = np.random.default_rng(20240501)
+MINHASH_A = _rng.integers(1, 2**32, NEAR_DUPLICATE_PERMUTATIONS, dtype=np.uint64)
+MINHASH_B = _rng.integers(0, 2**32, NEAR_DUPLICATE_PERMUTATIONS, dtype=np.uint64)
+
+
+def shingles(text: str) -> set:
+    normalized = " ".join(tokenize(text))
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def minhash(shingle_set: set) -> np.ndarray:
+    hashes = np.array([mmh3.hash(s, signed=False) for s in shingle_set], dtype=np.uint64)
+    return ((np.outer(MINHASH_A, hashes) + MINHASH_B[:, None]) % MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def band_keys(signature: np.ndarray) -> list:
+    rows = len(signature) // NEAR_DUPLICATE_BANDS
+    return [
+        (band, signature[band * rows:(band + 1) * rows].tobytes())
+        for band in range(NEAR_DUPLICATE_BANDS)
+    ]
+
+
+def _map_position(opcodes, position: int) -> int:
+    for op, i1, i2, j1, j2 in opcodes:
+        if i1 <= position < i2:
+            if op == "equal":
+                return j1 + position - i1
+            # Differing region, e.g. another spelling: map proportionally
+            return j1 + round((position - i1) * (j2 - j1) / (i2 - i1))
+    return opcodes[-1][4] if opcodes else position
+
+
+def transfer_spans(source: TaggedLine, target_text: str):
+    """
+    Spans of ``source`` mapped onto ``target_text``, or None if a span has no
+    similar counterpart in the target.
+    """
+    opcodes = difflib.SequenceMatcher(None, source.text, target_text, autojunk=False).get_opcodes()
+    target = TaggedLine(target_text)
+    for start, end, tag, entity in source.spans:
+        new_start = _map_position(opcodes, start)
+        new_end = _map_position(opcodes, end - 1) + 1
+        # Entities are whole words
+        while new_start < len(target_text) and target_text[new_start].isspace():
+            new_start += 1
+        while new_start > 0 and not target_text[new_start - 1].isspace():
+            new_start -= 1
+        while new_end > new_start and target_text[new_end - 1].isspace():
+            new_end -= 1
+        while new_end < len(target_text) and not target_text[new_end].isspace():
+            new_end += 1
+        if new_end <= new_start:
+            return None
+        ratio = difflib.SequenceMatcher(
+            None, normalize_urdu(entity), normalize_urdu(target_text[new_start:new_end])
+        ).ratio()
+        if ratio < ENTITY_MATCH_RATIO:
+            return None
+        try:
+            target.add(new_start, new_end, tag)
+        except ValueError:
+            return None
+    return target
+
+
+class NearDuplicateIndex:
+    def __init__(self, path: str = NEAR_DUPLICATE_INDEX_PATH):
+        self.path = path
+        # (doc_id, line_no) -> {"text", "spans", "english", "shingles", "signature"}
+        self.lines = dict()
+        # (doc_id, stanza_no) -> {"line_nos", "shingles", "signature"}
+        self.stanzas = dict()
+        # (band, key bytes) -> set of ("line" | "stanza", entry key)
+        self.buckets = defaultdict(set)
+        self.synced_at = 0
+        self._lock = threading.RLock()
+        self._dirty = False
+
+    # ─── persistence ────────────────────────────────────────────────────────
+
+    @classmethod
+    def load(cls, path: str = NEAR_DUPLICATE_INDEX_PATH) -> "NearDuplicateIndex":
+        index = cls(path)
+        if not os.path.exists(path):
+            return index
+        loaded = read_index_file(path, INDEX_MAGIC, INDEX_VERSION)
+        if loaded is None:
+            print("Near-duplicate index version changed, rebuilding.")
+            return index
+        header, (line_signatures, stanza_signatures) = loaded
+        index.synced_at = header["synced_at"]
+        line_signatures = np.frombuffer(line_signatures, dtype=np.uint32).reshape(-1, NEAR_DUPLICATE_PERMUTATIONS)
+        for (doc_id, line_no, text, spans, english, shingle_list), signature in zip(header["lines"], line_signatures):
+            index._add("line", (doc_id, line_no), {
+                "text": text,
+                "spans": spans,
+                "english": english,
+                "shingles": set(shingle_list),
+                "signature": signature,
+            }, index.lines)
+        stanza_signatures = np.frombuffer(stanza_signatures, dtype=np.uint32).reshape(-1, NEAR_DUPLICATE_PERMUTATIONS)
+        for (doc_id, stanza_no, line_nos, shingle_list), signature in zip(header["stanzas"], stanza_signatures):
+            index._add("stanza", (doc_id, stanza_no), {
+                "line_nos": line_nos,
+                "shingles": set(shingle_list),
+                "signature": signature,
+            }, index.stanzas)
+        index._dirty = False
+        return index
+
+    def save(self):
+        """
+        Write the entries as the header and their MinHash signatures as two raw
+        ``array('I')`` buffers, one row of ``NEAR_DUPLICATE_PERMUTATIONS`` per entry.
+        """
+        with self._lock:
+            line_signatures = array("I")
+            lines = list()
+            for (doc_id, line_no), entry in self.lines.items():
+                lines.append([doc_id, line_no, entry["text"], entry["spans"], entry["english"], sorted(entry["shingles"])])
+                line_signatures.frombytes(entry["signature"].tobytes())
+            stanza_signatures = array("I")
+            stanzas = list()
+            for (doc_id, stanza_no), entry in self.stanzas.items():
+                stanzas.append([doc_id, stanza_no, entry["line_nos"], sorted(entry["shingles"])])
+                stanza_signatures.frombytes(entry["signature"].tobytes())
+            write_index_file(
+                self.path, INDEX_MAGIC, INDEX_VERSION,
+                {"synced_at": self.synced_at, "lines": lines, "stanzas": stanzas},
+                [line_signatures, stanza_signatures],
+            )
+            self._dirty = False
+
+    # ─── indexing ───────────────────────────────────────────────────────────
+
+    def _add(self, kind, key, entry, entries):
+        entries[key] = entry
+        for band_key in band_keys(entry["signature"]):
+            self.buckets[band_key].add((kind, key))
+        self._dirty = True
+
+    def _remove_document(self, doc_id):
+        for kind, entries in (("line", self.lines), ("stanza", self.stanzas)):
+            for key in [k for k in entries if k[0] == doc_id]:
+                for band_key in band_keys(entries[key]["signature"]):
+                    self.buckets[band_key].discard((kind, key))
+                del entries[key]
+                self._dirty = True
+
+    def add_document(self, doc_id: str, text: str, reviewed_lines: list):
+        """
+        (Re-)index the reviewed lines of a document and the stanzas of its text that contain them.
+        """
+        with self._lock:
+            self._remove_document(doc_id)
+            line_nos = dict()
+            for line in reviewed_lines:
+                shingle_set = shingles(line["original"])
+                if len(tokenize(line["original"])) < NEAR_DUPLICATE_MIN_TOKENS:
+                    continue
+                source = TaggedLine.from_line({
+                    "tagged": line["tagged"],
+                    **({"spans": line["spans"]} if line.get("spans") is not None else {}),
+                })
+                self._add("line", (doc_id, line["line_no"]), {
+                    "text": source.text,
+                    "spans": source.spans,
+                    "english": line["english"],
+                    "shingles": shingle_set,
+                    "signature": minhash(shingle_set),
+                }, self.lines)
+                line_nos[normalize_urdu(line["original"].strip())] = line["line_no"]
+
+            for stanza_no, stanza in enumerate(split_stanzas(text)):
+                stanza_line_nos = [
+                    line_nos[normalize_urdu(line.strip())]
+                    for line in stanza if normalize_urdu(line.strip()) in line_nos
+                ]
+                if len(stanza_line_nos) < 2:
+                    continue
+                shingle_set = shingles("\n".join(stanza))
+                self._add("stanza", (doc_id, stanza_no), {
+                    "line_nos": stanza_line_nos,
+                    "shingles": shingle_set,
+                    "signature": minhash(shingle_set),
+                }, self.stanzas)
+
+    def update(self, store: AnnotationStore) -> bool:
+        """
+        Re-index the documents reviewed since the last update. Returns True if the index changed.
+        """
+        with self._lock:
+            rows = store.get_verified_lines(since=self.synced_at)
+            by_doc = defaultdict(list)
+            for row in rows:
+                row["spans"] = json.loads(row["spans"]) if row["spans"] is not None else None
+                by_doc[row["doc_id"]].append(row)
+            for doc_id, reviewed_lines in by_doc.items():
+                self.add_document(doc_id, store.get_text(doc_id), reviewed_lines)
+            if rows:
+                self.synced_at = max(row["updated_at"] for row in rows)
+                print(f"Indexed {len(rows)} reviewed lines of {len(by_doc)} documents for near-duplicate transfer.")
+            return self._dirty
+
+    # ─── lookup ─────────────────────────────────────────────────────────────
+
+    def _candidates(self, kind, shingle_set, exclude_doc=None):
+        """
+        ``(similarity, key)`` of the entries above the threshold, most similar first.
+        """
+        if not shingle_set:
+            return []
+        entries = self.lines if kind == "line" else self.stanzas
+        keys = set()
+        for band_key in band_keys(minhash(shingle_set)):
+            keys.update(key for k, key in self.buckets.get(band_key, ()) if k == kind)
+        scored = [
+            (jaccard(shingle_set, entries[key]["shingles"]), key)
+            for key in keys if key[0] != exclude_doc
+        ]
+        return sorted((c for c in scored if c[0] >= NEAR_DUPLICATE_THRESHOLD), reverse=True)
+
+    def _transfer(self, key, target_text):
+        entry = self.lines[key]
+        target = transfer_spans(TaggedLine(entry["text"], entry["spans"]), target_text)
+        if target is None:
+            return None
+        return target.to_line({"original": target_text, "english": entry["english"]})
+
+    def transfer_annotations(self, lines: list, stanzas: list = (), exclude_doc: str = None) -> dict:
+        """
+        Reviewed annotations for the near-duplicates among ``lines``, as
+        ``{line index: tagged element}``. ``stanzas`` are lists of line indexes.
+        """
+        transferred = dict()
+        with self._lock:
+            if not self.lines:
+                return transferred
+            for stanza in stanzas:
+                if len(stanza) < 2:
+                    continue
+                shingle_set = shingles("\n".join(lines[i] for i in stanza))
+                for _, stanza_key in self._candidates("stanza", shingle_set, exclude_doc)[:1]:
+                    source_keys = [(stanza_key[0], n) for n in self.stanzas[stanza_key]["line_nos"]]
+                    for i in stanza:
+                        line_shingles = shingles(lines[i])
+                        best = max(
+                            ((jaccard(line_shingles, self.lines[k]["shingles"]), k) for k in source_keys),
+                            default=(0, None),
+                        )
+                        if best[0] >= NEAR_DUPLICATE_THRESHOLD:
+                            element = self._transfer(best[1], lines[i])
+                            if element is not None:
+                                transferred[i] = element
+
+            for i, line in enumerate(lines):
+                if i in transferred or len(tokenize(line)) < NEAR_DUPLICATE_MIN_TOKENS:
+                    continue
+                for _, key in self._candidates("line", shingles(line), exclude_doc)[:3]:
+                    element = self._transfer(key, line)
+                    if element is not None:
+                        transferred[i] = element
+                        break
+        return transferred
+
+
+def split_stanzas(text: str) -> list:
+    """
+    Blocks of non-empty lines separated by blank lines.
+    """
+    stanzas = [list()]
+    for line in text.split("\n"):
+        if line.strip():
+            stanzas[-1].append(line)
+        elif stanzas[-1]:
+            stanzas.append(list())
+    return [stanza for stanza in stanzas if stanza]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_near_duplicate_index() -> NearDuplicateIndex:
+    """
+    The near-duplicate index, updated with the lines reviewed since it was saved.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = NearDuplicateIndex.load()
+        if _index.update(get_store()):
+            _index.save()
+    return _index
+
+
+def evaluate_transfer(store: AnnotationStore = None) -> dict:
+    """
+    Tag the reviewed lines of every reviewed document by transfer from the other
+    documents only, and compare the transferred spans with the reviewed ones.
+    """
+    store = store or get_store()
+    index = NearDuplicateIndex(path=None)
+    index.update(store)
+    counts = defaultdict(int)
+    for doc_id in sorted({key[0] for key in index.lines}):
+        gold = {
+            index.lines[key]["text"]: {tuple(span[:3]) for span in index.lines[key]["spans"]}
+            for key in index.lines if key[0] == doc_id
+        }
+        # Lines of the text are compared on the reviewed text, whose offsets the spans refer to
+        gold_texts = {normalize_urdu(text.strip()): text for text in gold}
+        lines = list()
+        stanzas = list()
+        for stanza in split_stanzas(store.get_text(doc_id)):
+            stanzas.append(list(range(len(lines), len(lines) + len(stanza))))
+            lines.extend(gold_texts.get(normalize_urdu(line.strip()), line) for line in stanza)
+        transferred = index.transfer_annotations(lines, stanzas, exclude_doc=doc_id)
+        for i, line in enumerate(lines):
+            if line not in gold:
+                continue
+            expected = gold.pop(line)
+            counts["lines"] += 1
+            counts["gold_entities"] += len(expected)
+            if i not in transferred:
+                continue
+            predicted = {tuple(span[:3]) for span in transferred[i]["spans"]}
+            counts["transferred_lines"] += 1
+            counts["exact_lines"] += predicted == expected
+            counts["true_positives"] += len(predicted & expected)
+            counts["false_positives"] += len(predicted - expected)
+            counts["false_negatives"] += len(expected - predicted)
+            counts["transferred_gold_entities"] += len(expected)
+
+    tp = counts["true_positives"]
+    return {
+        **counts,
+        "coverage": counts["transferred_lines"] / max(counts["lines"], 1),
+        "precision": tp / max(tp + counts["false_positives"], 1),
+        "recall": tp / max(counts["transferred_gold_entities"], 1),
+        "recall_overall": tp / max(counts["gold_entities"], 1),
+        "exact_line_accuracy": counts["exact_lines"] / max(counts["transferred_lines"], 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Near-duplicate transfer of reviewed annotations.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Index the reviewed lines of the store")
+    subparsers.add_parser("evaluate", help="Report the precision and recall of the transfer")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = get_near_duplicate_index()
+        print(f"{len(index.lines)} lines and {len(index.stanzas)} stanzas indexed.")
+    else:
+        report = evaluate_transfer()
+        print(f"Reviewed lines:       {report['lines']}")
+        print(f"Transferred lines:    {report['transferred_lines']} ({report['coverage']:.1%})")
+        print(f"Precision:            {report['precision']:.3f}")
+        print(f"Recall (transferred): {report['recall']:.3f}")
+        print(f"Recall (all lines):   {report['recall_overall']:.3f}")
+        print(f"Exact line accuracy:  {report['exact_line_accuracy']:.3f}")
@@ -0,0 +1,363 @@
+"""
+Process-pool pipeline for the CPU-bound work of whole-corpus rebuilds.
+
+Reading and hashing files, Urdu filtering and chunking, tokenising lines for
+the search index, parsing tagged lines into entities, building export rows
+and review statistics are pure Python and hold the GIL, so rebuilds over the
+whole corpus shard the documents across worker processes. Shards are
+contiguous runs of documents of about equal total size, several per worker,
+so results stay in document order and slow shards do not hold up the pool.
+
+Only paths and document ids are sent to the workers; every worker reads the
+corpus files and opens the annotation store itself. Results come back as flat
+buffers rather than pickled dict trees:
+
+- search postings as the distinct terms of a document and ``array('I')`` bytes,
+- export rows as Arrow IPC streams,
+- review statistics as category counts and confusion matrix bytes,
+- corpus pack records as their JSON bytes.
+
+``PIPELINE_MAX_WORKERS`` caps the pool (0: one worker per core). Fewer than
+``PIPELINE_MIN_DOCUMENTS`` documents are processed in the calling process.
+The app does not start a pool per request: its exports run on one shared pool
+of ``PIPELINE_SHARED_WORKERS`` processes (see ``get_shared_pool``), so
+concurrent downloads queue on the same workers.
+
+``python -m ner_annotator.pipeline index|pack|stats|export`` runs the rebuilds
+from the command line and prints how long they took.
+"""
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ner_annotator.constants import (
+    CHUNK_SIZE,
+    DATASET_DIR,
+    PIPELINE_MAX_WORKERS,
+    PIPELINE_MIN_DOCUMENTS,
+    PIPELINE_SHARDS_PER_WORKER,
+    PIPELINE_SHARED_WORKERS,
+)
+from ner_annotator.corpus import read_corpus_text
+from ner_annotator.identity import document_id
+from ner_annotator.store import get_store
+from ner_annotator.tracing import detached_span
+
+
+def get_worker_count(workers: int = None) -> int:
+    return workers or PIPELINE_MAX_WORKERS or os.cpu_count() or 1
+
+
+def shard_items(sizes: list, shards: int) -> list:
+    """
+    Split ``range(len(sizes))`` into at most ``shards`` contiguous ``(start, end)``
+    runs of about equal total size. Unknown sizes count as the mean size.
+    """
+    known = [size for size in sizes if size]
+    mean = sum(known) / len(known) if known else 1
+    sizes = [size or mean for size in sizes]
+    target = sum(sizes) / max(shards, 1)
+    runs = list()
+    start = 0
+    total = 0
+    for i, size in enumerate(sizes):
+        total += size
+        if total >= target * (len(runs) + 1) and i + 1 < len(sizes):
+            runs.append((start, i + 1))
+            start = i + 1
+    if start < len(sizes):
+        runs.append((start, len(sizes)))
+    return runs
+
+
+def _spawn_pool(workers: int) -> ProcessPoolExecutor:
+    # Spawned like the job workers, so no Streamlit or database state is inherited
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def imap_shards(func, items: list, sizes: list = None, workers: int = None, pool: ProcessPoolExecutor = None):
+    """
+    Yield ``func``'s result for every item, in the order of ``items``. ``func`` is a
+    module-level function that takes a list of items and returns one result per item;
+    it runs on shards of ``items`` in a pool of spawned worker processes, started for
+    the call unless a shared ``pool`` is given.
+    """
+    workers = min(PIPELINE_SHARED_WORKERS if pool is not None else get_worker_count(workers), len(items))
+    # The span stays open while the consumer iterates, so it must not be the current span
+    with detached_span("pipeline.map", function=func.__name__, items=len(items), workers=workers):
+        if workers <= 1 or len(items) < PIPELINE_MIN_DOCUMENTS:
+            yield from func(items)
+            return
+        runs = shard_items(sizes or [None] * len(items), workers * PIPELINE_SHARDS_PER_WORKER)
+        shards = [items[start:end] for start, end in runs]
+        if pool is not None:
+            for results in pool.map(func, shards):
+                yield from results
+            return
+        with _spawn_pool(workers) as pool:
+            for results in pool.map(func, shards):
+                yield from results
+
+
+def map_shards(func, items: list, sizes: list = None, workers: int = None, pool: ProcessPoolExecutor = None) -> list:
+    return list(imap_shards(func, items, sizes, workers, pool))
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_shared_pool() -> ProcessPoolExecutor:
+    """
+    Process pool of ``PIPELINE_SHARED_WORKERS`` workers shared by all sessions of the app.
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = _spawn_pool(PIPELINE_SHARED_WORKERS)
+    return _shared_pool
+
+
+# ─── workers ────────────────────────────────────────────────────────────────
+
+
+def _read_text(source: str, key: str) -> str:
+    if source == "corpus":
+        return read_corpus_text(key)
+    return get_store().get_text(key) or ""
+
+
+def hash_files(paths: list) -> list:
+    return [document_id(read_corpus_text(path)) for path in paths]
+
+
+def tokenize_documents(items: list) -> list:
+    """
+    Search postings of ``(doc_idx, source, path or doc_id)`` items as
+    ``(terms, offsets, postings)`` bytes (see ``search.tokenize_postings``).
+    """
+    from ner_annotator.search import tokenize_postings
+
+    results = list()
+    for doc_idx, source, key in items:
+        terms, offsets, postings = tokenize_postings(_read_text(source, key), doc_idx)
+        results.append(("\n".join(terms).encode(), offsets.tobytes(), postings.tobytes()))
+    return results
+
+
+def preprocess_documents(items: list) -> list:
+    """
+    ``(lines, Urdu lines, tagging chunks, Urdu tokens)`` of ``(source, path or doc_id)`` items.
+    """
+    from ner_annotator.llm_tagger import is_mostly_urdu
+    from ner_annotator.search import tokenize
+
+    results = list()
+    for source, key in items:
+        lines = _read_text(source, key).split("\n")
+        urdu_lines = [line for line in lines if is_mostly_urdu(line)]
+        results.append((
+            len(lines),
+            len(urdu_lines),
+            -(-len(urdu_lines) // CHUNK_SIZE),
+            sum(len(tokenize(line)) for line in urdu_lines),
+        ))
+    return results
+
+
+def pack_documents(doc_ids: list) -> list:
+    from ner_annotator.corpus_pack import pack_document
+
+    store = get_store()
+    return [pack_document(store, doc_id) for doc_id in doc_ids]
+
+
+def export_documents(items: list) -> list:
+    """
+    Export rows of ``(kind, doc_id)`` items as Arrow IPC streams.
+    """
+    from ner_annotator.export import records_to_ipc
+
+    store = get_store()
+    results = list()
+    for kind, doc_id in items:
+        columns, _, records_fn = _get_export_kind(kind)
+        results.append(records_to_ipc(records_fn(store.get_document(doc_id) or {}), columns))
+    return results
+
+
+def count_reviews(doc_ids: list) -> list:
+    """
+    Review counts of documents as ``(total entities, verified entities, categories,
+    category counts, confusion labels, confusion matrix)`` with the counts as bytes.
+    """
+    from ner_annotator.metrics import get_review_counts
+
+    store = get_store()
+    results = list()
+    for doc_id in doc_ids:
+        counts = get_review_counts(store.get_lines(doc_id))
+        categories = counts["per_category_count"]
+        matrix = counts["confusion_matrix"]
+        results.append((
+            counts["total_entities"],
+            counts["total_verified"],
+            tuple(categories),
+            array("q", categories.values()).tobytes(),
+            tuple(matrix.labels),
+            matrix.matrix.tobytes(),
+        ))
+    return results
+
+
+# ─── corpus-wide operations ─────────────────────────────────────────────────
+
+
+def _get_export_kind(kind: str):
+    from ner_annotator.export import (
+        LLM_JUDGEMENT_COLUMNS,
+        NER_TAG_COLUMNS,
+        iter_llm_judgement_records,
+        iter_ner_tag_records,
+    )
+
+    if kind == "ner_tags":
+        return NER_TAG_COLUMNS, "Combined NER Tags", lambda data: iter_ner_tag_records(
+            data.get("filename"), data.get("tagged_elements", [])
+        )
+    if kind == "llm_judgement":
+        return LLM_JUDGEMENT_COLUMNS, "Combined LLM Judgement", lambda data: iter_llm_judgement_records(
+            data.get("filename"), data.get("llm_judgement", [])
+        )
+    raise ValueError(f"Unknown export kind: {kind}")
+
+
+def export_all(
+    kind: str, doc_ids: list, export_format: str = "Excel", workers: int = None, pool: ProcessPoolExecutor = None
+):
+    """
+    Combined export of ``doc_ids``, with the rows built in worker processes
+    (those of ``pool`` if given).
+    """
+    from ner_annotator.export import export_record_batches, iter_ipc_batches
+    from ner_annotator.journal import get_journal
+
+    columns, sheet_name, _ = _get_export_kind(kind)
+    # Workers read the store, so the review edits journaled by this process must be in it
+    get_journal().compact()
+    streams = imap_shards(export_documents, [(kind, doc_id) for doc_id in doc_ids], workers=workers, pool=pool)
+    return export_record_batches(
+        iter_ipc_batches(streams),
+        columns, sheet_name, export_format,
+    )
+
+
+def review_counts_all(doc_ids: list, workers: int = None) -> dict:
+    """
+    Review counts of ``doc_ids`` merged like ``metrics.merge_review_counts``.
+    """
+    from ner_annotator.journal import get_journal
+    from ner_annotator.metrics import ConfusionMatrix, empty_review_counts
+
+    get_journal().compact()
+    merged = empty_review_counts()
+    for total, verified, categories, category_counts, labels, matrix in imap_shards(
+        count_reviews, doc_ids, workers=workers
+    ):
+        merged["total_entities"] += total
+        merged["total_verified"] += verified
+        merged["per_category_count"].update(dict(zip(categories, array("q", category_counts))))
+        confusion_matrix = ConfusionMatrix(labels)
+        confusion_matrix.matrix = np.frombuffer(matrix, dtype=np.int64).reshape(len(labels), len(labels))
+        merged["confusion_matrix"].merge(confusion_matrix)
+    return merged
+
+
+def preprocess_all(corpus_index, store, workers: int = None) -> dict:
+    """
+    Line, Urdu line, chunk and token totals of the corpus files and uploads.
+    """
+    items = [("corpus", entry["path"]) for entry in corpus_index.entries.values()]
+    sizes = [entry["size"] for entry in corpus_index.entries.values()]
+    items += [("upload", doc["doc_id"]) for doc in store.list_documents()]
+    sizes += [None] * (len(items) - len(sizes))
+    totals = np.zeros(4, dtype=np.int64)
+    for counts in imap_shards(preprocess_documents, items, sizes, workers):
+        totals += counts
+    return dict(zip(("documents", "lines", "urdu_lines", "chunks", "tokens"), [len(items), *totals.tolist()]))
+
+
+def _rebuild_indexes(workers):
+    from ner_annotator.constants import SEARCH_INDEX_PATH
+    from ner_annotator.corpus import build_corpus_index
+    from ner_annotator.search import SearchIndex
+
+    corpus_index = build_corpus_index(DATASET_DIR, workers=workers)
+    search_index = SearchIndex(SEARCH_INDEX_PATH)
+    search_index.update(corpus_index, get_store(), workers=workers)
+    print(f"Indexed {len(search_index.docs)} documents with {len(search_index.postings)} terms for search.")
+
+
+def _print_stats(workers):
+    from ner_annotator.corpus import load_corpus_index
+    from ner_annotator.metrics import summarize_review_counts
+
+    store = get_store()
+    for name, value in preprocess_all(load_corpus_index(DATASET_DIR), store, workers).items():
+        print(f"{name}: {value}")
+    stats = summarize_review_counts(
+        review_counts_all(sorted(store.get_doc_ids_with_status("tagged")), workers)
+    )
+    print(f"entities: {stats['total_entities']} ({stats['total_verified']} verified)")
+    for tag, count in sorted(stats["per_category_count"].items(), key=lambda c: -c[1]):
+        print(f"  {tag}: {count}")
+    if stats["micro_scores"]:
+        scores = stats["micro_scores"]
+        print(f"micro precision {scores['precision']:.2%}, recall {scores['recall']:.2%}, F1 {scores['f1']:.2%}")
+
+
+def _export(kind, export_format, output, workers):
+    output = output or f"{kind}.{_export_extension(export_format)}"
+    doc_ids = sorted(get_store().get_doc_ids_with_status("tagged"))
+    with open(output, "wb") as f:
+        f.write(export_all(kind, doc_ids, export_format, workers).getvalue())
+    print(f"Exported {len(doc_ids)} documents to {output}.")
+
+
+def _export_extension(export_format):
+    from ner_annotator.export import EXPORT_FORMATS
+
+    return EXPORT_FORMATS[export_format]["extension"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Whole-corpus rebuilds in a process pool.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per core)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("index", help="Rehash the corpus and rebuild the search index from scratch")
+    subparsers.add_parser("pack", help="Rebuild the corpus pack")
+    subparsers.add_parser("stats", help="Corpus and review statistics")
+    export_parser = subparsers.add_parser("export", help="Combined export of all tagged documents")
+    export_parser.add_argument("--kind", choices=["ner_tags", "llm_judgement"], default="ner_tags")
+    export_parser.add_argument("--format", choices=["Excel", "CSV", "Parquet"], default="Parquet")
+    export_parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == "index":
+        _rebuild_indexes(args.workers)
+    elif args.command == "pack":
+        from ner_annotator.corpus_pack import build_corpus_pack
+
+        build_corpus_pack(workers=args.workers)
+    elif args.command == "stats":
+        _print_stats(args.workers)
+    else:
+        _export(args.kind, args.format, args.output, args.workers)
+    print(f"{args.command} took {time.perf_counter() - started:.2f}s with {get_worker_count(args.workers)} workers.")
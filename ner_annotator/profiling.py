@@ -0,0 +1,190 @@
+"""
+Cold-start and render profiling for the Streamlit app.
+
+``python -m ner_annotator.profiling`` imports the app modules in a fresh
+interpreter with ``-X importtime`` and reports the slowest imports.
+``page_render_timer`` is used by ``app.py`` to time every rerun of a page (and
+traces it as a ``page.render`` span), and for the first render of a page in
+this process, reports the time since the process started. Pages time their
+parts with ``section_timer``. The last ``RENDER_SAMPLE_WINDOW`` samples of
+each page and section are kept, and rolling p50/p95/p99 are shown on the
+admin diagnostics page.
+"""
+import argparse
+import math
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from ner_annotator.constants import RENDER_SAMPLE_WINDOW
+from ner_annotator.tracing import span
+
+
+PROCESS_START = time.perf_counter()
+
+APP_MODULES = [
+    "streamlit",
+    "ner_annotator.auth",
+    "app_pages.common",
+    "ner_annotator.utils",
+    "ner_annotator.llm_tagger",
+    "ner_annotator.llm_judge",
+]
+
+PAGE_TOTAL = "total"
+PERCENTILES = (50, 95, 99)
+
+_rendered_pages = set()
+_rendered_lock = threading.Lock()
+# Each rerun runs in its own script thread, the page being rendered is per thread
+_current = threading.local()
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    """
+    Linearly interpolated ``q``-th percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return float("nan")
+    rank = (len(sorted_values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+class RenderProfiler:
+    """
+    Rolling window of render times per page and section, shared by all sessions.
+    """
+
+    def __init__(self, window: int = RENDER_SAMPLE_WINDOW):
+        self.window = window
+        # (page, section) -> deque of seconds
+        self._samples = dict()
+        self._lock = threading.Lock()
+
+    def record(self, page: str, section: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get((page, section))
+            if samples is None:
+                samples = self._samples[(page, section)] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def report(self) -> list:
+        """
+        One row per page and section with the sample count, p50/p95/p99 and max in seconds.
+        """
+        with self._lock:
+            snapshot = {key: sorted(samples) for key, samples in self._samples.items()}
+        rows = list()
+        for (page, section), samples in sorted(
+            snapshot.items(), key=lambda item: (item[0][0], item[0][1] != PAGE_TOTAL, item[0][1])
+        ):
+            row = {"page": page, "section": section, "count": len(samples)}
+            for q in PERCENTILES:
+                row[f"p{q}"] = percentile(samples, q)
+            row["max"] = samples[-1]
+            rows.append(row)
+        return rows
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_render_profiler() -> RenderProfiler:
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = RenderProfiler()
+    return _profiler
+
+
+@contextmanager
+def section_timer(section: str):
+    """
+    Time a named part of the page that is currently being rendered.
+    """
+    page = getattr(_current, "page", None)
+    start_time = time.perf_counter()
+    try:
+        with span("page.section", page=page, section=section):
+            yield
+    finally:
+        if page is not None:
+            get_render_profiler().record(page, section, time.perf_counter() - start_time)
+
+
+@contextmanager
+def page_render_timer(page_title: str):
+    start_time = time.perf_counter()
+    _current.page = page_title
+    try:
+        with span("page.render", page=page_title):
+            yield
+    finally:
+        _current.page = None
+        elapsed = time.perf_counter() - start_time
+        get_render_profiler().record(page_title, PAGE_TOTAL, elapsed)
+        with _rendered_lock:
+            first_render = page_title not in _rendered_pages
+            _rendered_pages.add(page_title)
+        if first_render:
+            print(
+                f"First render of '{page_title}' took {elapsed:.2f} seconds "
+                f"({time.perf_counter() - PROCESS_START:.2f} seconds after process start)."
+            )
+        else:
+            print(f"Render of '{page_title}' took {elapsed:.2f} seconds.")
+
+
+def parse_importtime(output: str) -> list:
+    """
+    Parse ``-X importtime`` output into ``(module, self_us, cumulative_us)`` tuples.
+    """
+    timings = list()
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        timings.append((module.strip(), int(self_us), int(cumulative_us)))
+    return timings
+
+
+def profile_imports(modules=APP_MODULES) -> list:
+    """
+    Import ``modules`` in a fresh interpreter and return the per-module import times.
+    """
+    code = "\n".join(f"import {module}" for module in modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1] if result.stderr else "Import failed.")
+    return parse_importtime(result.stderr)
+
+
+def print_import_report(timings: list, modules=APP_MODULES, top: int = 25):
+    by_name = {module: cumulative for module, _, cumulative in timings}
+    print("Requested modules (cumulative):")
+    for module in modules:
+        if module in by_name:
+            print(f"  {by_name[module] / 1e6:8.3f}s  {module}")
+    print(f"Slowest {top} imports (self time):")
+    for module, self_us, cumulative_us in sorted(timings, key=lambda t: -t[1])[:top]:
+        print(f"  {self_us / 1e6:8.3f}s  {module} (cumulative {cumulative_us / 1e6:.3f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report import times of the app modules.")
+    parser.add_argument("modules", nargs="*", default=APP_MODULES)
+    parser.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+    print_import_report(profile_imports(args.modules), args.modules, top=args.top)
@@ -0,0 +1,328 @@
+"""
+Inverted full-text index over the Marsiya corpus and uploaded texts.
+
+Tokens are normalised (diacritics, tatweel and Arabic/Urdu letter variants) and
+stored with positional postings ``(doc, line, position)`` packed into
+``array('I')`` buffers, sorted by document, line and position, so phrase queries
+are answered by merging the postings of their terms. The index is updated
+incrementally by content hash, when the corpus index or the documents of the
+store changed, and saved as a JSON header followed by the raw postings arrays
+(see ``index_file``).
+"""
+import os
+import re
+import threading
+from array import array
+
+from ner_annotator.constants import SEARCH_INDEX_PATH
+from ner_annotator.corpus import CorpusIndex, read_corpus_text
+from ner_annotator.index_file import read_index_file, write_index_file
+from ner_annotator.store import AnnotationStore
+
+
+INDEX_VERSION = 3
+INDEX_MAGIC = b"NERSRCH"
+
+DIACRITICS_PATTERN = re.compile(r"[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640\u200C\u200D]")
+TOKEN_PATTERN = re.compile(r"\w+")
+LETTER_VARIANTS = str.maketrans({
+    "\u064A": "\u06CC",  # ي -> ی
+    "\u0649": "\u06CC",  # ى -> ی
+    "\u0643": "\u06A9",  # ك -> ک
+    "\u0647": "\u06C1",  # ه -> ہ
+    "\u06C2": "\u06C1",  # ۂ -> ہ
+    "\u0629": "\u06C1",  # ة -> ہ
+    "\u0623": "\u0627",  # أ -> ا
+    "\u0625": "\u0627",  # إ -> ا
+    "\u0622": "\u0627",  # آ -> ا
+})
+
+
+def normalize_urdu(text: str) -> str:
+    return DIACRITICS_PATTERN.sub("", text).translate(LETTER_VARIANTS).lower()
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_PATTERN.findall(normalize_urdu(text))
+
+
+def tokenize_postings(text: str, doc_idx: int):
+    """
+    Distinct terms of ``text`` and their ``(doc_idx, line, position)`` postings,
+    concatenated term after term into one ``array('I')`` with the start of the
+    postings of every term in ``offsets``.
+    """
+    by_term = dict()
+    for line_no, line in enumerate(text.split("\n")):
+        for position, term in enumerate(tokenize(line)):
+            postings = by_term.get(term)
+            if postings is None:
+                postings = by_term[term] = array("I")
+            postings.extend((doc_idx, line_no, position))
+    terms = list(by_term)
+    offsets = array("I", [0])
+    postings = array("I")
+    for term in terms:
+        postings.extend(by_term[term])
+        offsets.append(len(postings))
+    return terms, offsets, postings
+
+
+def intersect_postings(matches: array, postings: array, offset: int) -> array:
+    """
+    The ``(doc, line, position)`` triples of ``matches`` that have a posting of
+    ``postings`` ``offset`` positions further on the same line. Both are sorted.
+    """
+    result = array("I")
+    i = j = 0
+    while i < len(matches) and j < len(postings):
+        match = (matches[i], matches[i + 1], matches[i + 2] + offset)
+        posting = (postings[j], postings[j + 1], postings[j + 2])
+        if match == posting:
+            result.extend(matches[i:i + 3])
+            i += 3
+            j += 3
+        elif match < posting:
+            i += 3
+        else:
+            j += 3
+    return result
+
+
+def shift_postings(postings: array, offset: int) -> array:
+    """
+    ``postings`` moved ``offset`` positions back, dropping those before the start of their line.
+    """
+    if not offset:
+        return postings
+    shifted = array("I")
+    for i in range(0, len(postings), 3):
+        if postings[i + 2] >= offset:
+            shifted.extend((postings[i], postings[i + 1], postings[i + 2] - offset))
+    return shifted
+
+
+class SearchIndex:
+    def __init__(self, path: str = SEARCH_INDEX_PATH):
+        self.path = path
+        # doc_key -> {"doc_idx", "name", "source", "path"}
+        self.docs = dict()
+        self.doc_keys = list()
+        self.postings = dict()
+        # Corpus index and store documents version the index was last updated with
+        self.synced_corpus_index = None
+        self.documents_version = None
+        self._lock = threading.RLock()
+        self._dirty = False
+
+    # ─── persistence ────────────────────────────────────────────────────────
+
+    @classmethod
+    def load(cls, path: str = SEARCH_INDEX_PATH) -> "SearchIndex":
+        index = cls(path)
+        if not os.path.exists(path):
+            return index
+        loaded = read_index_file(path, INDEX_MAGIC, INDEX_VERSION)
+        if loaded is None:
+            print("Search index version changed, rebuilding.")
+            return index
+        header, (offsets, postings) = loaded
+        index.docs = header["docs"]
+        index.doc_keys = header["doc_keys"]
+        for i, term in enumerate(header["terms"]):
+            index.postings[term] = postings[offsets[i]:offsets[i + 1]]
+        return index
+
+    def save(self):
+        """
+        Write the documents and terms as the header, then the offsets of the postings
+        of every term and the postings of all terms as raw ``array('I')`` buffers.
+        """
+        with self._lock:
+            terms = list(self.postings)
+            offsets = array("I", [0])
+            postings = array("I")
+            for term in terms:
+                postings.extend(self.postings[term])
+                offsets.append(len(postings))
+            write_index_file(
+                self.path, INDEX_MAGIC, INDEX_VERSION,
+                {"docs": self.docs, "doc_keys": self.doc_keys, "terms": terms},
+                [offsets, postings],
+            )
+            self._dirty = False
+
+    # ─── indexing ───────────────────────────────────────────────────────────
+
+    def _register(self, doc_key: str, name: str, source: str, path: str = None) -> int:
+        doc_idx = len(self.doc_keys)
+        self.doc_keys.append(doc_key)
+        self.docs[doc_key] = {
+            "doc_idx": doc_idx,
+            "name": name,
+            "source": source,
+            "path": path,
+        }
+        self._dirty = True
+        return doc_idx
+
+    def _add_postings(self, terms, offsets, postings):
+        for i, term in enumerate(terms):
+            term_postings = self.postings.get(term)
+            if term_postings is None:
+                term_postings = self.postings[term] = array("I")
+            term_postings.extend(postings[offsets[i]:offsets[i + 1]])
+
+    def add_document(self, doc_key: str, name: str, text: str, source: str, path: str = None):
+        with self._lock:
+            if doc_key in self.docs:
+                return
+            doc_idx = self._register(doc_key, name, source, path)
+            self._add_postings(*tokenize_postings(text, doc_idx))
+
+    def add_documents(self, documents: list, workers: int = None):
+        """
+        Index many ``{"doc_key", "name", "source", "path", "size"}`` documents, tokenised
+        in worker processes (see ``pipeline``). Corpus files are read from ``path``,
+        uploads from the annotation store.
+        """
+        from ner_annotator.pipeline import map_shards, tokenize_documents
+
+        with self._lock:
+            documents = [d for d in documents if d["doc_key"] not in self.docs]
+            items = [
+                (self._register(d["doc_key"], d["name"], d["source"], d.get("path")), d["source"],
+                 d.get("path") or d["doc_key"])
+                for d in documents
+            ]
+            results = map_shards(
+                tokenize_documents, items, sizes=[d.get("size") for d in documents], workers=workers
+            )
+            for terms, offsets, postings in results:
+                offsets_array = array("I")
+                offsets_array.frombytes(offsets)
+                postings_array = array("I")
+                postings_array.frombytes(postings)
+                self._add_postings(terms.decode().split("\n") if terms else [], offsets_array, postings_array)
+
+    def remove_documents(self, doc_keys: set):
+        """
+        Drop documents and re-number the remaining ones. Costs a pass over all postings,
+        so it is only used when corpus files change.
+        """
+        with self._lock:
+            removed = {self.docs[k]["doc_idx"] for k in doc_keys if k in self.docs}
+            if not removed:
+                return
+            remap = dict()
+            doc_keys_left = list()
+            for old_idx, key in enumerate(self.doc_keys):
+                if old_idx in removed:
+                    del self.docs[key]
+                    continue
+                remap[old_idx] = len(doc_keys_left)
+                self.docs[key]["doc_idx"] = len(doc_keys_left)
+                doc_keys_left.append(key)
+            self.doc_keys = doc_keys_left
+
+            for term in list(self.postings):
+                old = self.postings[term]
+                new = array("I")
+                for i in range(0, len(old), 3):
+                    if old[i] in remap:
+                        new.extend((remap[old[i]], old[i + 1], old[i + 2]))
+                if new:
+                    self.postings[term] = new
+                else:
+                    del self.postings[term]
+            self._dirty = True
+
+    def update(self, corpus_index: CorpusIndex, store: AnnotationStore, workers: int = None) -> bool:
+        """
+        Index new corpus files and uploaded documents, and drop corpus files that disappeared.
+        Does nothing unless ``corpus_index`` is another index or documents were added to the
+        store since the last update. Returns True if the index changed.
+        """
+        with self._lock:
+            documents_version = store.get_documents_version()
+            if corpus_index is self.synced_corpus_index and documents_version == self.documents_version:
+                return False
+            corpus_hashes = {e["content_hash"] for e in corpus_index.entries.values()}
+            stale = {
+                key for key, doc in self.docs.items()
+                if doc["source"] == "corpus" and key not in corpus_hashes
+            }
+            self.remove_documents(stale)
+
+            pending = dict()
+            for name, entry in corpus_index.entries.items():
+                if entry["content_hash"] not in self.docs:
+                    pending.setdefault(entry["content_hash"], {
+                        "doc_key": entry["content_hash"], "name": name, "source": "corpus",
+                        "path": entry["path"], "size": entry["size"],
+                    })
+            for doc in store.list_documents():
+                if doc["doc_id"] not in self.docs:
+                    pending.setdefault(doc["doc_id"], {
+                        "doc_key": doc["doc_id"], "name": doc["filename"] or doc["doc_id"][:8],
+                        "source": "upload",
+                    })
+            if pending:
+                self.add_documents(list(pending.values()), workers=workers)
+            self.synced_corpus_index = corpus_index
+            self.documents_version = documents_version
+
+            if self._dirty:
+                self.save()
+                return True
+            return False
+
+    # ─── querying ───────────────────────────────────────────────────────────
+
+    def search(self, query: str) -> list:
+        """
+        Find the lines containing the query terms as a contiguous phrase.
+        Returns ``(doc_key, line_no)`` pairs sorted by document and line.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            postings = [self.postings.get(term, array("I")) for term in terms]
+            # Start from the rarest term, so the merges only walk its few candidate phrases
+            order = sorted(range(len(terms)), key=lambda offset: len(postings[offset]))
+            matches = shift_postings(postings[order[0]], order[0])
+            for offset in order[1:]:
+                if not matches:
+                    break
+                matches = intersect_postings(matches, postings[offset], offset)
+            lines = list()
+            for i in range(0, len(matches), 3):
+                line = (matches[i], matches[i + 1])
+                if not lines or lines[-1] != line:
+                    lines.append(line)
+            return [(self.doc_keys[doc], line) for doc, line in lines]
+
+    def search_lines(self, query: str, store: AnnotationStore, limit: int = None) -> list:
+        """
+        Search and resolve the matching lines with file name and 1-based line number.
+        """
+        hits = self.search(query)
+        if limit is not None:
+            hits = hits[:limit]
+        results = list()
+        texts = dict()
+        for doc_key, line_no in hits:
+            doc = self.docs[doc_key]
+            if doc_key not in texts:
+                text = (
+                    read_corpus_text(doc["path"]) if doc["source"] == "corpus"
+                    else store.get_text(doc_key) or ""
+                )
+                texts[doc_key] = text.split("\n")
+            results.append({
+                "File": doc["name"],
+                "Line": line_no + 1,
+                "Text": texts[doc_key][line_no],
+            })
+        return results
@@ -1,6 +1,291 @@
+"""
+Email delivery for review reports.
+
+Messages are queued to a background worker that sends them over a pooled,
+reusable SMTP connection and retries failed deliveries with backoff, so the
+pages never wait for the mail server. Messages with large attachments can be
+queued as a function that builds them, which the worker calls before sending. Large attachments are gzip-compressed
+unless their format is already compressed.
+
+The server is configured through the environment (``SMTP_HOST``,
+``SMTP_PORT``, ``SMTP_SECURITY`` = ssl | starttls | none, ``SMTP_USER``,
+``SMTP_PASSWORD``, ``SMTP_SENDER``). Pointing it at a local stand-in such as
+``python -m aiosmtpd -n -l localhost:1025`` with ``SMTP_SECURITY=none``
+delivers everything locally.
+"""
+import functools
+import gzip
+import io
+import os
+import queue
 import smtplib
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from email.message import EmailMessage
 
+from ner_annotator.constants import (
+    EMAIL_COMPRESS_THRESHOLD,
+    EMAIL_MAX_RETRIES,
+    EMAIL_RETRY_BACKOFF,
+    EMAIL_POOL_SIZE,
+    EMAIL_IDLE_TIMEOUT,
+)
+
+
+DEFAULT_PORTS = {"ssl": 465, "starttls": 587, "none": 25}
+ALREADY_COMPRESSED = {".xlsx", ".parquet", ".gz", ".zip", ".png", ".jpg"}
+ATTACHMENT_TYPES = {
+    ".json": ("application", "json"),
+    ".csv": ("text", "csv"),
+    ".xlsx": ("application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ".parquet": ("application", "vnd.apache.parquet"),
+    ".gz": ("application", "gzip"),
+}
+
+
+@dataclass
+class SMTPSettings:
+    host: str = "smtp.gmail.com"
+    port: int = 465
+    security: str = "ssl"
+    user: str = None
+    password: str = None
+    sender: str = None
+    timeout: float = 30
+
+    @classmethod
+    def from_env(cls) -> "SMTPSettings":
+        security = os.getenv("SMTP_SECURITY", "ssl").lower()
+        user = os.getenv("SMTP_USER")
+        return cls(
+            host=os.getenv("SMTP_HOST", cls.host),
+            port=int(os.getenv("SMTP_PORT", DEFAULT_PORTS.get(security, 25))),
+            security=security,
+            user=user,
+            password=os.getenv("SMTP_PASSWORD"),
+            sender=os.getenv("SMTP_SENDER", user),
+        )
+
+
+@dataclass
+class Attachment:
+    filename: str
+    data: bytes = None
+    path: str = None
+
+    def read(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def size(self) -> int:
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+
+@dataclass
+class OutgoingEmail:
+    recipients: list
+    subject: str
+    body: str
+    attachments: list = field(default_factory=list)
+
+
+def compress_attachment(attachment: Attachment, threshold: int = EMAIL_COMPRESS_THRESHOLD) -> Attachment:
+    extension = os.path.splitext(attachment.filename)[1].lower()
+    if extension in ALREADY_COMPRESSED or attachment.size() < threshold:
+        return attachment
+    output = io.BytesIO()
+    with gzip.GzipFile(filename=attachment.filename, mode="wb", fileobj=output) as gz:
+        if attachment.data is not None:
+            gz.write(attachment.data)
+        else:
+            with open(attachment.path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    gz.write(chunk)
+    return Attachment(filename=f"{attachment.filename}.gz", data=output.getvalue())
+
+
+def build_message(email: OutgoingEmail, sender: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg['From'] = sender
+    msg['To'] = ", ".join(email.recipients)
+    msg['Subject'] = email.subject
+    msg.set_content(email.body)
+    for attachment in email.attachments:
+        attachment = compress_attachment(attachment)
+        extension = os.path.splitext(attachment.filename)[1].lower()
+        maintype, subtype = ATTACHMENT_TYPES.get(extension, ("application", "octet-stream"))
+        msg.add_attachment(
+            attachment.read(), maintype=maintype, subtype=subtype, filename=attachment.filename
+        )
+    return msg
+
+
+class SMTPConnectionPool:
+    """
+    Keeps up to ``size`` logged-in SMTP connections for reuse. A connection that
+    sat idle too long or fails a NOOP is replaced.
+    """
+
+    def __init__(self, settings: SMTPSettings, size: int = EMAIL_POOL_SIZE, idle_timeout: float = EMAIL_IDLE_TIMEOUT):
+        self.settings = settings
+        self.size = size
+        self.idle_timeout = idle_timeout
+        # (connection, last used)
+        self._idle = list()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> smtplib.SMTP:
+        settings = self.settings
+        if settings.security == "ssl":
+            smtp = smtplib.SMTP_SSL(settings.host, settings.port, timeout=settings.timeout)
+        else:
+            smtp = smtplib.SMTP(settings.host, settings.port, timeout=settings.timeout)
+            if settings.security == "starttls":
+                smtp.starttls()
+        if settings.user:
+            smtp.login(settings.user, settings.password)
+        return smtp
+
+    @staticmethod
+    def _is_alive(smtp: smtplib.SMTP) -> bool:
+        try:
+            return smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _quit(smtp: smtplib.SMTP):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    @contextmanager
+    def connection(self):
+        smtp = None
+        with self._lock:
+            while self._idle and smtp is None:
+                candidate, last_used = self._idle.pop()
+                if time.monotonic() - last_used > self.idle_timeout or not self._is_alive(candidate):
+                    self._quit(candidate)
+                else:
+                    smtp = candidate
+        if smtp is None:
+            smtp = self._connect()
+        try:
+            yield smtp
+        except BaseException:
+            # The connection may be in the middle of a transaction, do not reuse it
+            smtp.close()
+            raise
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((smtp, time.monotonic()))
+                return
+        self._quit(smtp)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, list()
+        for smtp, _ in idle:
+            self._quit(smtp)
+
+
+class EmailSender:
+    """
+    Background worker that delivers queued emails over the connection pool.
+    ``send`` returns a Future that resolves once the message is accepted by the server.
+    """
+
+    def __init__(
+        self,
+        settings: SMTPSettings = None,
+        max_retries: int = EMAIL_MAX_RETRIES,
+        retry_backoff: float = EMAIL_RETRY_BACKOFF,
+    ):
+        self.settings = settings or SMTPSettings.from_env()
+        self.pool = SMTPConnectionPool(self.settings)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="email-sender", daemon=True)
+        self._worker.start()
+
+    def send(self, email: OutgoingEmail) -> Future:
+        future = Future()
+        self._queue.put((email, future))
+        return future
+
+    def submit(self, build, *args) -> Future:
+        """
+        Queue the email returned by ``build(*args)``; it is built in the background worker.
+        """
+        future = Future()
+        self._queue.put((functools.partial(build, *args), future))
+        return future
+
+    def send_many(self, emails: list) -> list:
+        """
+        Queue many emails, e.g. one report per file; they share the pooled connection.
+        """
+        return [self.send(email) for email in emails]
+
+    def close(self, timeout: float = None):
+        self._queue.put(None)
+        self._worker.join(timeout)
+        self.pool.close()
+
+    def _deliver(self, email: OutgoingEmail):
+        msg = build_message(email, self.settings.sender)
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.pool.connection() as smtp:
+                    smtp.send_message(msg)
+                print(f"Email sent to {msg['To']}: {email.subject}")
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                if attempt == self.max_retries or isinstance(e, smtplib.SMTPAuthenticationError):
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                print(f"Error sending email to {msg['To']} ({e}), retrying in {delay:.0f}s...")
+                time.sleep(delay)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            email, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if callable(email):
+                    email = email()
+                self._deliver(email)
+            except Exception as e:
+                print(f"Failed to send email '{getattr(email, 'subject', email)}': {e}")
+                future.set_exception(e)
+            else:
+                future.set_result(True)
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def get_email_sender() -> EmailSender:
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            _sender = EmailSender()
+    return _sender
+
+
 def send_json_via_gmail(
     sender_email: str,
     sender_password: str,
@@ -9,26 +294,16 @@ def send_json_via_gmail(
     body: str,
     json_filepath: str
 ):
-    # Create the email
-    msg = EmailMessage()
-    msg['From'] = sender_email
-    msg['To'] = recipient_email
-    msg['Subject'] = subject
-    msg.set_content(body)
-
-    # Attach the JSON file
-    with open(json_filepath, 'rb') as f:
-        file_data = f.read()
-        file_name = json_filepath.split('/')[-1]
-    msg.add_attachment(
-        file_data,
-        maintype='application',
-        subtype='json',
-        filename=file_name
-    )
-
-    # Send it off
-    with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
-        smtp.login(sender_email, sender_password)
-        smtp.send_message(msg)
-        print(f"Email sent to {recipient_email} with attachment {file_name}!")
+    """
+    Send a JSON file through Gmail and wait for the delivery.
+    """
+    sender = EmailSender(SMTPSettings(user=sender_email, password=sender_password, sender=sender_email))
+    try:
+        sender.send(OutgoingEmail(
+            recipients=[recipient_email],
+            subject=subject,
+            body=body,
+            attachments=[Attachment(filename=os.path.basename(json_filepath), path=json_filepath)],
+        )).result()
+    finally:
+        sender.close()
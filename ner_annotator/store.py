@@ -0,0 +1,1097 @@
+"""
+SQLite-backed storage for uploaded documents and their annotations.
+
+Every document is keyed by its content-addressed id (see ``identity.document_id``)
+and split into rows, so editing a single line only touches that line and its
+entities instead of rewriting the whole document.
+"""
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from ner_annotator.constants import ANNOTATIONS_DB, UPLOAD_DIR
+from ner_annotator.entities import (
+    TaggedLine,
+    extract_spans,
+    index_line,
+    iter_entity_status,
+    normalize_entity_status,
+    span_key,
+)
+from ner_annotator.tracing import span
+
+
+# Entities are keyed by their span, so repeated entities of a line are reviewed separately
+ENTITIES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    doc_id          TEXT NOT NULL,
+    line_no         INTEGER NOT NULL,
+    span_start      INTEGER NOT NULL,
+    span_end        INTEGER NOT NULL,
+    entity          TEXT NOT NULL,
+    tag             TEXT,
+    user_updated    TEXT,
+    PRIMARY KEY (doc_id, line_no, span_start, span_end),
+    FOREIGN KEY (doc_id, line_no) REFERENCES lines(doc_id, line_no) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_entities_entity ON entities(entity, tag);
+CREATE INDEX IF NOT EXISTS idx_entities_tag ON entities(tag);
+CREATE INDEX IF NOT EXISTS idx_entities_user_updated ON entities(user_updated);
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id      TEXT PRIMARY KEY,
+    filename    TEXT,
+    text        TEXT NOT NULL,
+    tagged      INTEGER NOT NULL DEFAULT 0,
+    created_at  REAL NOT NULL,
+    updated_at  REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS lines (
+    doc_id          TEXT NOT NULL REFERENCES documents(doc_id) ON DELETE CASCADE,
+    line_no         INTEGER NOT NULL,
+    original        TEXT NOT NULL,
+    tagged          TEXT NOT NULL,
+    english         TEXT,
+    has_status      INTEGER NOT NULL DEFAULT 0,
+    user_verified   INTEGER NOT NULL DEFAULT 0,
+    spans           TEXT,
+    PRIMARY KEY (doc_id, line_no)
+) WITHOUT ROWID;
+
+-- Whether a document still has unverified lines is one lookup, however long it is
+CREATE INDEX IF NOT EXISTS idx_lines_verified ON lines(doc_id, user_verified);
+
+CREATE TABLE IF NOT EXISTS review_decisions (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    doc_id          TEXT NOT NULL,
+    line_no         INTEGER NOT NULL,
+    entity          TEXT NOT NULL,
+    tag             TEXT,
+    user_updated    TEXT,
+    user_verified   INTEGER NOT NULL DEFAULT 0,
+    created_at      REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_review_decisions_line ON review_decisions(doc_id, line_no);
+
+CREATE TABLE IF NOT EXISTS judgements (
+    doc_id          TEXT NOT NULL REFERENCES documents(doc_id) ON DELETE CASCADE,
+    chunk_no        INTEGER NOT NULL,
+    model           TEXT NOT NULL,
+    position        INTEGER NOT NULL,
+    entity          TEXT NOT NULL,
+    tag             TEXT,
+    correct         INTEGER NOT NULL,
+    alternative     TEXT,
+    PRIMARY KEY (doc_id, chunk_no, model, position)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_judgements_model ON judgements(model);
+CREATE INDEX IF NOT EXISTS idx_judgements_entity ON judgements(entity);
+
+CREATE TABLE IF NOT EXISTS document_status (
+    doc_id          TEXT PRIMARY KEY,
+    tagged          INTEGER NOT NULL DEFAULT 0,
+    judged          INTEGER NOT NULL DEFAULT 0,
+    reviewed        INTEGER NOT NULL DEFAULT 0,
+    tagged_at       REAL,
+    judged_at       REAL,
+    reviewed_at     REAL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_document_status_tagged ON document_status(tagged);
+
+-- Incremented on every change, so readers can tell cheaply whether cached state is stale
+CREATE TABLE IF NOT EXISTS versions (
+    name            TEXT PRIMARY KEY,
+    version         INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS documents_version AFTER INSERT ON documents
+BEGIN
+    INSERT INTO versions (name, version) VALUES ('documents', 1)
+    ON CONFLICT(name) DO UPDATE SET version = version + 1;
+END;
+
+INSERT OR IGNORE INTO document_status (doc_id, tagged, tagged_at)
+SELECT doc_id, 1, updated_at FROM documents WHERE tagged = 1;
+
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id            TEXT PRIMARY KEY,
+    kind              TEXT NOT NULL,
+    doc_id            TEXT NOT NULL,
+    params            TEXT NOT NULL,
+    status            TEXT NOT NULL,
+    done              INTEGER NOT NULL DEFAULT 0,
+    total             INTEGER,
+    message           TEXT,
+    error             TEXT,
+    cancel_requested  INTEGER NOT NULL DEFAULT 0,
+    created_at        REAL NOT NULL,
+    started_at        REAL,
+    finished_at       REAL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_jobs_doc ON jobs(doc_id, kind, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+
+CREATE TABLE IF NOT EXISTS bulk_corrections (
+    batch_id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    entity          TEXT NOT NULL,
+    tag             TEXT NOT NULL,
+    new_tag         TEXT NOT NULL,
+    occurrences     INTEGER NOT NULL,
+    created_at      REAL NOT NULL,
+    undone_at       REAL
+);
+
+CREATE TABLE IF NOT EXISTS bulk_correction_lines (
+    batch_id        INTEGER NOT NULL REFERENCES bulk_corrections(batch_id) ON DELETE CASCADE,
+    doc_id          TEXT NOT NULL,
+    line_no         INTEGER NOT NULL,
+    PRIMARY KEY (batch_id, doc_id, line_no)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS translation_memory (
+    key             TEXT PRIMARY KEY,
+    original        TEXT NOT NULL,
+    english         TEXT NOT NULL,
+    reviewed        INTEGER NOT NULL DEFAULT 0,
+    updated_at      REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_translation_memory_updated ON translation_memory(updated_at);
+
+CREATE TABLE IF NOT EXISTS translation_runs (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    doc_id          TEXT,
+    lines           INTEGER NOT NULL,
+    exact           INTEGER NOT NULL,
+    fuzzy           INTEGER NOT NULL,
+    missed          INTEGER NOT NULL DEFAULT 0,
+    created_at      REAL NOT NULL
+);
+"""
+
+STATUS_FLAGS = ("tagged", "judged", "reviewed")
+
+JOB_STATUSES = ("queued", "running", "done", "failed", "cancelled")
+ACTIVE_JOB_STATUSES = ("queued", "running")
+
+
+class AnnotationStore:
+    """
+    Thin wrapper around a SQLite database in WAL mode.
+
+    Connections are kept per thread because Streamlit runs every session
+    in its own script thread.
+    """
+
+    def __init__(self, db_path: str = ANNOTATIONS_DB):
+        self.db_path = db_path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+
+    def _migrate(self, conn):
+        line_columns = {row["name"] for row in conn.execute("PRAGMA table_info(lines)")}
+        if "spans" not in line_columns:
+            conn.execute("ALTER TABLE lines ADD COLUMN spans TEXT")
+        run_columns = {row["name"] for row in conn.execute("PRAGMA table_info(translation_runs)")}
+        if "missed" not in run_columns:
+            conn.execute("ALTER TABLE translation_runs ADD COLUMN missed INTEGER NOT NULL DEFAULT 0")
+        entity_columns = {row["name"] for row in conn.execute("PRAGMA table_info(entities)")}
+        if entity_columns and "span_start" not in entity_columns:
+            self._migrate_entity_spans(conn)
+        conn.executescript(ENTITIES_SCHEMA)
+
+    def _migrate_entity_spans(self, conn):
+        """
+        Re-key the entities stored by surface text by their spans; every occurrence of
+        an entity on a line gets the status of its surface text.
+        """
+        print("Migrating the entities table to span keys...")
+        conn.execute("ALTER TABLE entities RENAME TO entities_legacy")
+        for index in ("idx_entities_entity", "idx_entities_tag", "idx_entities_user_updated"):
+            conn.execute(f"DROP INDEX IF EXISTS {index}")
+        conn.executescript(ENTITIES_SCHEMA)
+        with conn:
+            legacy = dict()
+            for row in conn.execute("SELECT * FROM entities_legacy"):
+                legacy.setdefault((row["doc_id"], row["line_no"]), dict())[row["entity"]] = row
+            for (doc_id, line_no), statuses in legacy.items():
+                line = conn.execute(
+                    "SELECT tagged, spans FROM lines WHERE doc_id = ? AND line_no = ?", (doc_id, line_no)
+                ).fetchone()
+                if line is None:
+                    continue
+                spans = json.loads(line["spans"]) if line["spans"] is not None else extract_spans(line["tagged"])
+                conn.executemany(
+                    "INSERT OR IGNORE INTO entities "
+                    "(doc_id, line_no, span_start, span_end, entity, tag, user_updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (doc_id, line_no, start, end, entity,
+                         statuses[entity]["tag"], statuses[entity]["user_updated"])
+                        for start, end, _, entity in spans
+                        if entity in statuses
+                    ],
+                )
+            conn.execute("DROP TABLE entities_legacy")
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Connection usable as a context manager; the block runs in a single transaction.
+        """
+        return self.conn
+
+    # ─── documents ──────────────────────────────────────────────────────────
+
+    def has_document(self, doc_id: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM documents WHERE doc_id = ?", (doc_id,)
+        ).fetchone()
+        return row is not None
+
+    def list_documents(self) -> list:
+        """
+        Id, filename and tagged flag of every document, without the text.
+        """
+        return [
+            dict(row)
+            for row in self.conn.execute(
+                "SELECT doc_id, filename, tagged, updated_at FROM documents ORDER BY created_at"
+            )
+        ]
+
+    def get_updated_at(self, doc_id: str):
+        row = self.conn.execute(
+            "SELECT updated_at FROM documents WHERE doc_id = ?", (doc_id,)
+        ).fetchone()
+        return row["updated_at"] if row else None
+
+    def get_text(self, doc_id: str):
+        row = self.conn.execute(
+            "SELECT text FROM documents WHERE doc_id = ?", (doc_id,)
+        ).fetchone()
+        return row["text"] if row else None
+
+    def add_document(self, doc_id: str, text: str, filename: str = None):
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO documents (doc_id, filename, text, tagged, created_at, updated_at) "
+                "VALUES (?, ?, ?, 0, ?, ?)",
+                (doc_id, filename, text, now, now),
+            )
+
+    def get_document(self, doc_id: str):
+        """
+        Rebuild the document dictionary used by the app pages.
+        Returns None if the document does not exist.
+        """
+        doc = self.conn.execute(
+            "SELECT * FROM documents WHERE doc_id = ?", (doc_id,)
+        ).fetchone()
+        if doc is None:
+            return None
+
+        data = {
+            "text": doc["text"],
+            "tagged": bool(doc["tagged"]),
+        }
+        if doc["filename"] is not None:
+            data["filename"] = doc["filename"]
+
+        tagged_elements = self.get_lines(doc_id)
+        if tagged_elements:
+            data["tagged_elements"] = tagged_elements
+
+        llm_judgement = self.get_llm_judgement(doc_id)
+        if llm_judgement:
+            data["llm_judgement"] = llm_judgement
+        return data
+
+    def save_document(self, doc_id: str, data: dict):
+        """
+        Replace everything stored for a document with ``data``.
+        """
+        now = time.time()
+        with span("store.save_document", doc_id=doc_id), self.connection() as conn:
+            conn.execute(
+                "INSERT INTO documents (doc_id, filename, text, tagged, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(doc_id) DO UPDATE SET "
+                "filename = COALESCE(excluded.filename, documents.filename), "
+                "text = excluded.text, tagged = excluded.tagged, updated_at = excluded.updated_at",
+                (
+                    doc_id,
+                    data.get("filename"),
+                    data["text"],
+                    int(bool(data.get("tagged", False))),
+                    now,
+                    now,
+                ),
+            )
+            self._update_status(conn, [doc_id], {"tagged": bool(data.get("tagged", False))}, now)
+            if "tagged_elements" in data:
+                self._replace_lines(conn, doc_id, data["tagged_elements"] or [])
+                self._update_reviewed(conn, [doc_id], now)
+            if "llm_judgement" in data:
+                self._replace_judgement(conn, doc_id, data["llm_judgement"] or [])
+                self._update_status(conn, [doc_id], {"judged": bool(data["llm_judgement"])}, now)
+
+    # ─── lines and entities ─────────────────────────────────────────────────
+
+    def get_lines(self, doc_id: str) -> list:
+        lines = [
+            {
+                "original": row["original"],
+                "tagged": row["tagged"],
+                "english": row["english"],
+                **({"entity_status": {}} if row["has_status"] else {}),
+                **({"spans": json.loads(row["spans"])} if row["spans"] is not None else {}),
+                "_verified": bool(row["user_verified"]),
+            }
+            for row in self.conn.execute(
+                "SELECT * FROM lines WHERE doc_id = ? ORDER BY line_no", (doc_id,)
+            )
+        ]
+        for row in self.conn.execute(
+            "SELECT line_no, span_start, span_end, entity, tag, user_updated "
+            "FROM entities WHERE doc_id = ? ORDER BY line_no, span_start",
+            (doc_id,),
+        ):
+            line = lines[row["line_no"]]
+            line.setdefault("entity_status", {})[span_key(row["span_start"], row["span_end"])] = {
+                "entity": row["entity"],
+                "tag": row["tag"],
+                "user_updated": row["user_updated"],
+                "start": row["span_start"],
+                "end": row["span_end"],
+            }
+        for line in lines:
+            verified = line.pop("_verified")
+            if verified and "entity_status" in line:
+                line["entity_status"]["user_verified"] = True
+        return lines
+
+    def set_tagged_elements(self, doc_id: str, tagged_elements: list):
+        with span("store.set_tagged_elements", doc_id=doc_id, lines=len(tagged_elements)), self.connection() as conn:
+            now = time.time()
+            self._replace_lines(conn, doc_id, tagged_elements)
+            conn.execute(
+                "UPDATE documents SET tagged = 1, updated_at = ? WHERE doc_id = ?",
+                (now, doc_id),
+            )
+            self._update_status(conn, [doc_id], {"tagged": True}, now)
+            self._update_reviewed(conn, [doc_id], now)
+
+    def save_line(self, doc_id: str, line_no: int, line: dict):
+        """
+        Persist a single reviewed line. Only the line row and its entities are rewritten,
+        and the entity decisions that changed are appended to ``review_decisions``.
+        """
+        self.save_lines([(doc_id, line_no, line)])
+
+    def save_lines(self, items: list):
+        """
+        Persist many ``(doc_id, line_no, line)`` items in a single transaction. An item may
+        carry the time of the edit as a fourth element (the journal's record time), which
+        the logged decisions are stamped with; otherwise they get the time of the save.
+        """
+        now = time.time()
+        doc_ids = list({item[0] for item in items})
+        verified_changed = set()
+        with span("store.save_lines", lines=len(items), documents=len(doc_ids)), self.connection() as conn:
+            for doc_id, line_no, line, *edited_at in items:
+                previous = self._get_line_decisions(conn, doc_id, line_no)
+                self._write_line(conn, doc_id, line_no, line)
+                if self._log_decisions(conn, doc_id, line_no, line, previous, edited_at[0] if edited_at else now):
+                    verified_changed.add(doc_id)
+            conn.executemany(
+                "UPDATE documents SET updated_at = ? WHERE doc_id = ?",
+                [(now, doc_id) for doc_id in doc_ids],
+            )
+            self._update_reviewed(conn, sorted(verified_changed), now)
+
+    def _replace_lines(self, conn, doc_id, tagged_elements):
+        conn.execute("DELETE FROM entities WHERE doc_id = ?", (doc_id,))
+        conn.execute("DELETE FROM lines WHERE doc_id = ?", (doc_id,))
+        for line_no, line in enumerate(tagged_elements):
+            self._write_line(conn, doc_id, line_no, line)
+
+    def _write_line(self, conn, doc_id, line_no, line):
+        # Lines journaled before statuses were keyed by span are re-keyed on the way in
+        if "spans" not in line:
+            index_line(line)
+        entity_status = normalize_entity_status(line).get("entity_status")
+        conn.execute(
+            "INSERT OR REPLACE INTO lines "
+            "(doc_id, line_no, original, tagged, english, has_status, user_verified, spans) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                doc_id,
+                line_no,
+                line["original"],
+                line["tagged"],
+                line.get("english"),
+                int(entity_status is not None),
+                int(bool(entity_status and entity_status.get("user_verified", False))),
+                json.dumps(line["spans"], ensure_ascii=False) if "spans" in line else None,
+            ),
+        )
+        conn.execute(
+            "DELETE FROM entities WHERE doc_id = ? AND line_no = ?", (doc_id, line_no)
+        )
+        if entity_status:
+            conn.executemany(
+                "INSERT INTO entities "
+                "(doc_id, line_no, span_start, span_end, entity, tag, user_updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (doc_id, line_no, status["start"], status["end"], status["entity"],
+                     status["tag"], status["user_updated"])
+                    for _, status in iter_entity_status(entity_status)
+                ],
+            )
+
+    def _get_line_decisions(self, conn, doc_id, line_no):
+        """
+        Stored verified flag of a line (None if it is not stored yet) and the
+        ``(tag, user_updated)`` of its entities by span.
+        """
+        row = conn.execute(
+            "SELECT user_verified FROM lines WHERE doc_id = ? AND line_no = ?", (doc_id, line_no)
+        ).fetchone()
+        entities = {
+            (entity["span_start"], entity["span_end"]): (entity["tag"], entity["user_updated"])
+            for entity in conn.execute(
+                "SELECT span_start, span_end, tag, user_updated FROM entities "
+                "WHERE doc_id = ? AND line_no = ?",
+                (doc_id, line_no),
+            )
+        }
+        return (bool(row["user_verified"]) if row else None), entities
+
+    def _log_decisions(self, conn, doc_id, line_no, line, previous, created_at) -> bool:
+        """
+        Log the entities of a saved line whose tag, correction or verified flag changed.
+        Returns True if the verified flag of the line changed.
+        """
+        previous_verified, previous_entities = previous
+        entity_status = line.get("entity_status") or {}
+        verified = bool(entity_status.get("user_verified", False))
+        verified_changed = verified != previous_verified
+        conn.executemany(
+            "INSERT INTO review_decisions "
+            "(doc_id, line_no, entity, tag, user_updated, user_verified, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (doc_id, line_no, status["entity"], status["tag"], status["user_updated"], int(verified), created_at)
+                for _, status in iter_entity_status(entity_status)
+                if verified_changed
+                or previous_entities.get((status["start"], status["end"])) != (status["tag"], status["user_updated"])
+            ],
+        )
+        return verified_changed
+
+    def get_verified_lines(self, since: float = None) -> list:
+        """
+        Reviewed lines of all documents, optionally only of documents updated after ``since``.
+        """
+        return [
+            dict(row)
+            for row in self.conn.execute(
+                "SELECT l.doc_id, l.line_no, l.original, l.tagged, l.english, l.spans, d.updated_at "
+                "FROM lines l JOIN documents d ON d.doc_id = l.doc_id "
+                "WHERE l.user_verified = 1 AND d.updated_at > ? "
+                "ORDER BY l.doc_id, l.line_no",
+                (since or 0,),
+            )
+        ]
+
+    # ─── corpus-wide corrections ────────────────────────────────────────────
+
+    def find_unreviewed_occurrences(self, entity: str, tag: str, conn=None) -> list:
+        """
+        Occurrences of an entity with the given LLM tag that nobody has corrected,
+        on lines that are not verified yet.
+        """
+        return [
+            dict(row)
+            for row in (conn or self.conn).execute(
+                "SELECT e.doc_id, d.filename, e.line_no, e.span_start, e.span_end, l.original "
+                "FROM entities e "
+                "JOIN lines l ON l.doc_id = e.doc_id AND l.line_no = e.line_no "
+                "JOIN documents d ON d.doc_id = e.doc_id "
+                "WHERE e.entity = ? AND e.tag = ? AND e.user_updated IS NULL "
+                "AND l.user_verified = 0 "
+                "ORDER BY e.doc_id, e.line_no, e.span_start",
+                (entity, tag),
+            )
+        ]
+
+    def apply_bulk_correction(self, entity: str, tag: str, new_tag: str, exclude: set = None):
+        """
+        Retag every unreviewed occurrence of ``entity`` tagged ``tag`` as ``new_tag`` in
+        one transaction, except on the ``(doc_id, line_no)`` lines in ``exclude``, e.g.
+        those with journaled edits not folded in yet. Returns the batch id, used to undo
+        it, and the changed occurrences.
+        """
+        if new_tag == tag:
+            raise ValueError("The new tag must differ from the LLM tag.")
+        exclude = exclude or set()
+        now = time.time()
+        with span("store.apply_bulk_correction", entity=entity, tag=tag, new_tag=new_tag), self.connection() as conn:
+            # Take the write lock before reading, so no review is folded in between
+            conn.execute("BEGIN IMMEDIATE")
+            occurrences = [
+                o for o in self.find_unreviewed_occurrences(entity, tag, conn)
+                if (o["doc_id"], o["line_no"]) not in exclude
+            ]
+            cursor = conn.execute(
+                "INSERT INTO bulk_corrections (entity, tag, new_tag, occurrences, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (entity, tag, new_tag, len(occurrences), now),
+            )
+            batch_id = cursor.lastrowid
+            for occurrence in occurrences:
+                self._retag_entity(
+                    conn, occurrence["doc_id"], occurrence["line_no"],
+                    occurrence["span_start"], occurrence["span_end"], new_tag,
+                )
+                conn.execute(
+                    "UPDATE entities SET user_updated = ? "
+                    "WHERE doc_id = ? AND line_no = ? AND span_start = ? AND span_end = ?",
+                    (new_tag, occurrence["doc_id"], occurrence["line_no"],
+                     occurrence["span_start"], occurrence["span_end"]),
+                )
+            conn.executemany(
+                "INSERT OR IGNORE INTO bulk_correction_lines (batch_id, doc_id, line_no) VALUES (?, ?, ?)",
+                [(batch_id, o["doc_id"], o["line_no"]) for o in occurrences],
+            )
+            conn.executemany(
+                "INSERT INTO review_decisions "
+                "(doc_id, line_no, entity, tag, user_updated, user_verified, created_at) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?)",
+                [(o["doc_id"], o["line_no"], entity, tag, new_tag, now) for o in occurrences],
+            )
+        return batch_id, occurrences
+
+    def undo_bulk_correction(self, batch_id: int, exclude: set = None):
+        """
+        Revert a bulk correction on the lines where it has not been changed since.
+        Lines verified or reviewed after the correction, and those in ``exclude``,
+        keep their tags. Returns the reverted and the skipped ``(doc_id, line_no)`` pairs.
+        """
+        exclude = exclude or set()
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            batch = conn.execute(
+                "SELECT * FROM bulk_corrections WHERE batch_id = ? AND undone_at IS NULL",
+                (batch_id,),
+            ).fetchone()
+            if batch is None:
+                return [], []
+            reverted, skipped = list(), list()
+            for row in conn.execute(
+                "SELECT b.doc_id, b.line_no, e.span_start, e.span_end, l.user_verified, "
+                "EXISTS (SELECT 1 FROM review_decisions r WHERE r.doc_id = b.doc_id "
+                "AND r.line_no = b.line_no AND r.created_at > ?) AS reviewed_since "
+                "FROM bulk_correction_lines b "
+                "JOIN entities e ON e.doc_id = b.doc_id AND e.line_no = b.line_no "
+                "JOIN lines l ON l.doc_id = b.doc_id AND l.line_no = b.line_no "
+                "WHERE b.batch_id = ? AND e.entity = ? AND e.user_updated = ?",
+                (batch["created_at"], batch_id, batch["entity"], batch["new_tag"]),
+            ).fetchall():
+                if row["user_verified"] or row["reviewed_since"] or (row["doc_id"], row["line_no"]) in exclude:
+                    skipped.append((row["doc_id"], row["line_no"]))
+                    continue
+                self._retag_entity(
+                    conn, row["doc_id"], row["line_no"], row["span_start"], row["span_end"], batch["tag"],
+                )
+                conn.execute(
+                    "UPDATE entities SET user_updated = NULL "
+                    "WHERE doc_id = ? AND line_no = ? AND span_start = ? AND span_end = ?",
+                    (row["doc_id"], row["line_no"], row["span_start"], row["span_end"]),
+                )
+                reverted.append((row["doc_id"], row["line_no"]))
+            conn.execute(
+                "UPDATE bulk_corrections SET undone_at = ? WHERE batch_id = ?", (now, batch_id)
+            )
+            conn.executemany(
+                "INSERT INTO review_decisions "
+                "(doc_id, line_no, entity, tag, user_updated, user_verified, created_at) "
+                "VALUES (?, ?, ?, ?, NULL, 0, ?)",
+                [(doc_id, line_no, batch["entity"], batch["tag"], now) for doc_id, line_no in reverted],
+            )
+        return reverted, skipped
+
+    def list_bulk_corrections(self, limit: int = 20) -> list:
+        return [
+            dict(row)
+            for row in self.conn.execute(
+                "SELECT * FROM bulk_corrections ORDER BY batch_id DESC LIMIT ?", (limit,)
+            )
+        ]
+
+    def get_bulk_correction_doc_ids(self, batch_id: int) -> set:
+        return {
+            row["doc_id"]
+            for row in self.conn.execute(
+                "SELECT DISTINCT doc_id FROM bulk_correction_lines WHERE batch_id = ?", (batch_id,)
+            )
+        }
+
+    def _retag_entity(self, conn, doc_id, line_no, start, end, new_tag):
+        row = conn.execute(
+            "SELECT tagged, spans FROM lines WHERE doc_id = ? AND line_no = ?", (doc_id, line_no)
+        ).fetchone()
+        line = {"tagged": row["tagged"]}
+        if row["spans"] is not None:
+            line["spans"] = json.loads(row["spans"])
+        line_model = TaggedLine.from_line(line)
+        i = line_model.span_at(start)
+        if i is None or line_model.spans[i][1] != end:
+            return
+        line_model.retag(start, new_tag)
+        line_model.to_line(line)
+        conn.execute(
+            "UPDATE lines SET tagged = ?, spans = ? WHERE doc_id = ? AND line_no = ?",
+            (line["tagged"], json.dumps(line["spans"], ensure_ascii=False), doc_id, line_no),
+        )
+        conn.execute(
+            "UPDATE documents SET updated_at = ? WHERE doc_id = ?", (time.time(), doc_id)
+        )
+
+    # ─── LLM judgement ──────────────────────────────────────────────────────
+
+    def get_llm_judgement(self, doc_id: str) -> list:
+        chunks = dict()
+        for row in self.conn.execute(
+            "SELECT * FROM judgements WHERE doc_id = ? ORDER BY chunk_no, model, position",
+            (doc_id,),
+        ):
+            chunk = chunks.setdefault(row["chunk_no"], dict())
+            chunk.setdefault(row["model"], {"predictions": []})["predictions"].append(
+                {
+                    "entity": row["entity"],
+                    "tag": row["tag"],
+                    "correct": bool(row["correct"]),
+                    "alternative": row["alternative"],
+                }
+            )
+        return [chunks[chunk_no] for chunk_no in sorted(chunks)]
+
+    def set_llm_judgement(self, doc_id: str, llm_judgement: list):
+        with span("store.set_llm_judgement", doc_id=doc_id), self.connection() as conn:
+            self._replace_judgement(conn, doc_id, llm_judgement)
+            conn.execute(
+                "UPDATE documents SET updated_at = ? WHERE doc_id = ?",
+                (time.time(), doc_id),
+            )
+            self._update_status(conn, [doc_id], {"judged": True})
+
+    def _replace_judgement(self, conn, doc_id, llm_judgement):
+        conn.execute("DELETE FROM judgements WHERE doc_id = ?", (doc_id,))
+        rows = [
+            (
+                doc_id,
+                chunk_no,
+                model,
+                position,
+                prediction["entity"],
+                prediction.get("tag"),
+                int(bool(prediction.get("correct"))),
+                prediction.get("alternative"),
+            )
+            for chunk_no, response in enumerate(llm_judgement)
+            for model, model_response in response.items()
+            if model_response
+            for position, prediction in enumerate(model_response.get("predictions", []))
+        ]
+        conn.executemany(
+            "INSERT INTO judgements "
+            "(doc_id, chunk_no, model, position, entity, tag, correct, alternative) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    # ─── translation memory ─────────────────────────────────────────────────
+
+    def get_translations(self, keys: list) -> dict:
+        """
+        Translations of the normalised lines ``keys`` that are in the memory, by key.
+        """
+        translations = dict()
+        keys = list(set(keys))
+        # Stay below SQLite's limit of host parameters
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            translations.update(
+                (row["key"], dict(row))
+                for row in self.conn.execute(
+                    f"SELECT * FROM translation_memory WHERE key IN ({', '.join('?' * len(batch))})",
+                    batch,
+                )
+            )
+        return translations
+
+    def list_translations(self, since: float = None) -> list:
+        return [
+            dict(row)
+            for row in self.conn.execute(
+                "SELECT * FROM translation_memory WHERE updated_at > ? ORDER BY updated_at",
+                (since or 0,),
+            )
+        ]
+
+    def add_translations(self, items: list, reviewed: bool = False):
+        """
+        Remember ``(key, original, english)`` items. Reviewed translations replace
+        any translation of the same line; LLM translations never replace reviewed ones.
+        Unchanged translations keep their ``updated_at``.
+        """
+        now = time.time()
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT INTO translation_memory (key, original, english, reviewed, updated_at) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET original = excluded.original, "
+                "english = excluded.english, reviewed = excluded.reviewed, updated_at = excluded.updated_at "
+                "WHERE excluded.reviewed >= translation_memory.reviewed "
+                "AND (excluded.english != translation_memory.english "
+                "OR excluded.reviewed > translation_memory.reviewed)",
+                [(key, original, english, int(reviewed), now) for key, original, english in items],
+            )
+
+    def record_translation_run(self, doc_id: str, lines: int, exact: int, fuzzy: int, missed: int = 0):
+        """
+        ``missed`` counts remembered translations that matched no line the LLM returned.
+        """
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT INTO translation_runs (doc_id, lines, exact, fuzzy, missed, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (doc_id, lines, exact, fuzzy, missed, time.time()),
+            )
+
+    def list_translation_runs(self, limit: int = 20) -> list:
+        return [
+            dict(row)
+            for row in self.conn.execute(
+                "SELECT * FROM translation_runs ORDER BY id DESC LIMIT ?", (limit,)
+            )
+        ]
+
+    # ─── document status ────────────────────────────────────────────────────
+
+    def update_status(self, doc_ids: list, **flags):
+        """
+        Set tagged/judged/reviewed flags for many documents in a single transaction.
+        Flags set to True also record the time of the change.
+        """
+        unknown = set(flags) - set(STATUS_FLAGS)
+        if unknown:
+            raise ValueError(f"Unknown status flags: {sorted(unknown)}")
+        with self.connection() as conn:
+            self._update_status(conn, doc_ids, flags)
+
+    def get_status(self, doc_id: str) -> dict:
+        row = self.conn.execute(
+            "SELECT * FROM document_status WHERE doc_id = ?", (doc_id,)
+        ).fetchone()
+        if row is None:
+            return {"doc_id": doc_id, **{flag: False for flag in STATUS_FLAGS}}
+        return {
+            **dict(row),
+            **{flag: bool(row[flag]) for flag in STATUS_FLAGS},
+        }
+
+    def get_doc_ids_with_status(self, flag: str) -> set:
+        if flag not in STATUS_FLAGS:
+            raise ValueError(f"Unknown status flag: {flag}")
+        return {
+            row["doc_id"]
+            for row in self.conn.execute(
+                f"SELECT doc_id FROM document_status WHERE {flag} = 1"
+            )
+        }
+
+    def get_version(self, name: str) -> int:
+        row = self.conn.execute("SELECT version FROM versions WHERE name = ?", (name,)).fetchone()
+        return row["version"] if row else 0
+
+    def get_status_version(self) -> int:
+        """
+        Counter of document status changes, also those made by other processes.
+        """
+        return self.get_version("document_status")
+
+    def get_documents_version(self) -> int:
+        """
+        Counter of added documents, also those added by other processes.
+        """
+        return self.get_version("documents")
+
+    def _update_reviewed(self, conn, doc_ids, now=None):
+        """
+        A document is reviewed once every one of its lines is verified. The flag and its
+        time are only written when that state changes. Callers pass only the documents
+        where the verified flag of a line changed; each costs two index lookups.
+        """
+        if not doc_ids:
+            return
+        placeholders = ", ".join("?" * len(doc_ids))
+        reviewed = {
+            doc_id
+            for doc_id in doc_ids
+            if conn.execute(
+                "SELECT EXISTS (SELECT 1 FROM lines WHERE doc_id = ?) "
+                "AND NOT EXISTS (SELECT 1 FROM lines WHERE doc_id = ? AND user_verified = 0)",
+                (doc_id, doc_id),
+            ).fetchone()[0]
+        }
+        current = {
+            row["doc_id"]
+            for row in conn.execute(
+                f"SELECT doc_id FROM document_status WHERE reviewed = 1 AND doc_id IN ({placeholders})",
+                doc_ids,
+            )
+        }
+        self._update_status(conn, sorted(reviewed - current), {"reviewed": True}, now)
+        self._update_status(conn, sorted(current - reviewed), {"reviewed": False}, now)
+
+    def _update_status(self, conn, doc_ids, flags, now=None):
+        if not flags or not doc_ids:
+            return
+        conn.execute(
+            "INSERT INTO versions (name, version) VALUES ('document_status', 1) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1"
+        )
+        now = now or time.time()
+        columns = list(flags)
+        values = [int(bool(flags[c])) for c in columns]
+        timestamps = [now if flags[c] else None for c in columns]
+        assignments = ", ".join(
+            f"{c} = excluded.{c}, {c}_at = excluded.{c}_at" for c in columns
+        )
+        conn.executemany(
+            f"INSERT INTO document_status (doc_id, {', '.join(columns)}, "
+            f"{', '.join(c + '_at' for c in columns)}) "
+            f"VALUES (?{', ?' * (2 * len(columns))}) "
+            f"ON CONFLICT(doc_id) DO UPDATE SET {assignments}",
+            [(doc_id, *values, *timestamps) for doc_id in doc_ids],
+        )
+
+    # ─── background jobs ────────────────────────────────────────────────────
+
+    def create_job(self, job_id: str, kind: str, doc_id: str, params: dict):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, kind, doc_id, params, status, created_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?)",
+                (job_id, kind, doc_id, json.dumps(params, ensure_ascii=False), time.time()),
+            )
+        return self.get_job(job_id)
+
+    def get_job(self, job_id: str):
+        row = self.conn.execute(
+            "SELECT * FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return self._job_from_row(row) if row else None
+
+    def list_jobs(self, doc_id: str = None, kind: str = None, statuses=None) -> list:
+        """
+        Jobs matching the filters, newest first.
+        """
+        conditions, params = [], []
+        if doc_id is not None:
+            conditions.append("doc_id = ?")
+            params.append(doc_id)
+        if kind is not None:
+            conditions.append("kind = ?")
+            params.append(kind)
+        if statuses:
+            conditions.append(f"status IN ({', '.join('?' * len(statuses))})")
+            params.extend(statuses)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return [
+            self._job_from_row(row)
+            for row in self.conn.execute(
+                f"SELECT * FROM jobs {where} ORDER BY created_at DESC", params
+            )
+        ]
+
+    def update_job(self, job_id: str, **fields):
+        if not fields:
+            return
+        if "status" in fields and fields["status"] not in JOB_STATUSES:
+            raise ValueError(f"Unknown job status: {fields['status']}")
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self.connection() as conn:
+            conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE job_id = ?",
+                (*fields.values(), job_id),
+            )
+
+    def claim_job(self, job_id: str) -> bool:
+        """
+        Move a queued job to running. Returns False if it was already claimed or cancelled.
+        """
+        with self.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? "
+                "WHERE job_id = ? AND status = 'queued' AND cancel_requested = 0",
+                (time.time(), job_id),
+            )
+        return cursor.rowcount == 1
+
+    def request_job_cancel(self, job_id: str):
+        with self.connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,)
+            )
+            # A job that has not started yet is cancelled right away
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? "
+                "WHERE job_id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            )
+
+    def is_job_cancel_requested(self, job_id: str) -> bool:
+        row = self.conn.execute(
+            "SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def requeue_interrupted_jobs(self) -> int:
+        """
+        Put jobs that were running when the server stopped back into the queue.
+        """
+        with self.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, done = 0 "
+                "WHERE status = 'running' AND cancel_requested = 0"
+            )
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? "
+                "WHERE status = 'running' AND cancel_requested = 1",
+                (time.time(),),
+            )
+        return cursor.rowcount
+
+    @staticmethod
+    def _job_from_row(row) -> dict:
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    # ─── cross-document queries ─────────────────────────────────────────────
+
+    def find_entity(self, entity: str = None, tag: str = None) -> list:
+        """
+        All occurrences of an entity surface form and/or predicted tag across documents.
+        """
+        conditions, params = [], []
+        if entity is not None:
+            conditions.append("e.entity = ?")
+            params.append(entity)
+        if tag is not None:
+            conditions.append("e.tag = ?")
+            params.append(tag)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return [
+            dict(row)
+            for row in self.conn.execute(
+                "SELECT e.doc_id, d.filename, e.line_no, e.entity, e.tag, e.user_updated, l.original "
+                "FROM entities e "
+                "JOIN lines l ON l.doc_id = e.doc_id AND l.line_no = e.line_no "
+                "JOIN documents d ON d.doc_id = e.doc_id "
+                f"{where} ORDER BY e.doc_id, e.line_no",
+                params,
+            )
+        ]
+
+    def entity_counts(self) -> dict:
+        """
+        Number of entities per final tag (user correction if any, else the LLM tag).
+        """
+        return {
+            row["final_tag"]: row["count"]
+            for row in self.conn.execute(
+                "SELECT COALESCE(user_updated, tag) AS final_tag, COUNT(*) AS count "
+                "FROM entities GROUP BY final_tag HAVING final_tag IS NOT NULL"
+            )
+        }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> AnnotationStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = AnnotationStore()
+    return _store
+
+
+def migrate_upload_jsons(upload_dir: str = UPLOAD_DIR, store: AnnotationStore = None):
+    """
+    Import the legacy ``{upload_dir}/{md5}.json`` files into the SQLite store.
+    The JSON files are left untouched.
+    """
+    store = store or get_store()
+    migrated = 0
+    for file_path in sorted(glob.glob(os.path.join(upload_dir, "*.json"))):
+        doc_id = os.path.basename(file_path).replace(".json", "")
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if "text" not in data:
+            print(f"Skipping {file_path}: no text found.")
+            continue
+        store.save_document(doc_id, data)
+        migrated += 1
+    print(f"Migrated {migrated} documents into {store.db_path}.")
+    return migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Annotation store utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser(
+        "migrate", help="Import legacy upload JSON files into the SQLite store"
+    )
+    migrate_parser.add_argument("--upload-dir", default=UPLOAD_DIR)
+    migrate_parser.add_argument("--db", default=ANNOTATIONS_DB)
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate_upload_jsons(args.upload_dir, AnnotationStore(args.db))
@@ -0,0 +1,184 @@
+"""
+OpenTelemetry tracing of the tag → parse → save → review pipeline.
+
+Tracing is off unless ``NER_TRACING_EXPORTER`` is set:
+
+- ``otlp``: send spans to a local collector over OTLP/HTTP (the standard
+  ``OTEL_EXPORTER_OTLP_*`` variables configure the endpoint).
+- ``file``: append one JSON span per line to ``NER_TRACE_FILE``
+  (``results/traces.jsonl`` by default).
+- ``console``: print spans to stdout.
+
+The app uses its own tracer provider, so the telemetry that crewai sets up is
+not affected. The document id is carried in the OpenTelemetry baggage and added
+to every span started inside ``document_context``, including spans in worker
+threads that are started with the submitting thread's ``current_context()``.
+
+OpenTelemetry is only imported once tracing is configured; until then, and
+when the SDK is not installed, spans are a no-op and cost one attribute check.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from ner_annotator.constants import RESULTS_DIR
+
+
+TRACING_EXPORTER_ENV = "NER_TRACING_EXPORTER"
+TRACE_FILE_ENV = "NER_TRACE_FILE"
+DEFAULT_TRACE_FILE = f"{RESULTS_DIR}/traces.jsonl"
+SERVICE_NAME = "ner-annotator"
+
+# None while tracing is off
+_tracer = None
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class _NoOpSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def record_exception(self, exception):
+        pass
+
+    def set_status(self, status):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoOpSpan()
+
+
+def _file_exporter(path):
+    from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+    class JSONLinesSpanExporter(SpanExporter):
+        def __init__(self):
+            self._lock = threading.Lock()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        def export(self, spans):
+            lines = "".join(json.dumps(json.loads(s.to_json()), ensure_ascii=False) + "\n" for s in spans)
+            with self._lock, open(path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            return SpanExportResult.SUCCESS
+
+        def shutdown(self):
+            pass
+
+    return JSONLinesSpanExporter()
+
+
+def _make_exporter(name):
+    if name == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    if name == "file":
+        return _file_exporter(os.getenv(TRACE_FILE_ENV, DEFAULT_TRACE_FILE))
+    if name == "console":
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+        return ConsoleSpanExporter()
+    raise ValueError(f"Unknown tracing exporter: {name}")
+
+
+def configure_tracing():
+    """
+    Set up the tracer from the environment. Called once per process; the SDK
+    is only imported when tracing is enabled.
+    """
+    global _tracer, _configured
+    with _configure_lock:
+        if _configured:
+            return
+        _configured = True
+        exporter_name = os.getenv(TRACING_EXPORTER_ENV, "").strip().lower()
+        if not exporter_name:
+            return
+        try:
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError as e:
+            print(f"Tracing disabled, the OpenTelemetry SDK is not installed: {e}")
+            return
+
+        provider = TracerProvider(resource=Resource.create({
+            "service.name": SERVICE_NAME,
+            "process.pid": os.getpid(),
+        }))
+        provider.add_span_processor(BatchSpanProcessor(_make_exporter(exporter_name)))
+        _tracer = provider.get_tracer("ner_annotator")
+        print(f"Tracing enabled, exporting spans via {exporter_name}.")
+
+
+def current_context():
+    if _tracer is None:
+        return None
+    from opentelemetry import context as otel_context
+
+    return otel_context.get_current()
+
+
+@contextmanager
+def document_context(doc_id: str):
+    if _tracer is None:
+        yield
+        return
+    from opentelemetry import baggage, context as otel_context
+
+    token = otel_context.attach(baggage.set_baggage("doc_id", doc_id))
+    try:
+        yield
+    finally:
+        otel_context.detach(token)
+
+
+def _span_attributes(parent, attributes):
+    from opentelemetry import baggage
+
+    doc_id = baggage.get_baggage("doc_id", parent)
+    if doc_id is not None:
+        attributes.setdefault("doc_id", doc_id)
+    return {k: v for k, v in attributes.items() if v is not None}
+
+
+@contextmanager
+def span(name: str, parent=None, **attributes):
+    """
+    Start a span as the current span. ``parent`` is a context captured with
+    ``current_context()`` in another thread; attributes that are None are dropped.
+    """
+    if _tracer is None:
+        yield NOOP_SPAN
+        return
+    with _tracer.start_as_current_span(
+        name, context=parent, attributes=_span_attributes(parent, attributes)
+    ) as current_span:
+        yield current_span
+
+
+@contextmanager
+def detached_span(name: str, parent=None, **attributes):
+    """
+    Like ``span``, but the span does not become the current span, so it can stay
+    open across the yields of a generator: a context attached there would be
+    detached wherever the consumer happens to resume the generator.
+    """
+    if _tracer is None:
+        yield NOOP_SPAN
+        return
+    from opentelemetry import trace
+
+    current_span = _tracer.start_span(name, context=parent, attributes=_span_attributes(parent, attributes))
+    try:
+        yield current_span
+    except Exception as e:
+        current_span.record_exception(e)
+        current_span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
+        raise
+    finally:
+        current_span.end()
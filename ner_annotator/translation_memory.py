@@ -0,0 +1,251 @@
+"""
+Translation memory for the English field of tagged lines.
+
+Every translation the tagger returns is remembered under the normalised Urdu
+line (see ``search.normalize_urdu``), and the translations of reviewed lines
+replace them. Before a text is tagged, its lines are looked up in the memory:
+
+- exact: the normalised line is in the memory.
+- fuzzy: a remembered line has a Jaccard similarity of at least
+  ``TRANSLATION_MEMORY_FUZZY_THRESHOLD`` over character 4-grams, found with
+  the MinHash/LSH scheme of ``near_duplicates``.
+
+The prompt asks the LLM to leave the translation of those lines empty, so it
+only translates the remaining lines, and the memory fills in the rest. The
+number of exact and fuzzy hits of every run is recorded in the store, with the
+remembered translations that matched no line the LLM returned.
+
+The MinHash signatures of the remembered lines are saved to
+``TRANSLATION_MEMORY_INDEX_PATH`` like the near-duplicate index (see
+``index_file``), so a tagging job only signs the lines remembered since the
+index was saved.
+
+``python -m ner_annotator.translation_memory sync`` adds the translations of
+reviewed lines and ``python -m ner_annotator.translation_memory stats`` shows
+the reuse rates of the last runs.
+"""
+import argparse
+import os
+import threading
+from array import array
+from collections import defaultdict
+
+import numpy as np
+
+from ner_annotator.constants import (
+    NEAR_DUPLICATE_PERMUTATIONS,
+    TRANSLATION_MEMORY_FUZZY_THRESHOLD,
+    TRANSLATION_MEMORY_INDEX_PATH,
+)
+from ner_annotator.index_file import read_index_file, write_index_file
+from ner_annotator.near_duplicates import band_keys, jaccard, minhash, shingles
+from ner_annotator.search import tokenize
+from ner_annotator.store import AnnotationStore, get_store
+
+
+INDEX_VERSION = 3
+INDEX_MAGIC = b"NERTRMM"
+
+
+def translation_key(line: str) -> str:
+    return " ".join(tokenize(line))
+
+
+class TranslationMemory:
+    def __init__(self, store: AnnotationStore = None, path: str = TRANSLATION_MEMORY_INDEX_PATH):
+        self.store = store or get_store()
+        self.path = path
+        # key -> {"original", "shingles", "signature"}, of the lines in the fuzzy index
+        self.lines = dict()
+        # (band, key bytes) -> set of keys
+        self.buckets = defaultdict(set)
+        self.loaded_at = 0
+        self.reviewed_synced_at = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    # ─── persistence ────────────────────────────────────────────────────────
+
+    @classmethod
+    def load(cls, store: AnnotationStore = None, path: str = TRANSLATION_MEMORY_INDEX_PATH) -> "TranslationMemory":
+        memory = cls(store, path)
+        if not os.path.exists(path):
+            return memory
+        loaded = read_index_file(path, INDEX_MAGIC, INDEX_VERSION)
+        if loaded is None:
+            print("Translation memory index version changed, rebuilding.")
+            return memory
+        header, (signatures,) = loaded
+        memory.loaded_at = header["loaded_at"]
+        memory.reviewed_synced_at = header["reviewed_synced_at"]
+        signatures = np.frombuffer(signatures, dtype=np.uint32).reshape(-1, NEAR_DUPLICATE_PERMUTATIONS)
+        for (key, original), signature in zip(header["lines"], signatures):
+            memory._add(key, {"original": original, "shingles": shingles(original), "signature": signature})
+        memory._dirty = False
+        return memory
+
+    def save(self):
+        """
+        Write the remembered lines as the header and their MinHash signatures as a raw
+        ``array('I')`` buffer, one row of ``NEAR_DUPLICATE_PERMUTATIONS`` per line.
+        """
+        with self._lock:
+            signatures = array("I")
+            lines = list()
+            for key, entry in self.lines.items():
+                lines.append([key, entry["original"]])
+                signatures.frombytes(entry["signature"].tobytes())
+            write_index_file(
+                self.path, INDEX_MAGIC, INDEX_VERSION,
+                {"loaded_at": self.loaded_at, "reviewed_synced_at": self.reviewed_synced_at, "lines": lines},
+                [signatures],
+            )
+            self._dirty = False
+
+    # ─── indexing ───────────────────────────────────────────────────────────
+
+    def _add(self, key, entry):
+        if key in self.lines:
+            self.lines[key].update(original=entry["original"], shingles=entry["shingles"])
+            return
+        self.lines[key] = entry
+        for band_key in band_keys(entry["signature"]):
+            self.buckets[band_key].add(key)
+        self._dirty = True
+
+    def update(self) -> bool:
+        """
+        Add the lines remembered since the last update to the fuzzy index. Returns True if it changed.
+        """
+        with self._lock:
+            for row in self.store.list_translations(since=self.loaded_at):
+                if row["key"] not in self.lines:
+                    shingle_set = shingles(row["original"])
+                    if shingle_set:
+                        self._add(row["key"], {
+                            "original": row["original"], "shingles": shingle_set, "signature": minhash(shingle_set),
+                        })
+                self.loaded_at = max(self.loaded_at, row["updated_at"])
+            return self._dirty
+
+    def sync_reviewed(self) -> int:
+        """
+        Remember the translations of lines reviewed since the last sync. The sync time is
+        saved with the index, so a tagging job only reads the lines reviewed since then.
+        """
+        with self._lock:
+            rows = self.store.get_verified_lines(since=self.reviewed_synced_at)
+            items = [
+                (translation_key(row["original"]), row["original"], row["english"].strip())
+                for row in rows
+                if row["english"] and row["english"].strip() and translation_key(row["original"])
+            ]
+            if items:
+                self.store.add_translations(items, reviewed=True)
+            if rows:
+                self.reviewed_synced_at = max(row["updated_at"] for row in rows)
+                self._dirty = True
+            return len(items)
+
+    # ─── lookup ─────────────────────────────────────────────────────────────
+
+    def _fuzzy_match(self, line: str):
+        shingle_set = shingles(line)
+        if not shingle_set:
+            return None
+        candidates = set()
+        for band_key in band_keys(minhash(shingle_set)):
+            candidates.update(self.buckets.get(band_key, ()))
+        scored = [(jaccard(shingle_set, self.lines[key]["shingles"]), key) for key in candidates]
+        best = max(scored, default=(0, None))
+        return best if best[0] >= TRANSLATION_MEMORY_FUZZY_THRESHOLD else None
+
+    def lookup(self, lines: list, fuzzy: bool = True) -> dict:
+        """
+        Remembered translations of ``lines`` as ``{line index: {"english", "match", "similarity"}}``.
+        """
+        keys = [translation_key(line) for line in lines]
+        exact = self.store.get_translations([key for key in keys if key])
+        found = dict()
+        missing = list()
+        for i, key in enumerate(keys):
+            if key in exact:
+                found[i] = {"english": exact[key]["english"], "match": "exact", "similarity": 1.0}
+            elif key:
+                missing.append(i)
+        if not fuzzy or not missing:
+            return found
+
+        with self._lock:
+            matches = {i: self._fuzzy_match(lines[i]) for i in missing}
+        matches = {i: match for i, match in matches.items() if match is not None}
+        translations = self.store.get_translations([key for _, key in matches.values()])
+        for i, (similarity, key) in matches.items():
+            if key in translations:
+                found[i] = {
+                    "english": translations[key]["english"],
+                    "match": "fuzzy",
+                    "similarity": similarity,
+                }
+        return found
+
+    def remember(self, translations: list) -> int:
+        """
+        Remember the translations the LLM returned, as ``(line, english)`` pairs.
+        """
+        items = [
+            (translation_key(line), line, english.strip())
+            for line, english in translations
+            if english and english.strip() and translation_key(line)
+        ]
+        if items:
+            self.store.add_translations(items)
+        return len(items)
+
+
+_memory = None
+_memory_lock = threading.Lock()
+
+
+def get_translation_memory() -> TranslationMemory:
+    """
+    The translation memory, with the translations of reviewed lines added and the
+    fuzzy index updated with the lines remembered since it was saved.
+    """
+    global _memory
+    with _memory_lock:
+        if _memory is None:
+            _memory = TranslationMemory.load()
+        try:
+            _memory.sync_reviewed()
+        except Exception as e:
+            print(f"Error syncing reviewed translations: {e}")
+        if _memory.update():
+            _memory.save()
+    return _memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Translation memory of tagged lines.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("sync", help="Add the translations of reviewed lines and update the fuzzy index")
+    stats_parser = subparsers.add_parser("stats", help="Show the reuse rates of the last tagging runs")
+    stats_parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "sync":
+        memory = TranslationMemory.load()
+        print(f"Added {memory.sync_reviewed()} reviewed translations.")
+        if memory.update():
+            memory.save()
+        print(f"{len(memory.lines)} lines in the fuzzy index.")
+    else:
+        runs = get_store().list_translation_runs(args.limit)
+        if not runs:
+            print("No tagging runs recorded yet.")
+        for run in runs:
+            reused = run["exact"] + run["fuzzy"]
+            print(
+                f"{run['doc_id'] or '-'}: {run['lines']} lines, {run['exact']} exact, "
+                f"{run['fuzzy']} fuzzy, {run['missed']} missed ({reused / max(run['lines'], 1):.1%} reused)"
+            )
@@ -0,0 +1,31 @@
+import pytest
+
+from ner_annotator.store import AnnotationStore
+
+
+def make_line(original, tagged, english=""):
+    return {"original": original, "tagged": tagged, "english": english}
+
+
+def entity_keys(line):
+    return [key for key in line["entity_status"] if key != "user_verified"]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return AnnotationStore(str(tmp_path / "annotations.db"))
+
+
+@pytest.fixture
+def tagged_store(store):
+    lines = [
+        make_line("علی اور حسین آئے", "<PERSON>علی</PERSON> اور <PERSON>حسین</PERSON> آئے", "Ali and Husain came"),
+        make_line("کربلا میں علی", "<LOCATION>کربلا</LOCATION> میں <PERSON>علی</PERSON>", "Ali in Karbala"),
+    ]
+    store.save_document("doc", {
+        "text": "\n".join(line["original"] for line in lines),
+        "filename": "doc.txt",
+        "tagged": True,
+        "tagged_elements": lines,
+    })
+    return store
@@ -0,0 +1,54 @@
+import pytest
+
+from ner_annotator.entities import EntityIndex, TaggedLine, extract_spans, index_line
+
+
+TAGGED = "<PERSON>علی</PERSON> اور <PERSON>حسین</PERSON> آئے"
+
+
+def test_extract_spans():
+    assert extract_spans(TAGGED) == [[0, 3, "PERSON", "علی"], [8, 12, "PERSON", "حسین"]]
+
+
+def test_from_line_round_trips_the_tagged_text():
+    line = TaggedLine.from_line({"tagged": TAGGED})
+    assert line.text == "علی اور حسین آئے"
+    assert line.tagged == TAGGED
+
+
+def test_retag_and_remove_touch_one_span():
+    line = TaggedLine.from_line({"tagged": TAGGED})
+    line.retag(8, "LOCATION")
+    assert line.tagged == "<PERSON>علی</PERSON> اور <LOCATION>حسین</LOCATION> آئے"
+    line.remove(0)
+    assert line.tagged == "علی اور <LOCATION>حسین</LOCATION> آئے"
+    with pytest.raises(KeyError):
+        line.retag(0, "PERSON")
+
+
+def test_add_rejects_overlaps():
+    line = TaggedLine.from_line({"tagged": TAGGED})
+    start = line.find_untagged("آئے")
+    assert start == 13
+    line.add(start, start + 3, "EVENT")
+    assert line.tagged.endswith("<EVENT>آئے</EVENT>")
+    with pytest.raises(ValueError):
+        line.add(1, 5, "PERSON")
+
+
+def test_to_line_writes_tagged_text_and_spans():
+    line = TaggedLine.from_line({"tagged": TAGGED})
+    line.retag(0, "LOCATION")
+    stored = line.to_line({"original": line.text})
+    assert stored["tagged"] == "<LOCATION>علی</LOCATION> اور <PERSON>حسین</PERSON> آئے"
+    assert stored["spans"][0] == [0, 3, "LOCATION", "علی"]
+
+
+def test_entity_index_from_line_entities_matches_parsed_index():
+    lines = [{"original": "", "tagged": TAGGED}, {"original": "", "tagged": "<PERSON>علی</PERSON>"}]
+    for line in lines:
+        index_line(line)
+    index = EntityIndex(lines)
+    rebuilt = EntityIndex.from_line_entities(index.line_entities)
+    assert rebuilt.line_entities == index.line_entities
+    assert rebuilt.find("علی") == index.find("علی") == {0: "PERSON", 1: "PERSON"}
@@ -0,0 +1,67 @@
+import json
+import os
+
+from conftest import entity_keys
+from ner_annotator.journal import EditJournal
+
+
+def journal_record(doc_id, line_no, line, ts=1.0):
+    return json.dumps({"ts": ts, "action": "review", "doc_id": doc_id, "line_no": line_no, "line": line})
+
+
+def verified(line):
+    line["entity_status"]["user_verified"] = True
+    return line
+
+
+def test_append_and_compact(tagged_store, tmp_path):
+    journal = EditJournal(tagged_store, journal_dir=str(tmp_path / "journal"))
+    try:
+        line = verified(tagged_store.get_lines("doc")[0])
+        journal.append("doc", 0, "review", line)
+        assert journal.has_pending("doc")
+        assert journal.pending_lines() == {("doc", 0)}
+        assert journal.compact() == 1
+        assert not journal.has_pending("doc")
+        assert tagged_store.get_lines("doc")[0]["entity_status"]["user_verified"] is True
+    finally:
+        journal.close()
+
+
+def test_recovers_journal_of_crashed_process(tagged_store, tmp_path):
+    journal_dir = tmp_path / "journal"
+    journal_dir.mkdir()
+    lines = tagged_store.get_lines("doc")
+    key = entity_keys(lines[1])[0]
+    lines[1]["entity_status"][key]["user_updated"] = "PERSON"
+    # The process died while writing its last record
+    (journal_dir / "review.999999.journal").write_text(
+        journal_record("doc", 0, verified(lines[0])) + "\n"
+        + journal_record("doc", 1, lines[1], ts=2.0) + "\n"
+        + '{"ts": 3.0, "action": "rev',
+        encoding="utf-8",
+    )
+    (journal_dir / "review.999999.lock").touch()
+
+    journal = EditJournal(tagged_store, journal_dir=str(journal_dir))
+    try:
+        stored = tagged_store.get_lines("doc")
+        assert stored[0]["entity_status"]["user_verified"] is True
+        assert stored[1]["entity_status"][key]["user_updated"] == "PERSON"
+        assert not os.path.exists(journal_dir / "review.999999.journal")
+        assert not os.path.exists(journal_dir / "review.999999.lock")
+    finally:
+        journal.close()
+
+
+def test_compact_retries_leftover_rotated_files(tagged_store, tmp_path):
+    journal = EditJournal(tagged_store, journal_dir=str(tmp_path / "journal"))
+    try:
+        line = verified(tagged_store.get_lines("doc")[0])
+        with open(f"{journal._path}.1.compacting", "w", encoding="utf-8") as f:
+            f.write(journal_record("doc", 0, line) + "\n")
+        assert journal.compact() == 1
+        assert tagged_store.get_lines("doc")[0]["entity_status"]["user_verified"] is True
+        assert not os.path.exists(f"{journal._path}.1.compacting")
+    finally:
+        journal.close()
@@ -0,0 +1,47 @@
+import random
+
+import pytest
+from sklearn.metrics import balanced_accuracy_score, confusion_matrix, precision_recall_fscore_support
+
+from ner_annotator.metrics import ConfusionMatrix, get_classification_metrics
+
+
+LABELS = ["PERSON", "LOCATION", "DATE", "EVENT"]
+
+
+@pytest.fixture
+def predictions():
+    rng = random.Random(7)
+    y_true = [rng.choice(LABELS) for _ in range(300)]
+    y_pred = [label if rng.random() < 0.7 else rng.choice(LABELS) for label in y_true]
+    return y_true, y_pred
+
+
+def test_matrix_matches_sklearn(predictions):
+    y_true, y_pred = predictions
+    matrix = ConfusionMatrix(LABELS).update(y_true, y_pred)
+    assert (matrix.matrix == confusion_matrix(y_true, y_pred, labels=LABELS)).all()
+    assert matrix.balanced_accuracy() == pytest.approx(balanced_accuracy_score(y_true, y_pred))
+
+
+@pytest.mark.parametrize("average", ["micro", "macro", "weighted"])
+def test_scores_match_sklearn(predictions, average):
+    y_true, y_pred = predictions
+    metrics = get_classification_metrics(ConfusionMatrix().update(y_true, y_pred), LABELS)
+    precision, recall, f1, _ = precision_recall_fscore_support(
+        y_true, y_pred, labels=LABELS, average=average, zero_division=0
+    )
+    scores = metrics[f"{average}_scores"]
+    assert scores["precision"] == pytest.approx(precision)
+    assert scores["recall"] == pytest.approx(recall)
+    assert scores["f1"] == pytest.approx(f1)
+
+
+def test_merged_matrices_match_one_matrix(predictions):
+    y_true, y_pred = predictions
+    first = ConfusionMatrix().update(y_true[:100], y_pred[:100])
+    second = ConfusionMatrix().update(y_true[100:], y_pred[100:])
+    merged = first + second
+    assert (merged.counts(LABELS)[0] == ConfusionMatrix().update(y_true, y_pred).counts(LABELS)[0]).all()
+    merged -= second
+    assert (merged.counts(LABELS)[2] == first.counts(LABELS)[2]).all()
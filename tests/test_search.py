@@ -0,0 +1,58 @@
+import random
+
+from ner_annotator.search import SearchIndex, normalize_urdu, tokenize
+
+
+def brute_force(texts, query):
+    terms = tokenize(query)
+    hits = list()
+    for doc_key, text in texts.items():
+        for line_no, line in enumerate(text.split("\n")):
+            tokens = tokenize(line)
+            if any(tokens[i:i + len(terms)] == terms for i in range(len(tokens))):
+                hits.append((doc_key, line_no))
+    return hits
+
+
+def test_normalize_urdu_folds_letter_variants_and_diacritics():
+    assert normalize_urdu("عَلِی") == normalize_urdu("علی")
+    assert normalize_urdu("كربلا") == normalize_urdu("کربلا")
+
+
+def test_phrase_search_matches_brute_force(tmp_path):
+    rng = random.Random(1)
+    words = ["علی", "حسین", "کربلا", "آئے", "میں", "اور"]
+    index = SearchIndex(str(tmp_path / "search.bin"))
+    texts = dict()
+    for d in range(30):
+        texts[f"doc{d}"] = "\n".join(
+            " ".join(rng.choice(words) for _ in range(rng.randint(0, 8))) for _ in range(5)
+        )
+        index.add_document(f"doc{d}", f"doc{d}", texts[f"doc{d}"], "upload")
+
+    queries = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 4))) for _ in range(200)]
+    for query in queries:
+        assert index.search(query) == brute_force(texts, query), query
+
+    index.remove_documents({"doc3", "doc7"})
+    del texts["doc3"], texts["doc7"]
+    for query in queries:
+        assert index.search(query) == brute_force(texts, query), query
+    assert index.search("غیر") == []
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "search.bin")
+    index = SearchIndex(path)
+    index.add_document("a", "a.txt", "علی اور حسین\nکربلا میں علی", "upload")
+    index.save()
+    loaded = SearchIndex.load(path)
+    assert loaded.docs == index.docs
+    assert loaded.postings == index.postings
+    assert loaded.search("میں علی") == [("a", 1)]
+
+
+def test_load_rebuilds_unknown_files(tmp_path):
+    path = tmp_path / "search.bin"
+    path.write_bytes(b"not an index")
+    assert SearchIndex.load(str(path)).docs == {}
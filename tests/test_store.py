@@ -0,0 +1,89 @@
+from conftest import entity_keys, make_line
+
+
+def count_decisions(store):
+    return store.conn.execute("SELECT COUNT(*) FROM review_decisions").fetchone()[0]
+
+
+def test_document_round_trip(tagged_store):
+    data = tagged_store.get_document("doc")
+    assert data["tagged"] is True
+    assert data["filename"] == "doc.txt"
+    assert [line["original"] for line in data["tagged_elements"]] == ["علی اور حسین آئے", "کربلا میں علی"]
+    first = data["tagged_elements"][0]
+    assert first["spans"] == [[0, 3, "PERSON", "علی"], [8, 12, "PERSON", "حسین"]]
+    statuses = [first["entity_status"][key] for key in entity_keys(first)]
+    assert {(s["entity"], s["tag"], s["user_updated"]) for s in statuses} == {
+        ("علی", "PERSON", None), ("حسین", "PERSON", None),
+    }
+    assert tagged_store.get_doc_ids_with_status("tagged") == {"doc"}
+
+
+def test_repeated_entities_are_kept_per_span(store):
+    store.save_document("doc", {
+        "text": "علی علی",
+        "tagged": True,
+        "tagged_elements": [make_line("علی علی", "<PERSON>علی</PERSON> <LOCATION>علی</LOCATION>")],
+    })
+    line = store.get_lines("doc")[0]
+    assert sorted(line["entity_status"][key]["tag"] for key in entity_keys(line)) == ["LOCATION", "PERSON"]
+
+
+def test_save_line_logs_only_changes(tagged_store):
+    line = tagged_store.get_lines("doc")[0]
+    tagged_store.save_line("doc", 0, line)
+    assert count_decisions(tagged_store) == 0
+
+    line["entity_status"]["user_verified"] = True
+    tagged_store.save_lines([("doc", 0, line, 123.0)])
+    assert count_decisions(tagged_store) == 2
+    assert {row[0] for row in tagged_store.conn.execute("SELECT created_at FROM review_decisions")} == {123.0}
+
+    key = entity_keys(line)[0]
+    line["entity_status"][key]["user_updated"] = "LOCATION"
+    tagged_store.save_line("doc", 0, line)
+    assert count_decisions(tagged_store) == 3
+    assert tagged_store.get_lines("doc")[0]["entity_status"][key]["user_updated"] == "LOCATION"
+
+
+def test_reviewed_only_when_all_lines_verified(tagged_store):
+    lines = tagged_store.get_lines("doc")
+    lines[0]["entity_status"]["user_verified"] = True
+    tagged_store.save_line("doc", 0, lines[0])
+    assert tagged_store.get_doc_ids_with_status("reviewed") == set()
+
+    lines[1]["entity_status"]["user_verified"] = True
+    tagged_store.save_line("doc", 1, lines[1])
+    assert tagged_store.get_doc_ids_with_status("reviewed") == {"doc"}
+
+    lines[1]["entity_status"]["user_verified"] = False
+    tagged_store.save_line("doc", 1, lines[1])
+    assert tagged_store.get_doc_ids_with_status("reviewed") == set()
+
+
+def test_bulk_correction_and_undo(tagged_store):
+    occurrences = tagged_store.find_unreviewed_occurrences("علی", "PERSON")
+    assert [(o["doc_id"], o["line_no"]) for o in occurrences] == [("doc", 0), ("doc", 1)]
+
+    batch_id, changed = tagged_store.apply_bulk_correction("علی", "PERSON", "LOCATION")
+    assert len(changed) == 2
+    lines = tagged_store.get_lines("doc")
+    assert lines[0]["tagged"] == "<LOCATION>علی</LOCATION> اور <PERSON>حسین</PERSON> آئے"
+    assert tagged_store.find_unreviewed_occurrences("علی", "PERSON") == []
+
+    # A line verified after the correction keeps it
+    lines[1]["entity_status"]["user_verified"] = True
+    tagged_store.save_line("doc", 1, lines[1])
+    reverted, skipped = tagged_store.undo_bulk_correction(batch_id)
+    assert reverted == [("doc", 0)]
+    assert skipped == [("doc", 1)]
+    lines = tagged_store.get_lines("doc")
+    assert lines[0]["tagged"] == "<PERSON>علی</PERSON> اور <PERSON>حسین</PERSON> آئے"
+    assert lines[1]["tagged"] == "<LOCATION>کربلا</LOCATION> میں <LOCATION>علی</LOCATION>"
+    assert tagged_store.undo_bulk_correction(batch_id) == ([], [])
+
+
+def test_bulk_correction_skips_excluded_lines(tagged_store):
+    _, changed = tagged_store.apply_bulk_correction("علی", "PERSON", "LOCATION", exclude={("doc", 1)})
+    assert [(o["doc_id"], o["line_no"]) for o in changed] == [("doc", 0)]
+    assert not tagged_store.conn.in_transaction